@@ -0,0 +1,860 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# =*= License: GPL-2+ =*=
+
+
+'''Benchmarks for cliapp.
+
+Run as "python benchmark.py SUBCOMMAND". Each subcommand measures
+one part of the framework and writes a small table to the output.
+
+'''
+
+
+from __future__ import division
+
+import gzip
+import importlib
+import io
+import mmap
+import os
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors34 as selectors
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cliapp
+
+
+# The cliapp.runcmd attribute is the function, not the module.
+runcmd_module = importlib.import_module('cliapp.runcmd')
+settings_module = importlib.import_module('cliapp.settings')
+
+MiB = 1024 ** 2
+
+
+def cpu_time():
+    '''Return CPU time (user + system) used by this process so far.'''
+    t = os.times()
+    return t[0] + t[1]
+
+
+def counting_selector(base):
+    '''Return a subclass of selector class base that counts wakeups.'''
+
+    class CountingSelector(base):
+
+        wakeups = 0
+
+        def select(self, timeout=None):
+            CountingSelector.wakeups += 1
+            return base.select(self, timeout)
+
+    return CountingSelector
+
+
+class Benchmark(cliapp.Application):
+
+    def add_settings(self):
+        self.settings.bytesize(
+            ['size'],
+            'pipe SIZE bytes through commands (default: %default)',
+            default=64 * MiB)
+        self.settings.integer(
+            ['rounds'],
+            'repeat each measurement N times, report best (default: %default)',
+            metavar='N',
+            default=3)
+        self.settings.bytesize(
+            ['heap'],
+            'use SIZE bytes of memory while measuring runcmd-spawn '
+            '(default: %default)',
+            default=2 * 1024 * MiB)
+        self.settings.integer(
+            ['import-budget'],
+            'fail import-time if importing cliapp takes more than MS '
+            'milliseconds (default: %default)',
+            metavar='MS',
+            default=100)
+
+    def measure(self, func):
+        '''Call func repeatedly, return best (wall, cpu) times.'''
+        best = None
+        for _ in range(self.settings['rounds']):
+            started = time.time()
+            cpu_started = cpu_time()
+            func()
+            result = (time.time() - started, cpu_time() - cpu_started)
+            if best is None or result < best:
+                best = result
+        return best
+
+    def report(self, title, rows):
+        self.output.write('%s\n' % title)
+        for row in rows:
+            self.output.write('  %s\n' % row)
+
+    def cmd_runcmd_loop(self, args):
+        '''Compare the runcmd event loop on different selectors.
+
+        Pipes --size bytes through cat and reports wakeups per second
+        and CPU time used by this process per MiB piped. The select
+        selector is what runcmd used to do; the default selector is
+        what it does now.
+
+        '''
+
+        size = self.settings['size']
+        data = b'x' * size
+        candidates = [
+            ('select', selectors.SelectSelector),
+            ('default (%s)' % selectors.DefaultSelector.__name__,
+             selectors.DefaultSelector),
+        ]
+
+        rows = []
+        saved = runcmd_module._selector_class
+        try:
+            for name, base in candidates:
+                selector_class = counting_selector(base)
+                runcmd_module._selector_class = selector_class
+
+                def run():
+                    out = cliapp.runcmd(['cat'], feed_stdin=data)
+                    assert len(out) == size
+
+                wall, cpu = self.measure(run)
+                wakeups = selector_class.wakeups / self.settings['rounds']
+                rows.append(
+                    '%-28s %10.0f wakeups/s %8.2f ms CPU/MiB %8.1f MiB/s' %
+                    (name, wakeups / wall, 1000.0 * cpu / (size / MiB),
+                     (size / MiB) / wall))
+        finally:
+            runcmd_module._selector_class = saved
+
+        self.report('runcmd event loop, %d MiB through cat' % (size / MiB),
+                    rows)
+
+    def cmd_runcmd_io_size(self, args):
+        '''Measure runcmd throughput with different I/O chunk sizes.
+
+        Pipes --size bytes through cat, once for each fixed chunk size,
+        and once with the default, adaptive chunk size.
+
+        '''
+
+        size = self.settings['size']
+        data = b'x' * size
+        rows = []
+        for io_size in [1024, 16 * 1024, 64 * 1024, MiB, None]:
+            def run():
+                out = cliapp.runcmd(['cat'], feed_stdin=data, io_size=io_size)
+                assert len(out) == size
+
+            wall, cpu = self.measure(run)
+            if io_size is None:
+                name = 'adaptive'
+            else:
+                name = '%d KiB' % (io_size / 1024)
+            rows.append('%-10s %8.1f MiB/s %8.2f ms CPU/MiB' %
+                        (name, (size / MiB) / wall,
+                         1000.0 * cpu / (size / MiB)))
+
+        self.report('runcmd throughput, %d MiB through cat' % (size / MiB),
+                    rows)
+
+    def cmd_runcmd_stdout_to(self, args):
+        '''Compare ways of getting command output into a file.
+
+        Pipes --size bytes through cat into a temporary file, first by
+        capturing the output and writing it out, then with stdout_to.
+
+        '''
+
+        size = self.settings['size']
+        data = b'x' * size
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+
+        def capture():
+            out = cliapp.runcmd(['cat'], feed_stdin=data)
+            with open(filename, 'wb') as f:
+                f.write(out)
+
+        def stdout_to():
+            cliapp.runcmd(['cat'], feed_stdin=data, stdout_to=filename)
+
+        rows = []
+        try:
+            for name, func in [('capture', capture),
+                               ('stdout_to', stdout_to)]:
+                wall, cpu = self.measure(func)
+                assert os.path.getsize(filename) == size
+                rows.append('%-10s %8.1f MiB/s %8.2f ms CPU/MiB' %
+                            (name, (size / MiB) / wall,
+                             1000.0 * cpu / (size / MiB)))
+        finally:
+            os.remove(filename)
+
+        self.report('runcmd output to file, %d MiB' % (size / MiB), rows)
+
+    def cmd_runcmd_many(self, args):
+        '''Compare running commands one by one and with runcmd_many.
+
+        Runs 500 short commands (sleep 0.01) first with runcmd in a
+        loop, then with runcmd_many using 16 workers.
+
+        '''
+
+        jobs = [['sleep', '0.01']] * 500
+
+        def one_by_one():
+            for argv in jobs:
+                cliapp.runcmd(argv)
+
+        def many():
+            for result in cliapp.runcmd_many(jobs, max_workers=16):
+                assert result[1] == 0
+
+        rows = []
+        for name, func in [('runcmd', one_by_one), ('runcmd_many', many)]:
+            wall, cpu = self.measure(func)
+            rows.append('%-12s %8.1f commands/s %8.2f ms CPU/command' %
+                        (name, len(jobs) / wall, 1000.0 * cpu / len(jobs)))
+
+        self.report('running %d commands' % len(jobs), rows)
+
+    def cmd_runcmd_reap(self, args):
+        '''Compare ways of finding out that child processes have exited.
+
+        Runs a pipeline of 100 cats, and 500 short commands with
+        runcmd_many, once with each way runcmd has of watching child
+        processes.
+
+        '''
+
+        methods = ['poll', 'sigchld']
+        if hasattr(os, 'pidfd_open'):
+            methods.append('pidfd')
+        jobs = [['true']] * 500
+
+        def wide():
+            cliapp.runcmd(*([['cat']] * 100), feed_stdin=b'x')
+
+        def many():
+            for result in cliapp.runcmd_many(jobs, max_workers=16):
+                assert result[1] == 0
+
+        rows = []
+        saved = runcmd_module._child_watch
+        try:
+            for method in methods:
+                runcmd_module._child_watch = method
+                wide_wall, wide_cpu = self.measure(wide)
+                many_wall, many_cpu = self.measure(many)
+                rows.append(
+                    '%-8s %8.1f ms/100 cats %8.1f commands/s '
+                    '%8.2f ms CPU/command' %
+                    (method, 1000.0 * wide_wall, len(jobs) / many_wall,
+                     1000.0 * many_cpu / len(jobs)))
+        finally:
+            runcmd_module._child_watch = saved
+
+        self.report('reaping child processes', rows)
+
+    def cmd_runcmd_spawn(self, args):
+        '''Compare the ways runcmd can start commands.
+
+        Runs true and echo 500 times each, first with subprocess.Popen,
+        then with os.posix_spawn, from a process that has allocated
+        and touched --heap bytes of memory.
+
+        '''
+
+        heap = bytearray(self.settings['heap'])
+        for i in range(0, len(heap), mmap.PAGESIZE):
+            heap[i] = 1
+
+        n = 500
+        rows = []
+        for launcher in ['popen', 'posix_spawn']:
+            for argv in [['true'], ['echo', 'foo']]:
+                def run():
+                    for _ in range(n):
+                        cliapp.runcmd(argv, launcher=launcher)
+
+                wall, cpu = self.measure(run)
+                rows.append('%-12s %-5s %8.1f commands/s' %
+                            (launcher, argv[0], n / wall))
+
+        self.report('starting commands, %d MiB heap' % (len(heap) / MiB),
+                    rows)
+
+    def cmd_process_input_lines(self, args):
+        '''Compare ways of processing input lines.
+
+        Writes --size bytes of 60-byte lines to a temporary file, and
+        counts them with Application.process_input: first the way it
+        used to, one process_input_line call per line read, then
+        via the default process_input_lines, which still calls
+        process_input_line for each line, and with a
+        process_input_lines that handles the whole batch. Then the
+        batch is read in binary mode, and the last two are repeated in
+        mmap mode. Use --size=1G for a realistic input.
+
+        '''
+
+        size = self.settings['size']
+        line = b'x' * 59 + b'\n'
+        n = size // len(line)
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            chunk = line * 10000
+            for _ in range(n // 10000):
+                f.write(chunk)
+            f.write(line * (n % 10000))
+
+        class PerLine(cliapp.Application):
+
+            count = 0
+
+            def process_input_line(self, name, line):
+                self.count += 1
+
+        class OldPerLine(PerLine):
+
+            def process_input(self, name):
+                f = self.open_input(name)
+                for line in f:
+                    self.global_lineno += 1
+                    self.lineno += 1
+                    self.process_input_line(name, line)
+                f.close()
+
+        class Batch(PerLine):
+
+            def process_input_lines(self, name, lines):
+                self.count += len(lines)
+
+        class BinaryBatch(Batch):
+
+            input_mode = 'binary'
+
+        class MmapPerLine(PerLine):
+
+            input_mode = 'mmap'
+
+        class MmapBatch(Batch):
+
+            input_mode = 'mmap'
+
+        rows = []
+        try:
+            for name, cls in [('process_input_line, old loop', OldPerLine),
+                              ('process_input_line', PerLine),
+                              ('process_input_lines', Batch),
+                              ('process_input_lines, binary', BinaryBatch),
+                              ('process_input_line, mmap', MmapPerLine),
+                              ('process_input_lines, mmap', MmapBatch)]:
+                def run():
+                    app = cls()
+                    app.process_input(filename)
+                    assert app.count == n
+
+                wall, cpu = self.measure(run)
+                rows.append('%-30s %12.0f lines/s' % (name, n / wall))
+        finally:
+            os.remove(filename)
+
+        self.report('processing %d lines (%d MiB)' % (n, size / MiB), rows)
+
+    def cmd_process_compressed_input(self, args):
+        '''Measure processing of compressed input.
+
+        Writes --size bytes of 60-byte lines, compressed with gzip, to
+        a temporary file, and counts the lines in batches with
+        Application.process_input, first decompressing in the same
+        thread, then with --decompress-in-background.
+
+        '''
+
+        size = self.settings['size']
+        line = b'x' * 59 + b'\n'
+        n = size // len(line)
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1) as f:
+                chunk = line * 10000
+                for _ in range(n // 10000):
+                    f.write(chunk)
+                f.write(line * (n % 10000))
+
+        class Batch(cliapp.Application):
+
+            input_mode = 'binary'
+            count = 0
+
+            def process_input_lines(self, name, lines):
+                # Something to do while the next batch is decompressed.
+                for line in lines:
+                    if line.startswith(b'y'):
+                        self.count -= 1
+                self.count += len(lines)
+
+        rows = []
+        try:
+            for background in [False, True]:
+                def run():
+                    app = Batch()
+                    app.settings['decompress-in-background'] = background
+                    app.process_input(filename)
+                    assert app.count == n
+
+                wall, cpu = self.measure(run)
+                name = 'background' if background else 'same thread'
+                rows.append('%-12s %12.0f lines/s %8.1f MiB/s' %
+                            (name, n / wall, (size / MiB) / wall))
+        finally:
+            os.remove(filename)
+
+        self.report('processing %d gzip-compressed lines (%d MiB)' %
+                    (n, size / MiB), rows)
+
+    def cmd_process_input_read_ahead(self, args):
+        '''Measure processing input from slow storage.
+
+        Writes --size bytes of 60-byte lines to a temporary file, and
+        counts the lines with Application.process_input, reading the
+        file through a wrapper that takes 10 ms per MiB, like a slow
+        network filesystem. First the file is read as lines are
+        processed, then read ahead in a background thread, as with
+        --read-ahead=4.
+
+        '''
+
+        size = self.settings['size']
+        line = b'x' * 59 + b'\n'
+        n = size // len(line)
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            chunk = line * 10000
+            for _ in range(n // 10000):
+                f.write(chunk)
+            f.write(line * (n % 10000))
+
+        class SlowFile(io.FileIO):
+
+            def readinto(self, buf):
+                time.sleep(0.01 * len(buf) / MiB)
+                return io.FileIO.readinto(self, buf)
+
+        class Batch(cliapp.Application):
+
+            input_mode = 'binary'
+            count = 0
+
+            def open_input(self, name, mode='r'):
+                # What Application.open_input does, but for SlowFile.
+                f = io.BufferedReader(SlowFile(name), MiB)
+                if self.settings['read-ahead'] > 0:
+                    f = cliapp.inputs.read_ahead(
+                        f, depth=self.settings['read-ahead'],
+                        block_size=self.settings['read-ahead-size'])
+                return f
+
+            def process_input_lines(self, name, lines):
+                for line in lines:
+                    if line.startswith(b'y'):
+                        self.count -= 1
+                self.count += len(lines)
+
+        rows = []
+        try:
+            for depth in [0, 4]:
+                def run():
+                    app = Batch()
+                    app.settings['read-ahead'] = depth
+                    app.process_input(filename)
+                    assert app.count == n
+
+                wall, cpu = self.measure(run)
+                name = 'read-ahead %d' % depth if depth else 'no read-ahead'
+                rows.append('%-14s %12.0f lines/s %8.1f MiB/s' %
+                            (name, n / wall, (size / MiB) / wall))
+        finally:
+            os.remove(filename)
+
+        self.report('processing %d lines (%d MiB) from slow storage' %
+                    (n, size / MiB), rows)
+
+    def cmd_output(self, args):
+        '''Compare ways of writing output.
+
+        Writes --size bytes of 60-byte lines, one write per line, to a
+        temporary file given as --output: with the default output
+        file, with a 1 MiB output buffer, and with the buffer written
+        in a background thread as well. Then the last two are repeated
+        with a file that takes 10 ms to write each MiB, like a slow
+        network filesystem.
+
+        '''
+
+        size = self.settings['size']
+        line = 'x' * 59 + '\n'
+        n = size // len(line)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+
+        class SlowFile(io.FileIO):
+
+            def write(self, buf):
+                time.sleep(0.01 * len(buf) / MiB)
+                return io.FileIO.write(self, buf)
+
+        class Writer(cliapp.Application):
+
+            def process_args(self, args):
+                write = self.output.write
+                for _ in range(n):
+                    write(line)
+
+        def run_app(settings):
+            Writer().run(args=['--no-default-configs',
+                               '--output=%s' % filename] + settings)
+
+        def write_slowly(background):
+            f = cliapp.outputs.open_output(
+                SlowFile(filename, 'w'), buffer_size=MiB,
+                background=background)
+            write = f.write
+            for _ in range(n):
+                write(line)
+            f.close()
+
+        rows = []
+        try:
+            for name, func in [
+                    ('default', lambda: run_app([])),
+                    ('1 MiB buffer',
+                     lambda: run_app(['--output-buffer-size=1M'])),
+                    ('background',
+                     lambda: run_app(['--output-buffer-size=1M',
+                                      '--output-in-background'])),
+                    ('slow, 1 MiB buffer', lambda: write_slowly(False)),
+                    ('slow, background', lambda: write_slowly(True))]:
+                wall, cpu = self.measure(func)
+                assert os.path.getsize(filename) == n * len(line)
+                rows.append('%-20s %12.0f lines/s %8.1f MiB/s' %
+                            (name, n / wall, (size / MiB) / wall))
+        finally:
+            os.remove(filename)
+
+        self.report('writing %d lines (%d MiB)' % (n, size / MiB), rows)
+
+    def cmd_checkpoint(self, args):
+        '''Measure the cost of --checkpoint.
+
+        Writes --size bytes of 60-byte lines to a temporary file, and
+        counts them in batches with Application.process_input in text
+        and binary mode: without --checkpoint, with it but the
+        default interval, so that only the bookkeeping costs, and
+        saving a checkpoint after every batch.
+
+        '''
+
+        size = self.settings['size']
+        line = b'x' * 59 + b'\n'
+        n = size // len(line)
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, 'input')
+        with open(filename, 'wb') as f:
+            chunk = line * 10000
+            for _ in range(n // 10000):
+                f.write(chunk)
+            f.write(line * (n % 10000))
+
+        class Batch(cliapp.Application):
+
+            count = 0
+
+            def process_input_lines(self, name, lines):
+                self.count += len(lines)
+
+        rows = []
+        try:
+            for input_mode in ['text', 'binary']:
+                for interval in [None, 300, 0]:
+                    def run():
+                        app = Batch()
+                        app.input_mode = input_mode
+                        if interval is not None:
+                            app.settings['checkpoint'] = os.path.join(
+                                tempdir, 'checkpoint')
+                            app.settings['checkpoint-interval'] = interval
+                        app.process_inputs([filename])
+                        assert app.count == n
+
+                    wall, cpu = self.measure(run)
+                    if interval is None:
+                        name = input_mode
+                    else:
+                        name = '%s, every %d s' % (input_mode, interval)
+                    rows.append('%-20s %12.0f lines/s' % (name, n / wall))
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.report('processing %d lines (%d MiB)' % (n, size / MiB), rows)
+
+    def cmd_parse_args(self, args):
+        '''Measure parsing the command line of an app with many settings.
+
+        Compares building an OptionParser twice and parsing the
+        command line with both, which is what Application.run used to
+        do, with scanning it for config options and then parsing it
+        once, with one parser, which is what it does now. The
+        settings are fresh each round, so the parser is always built.
+
+        '''
+
+        argv = ['--no-default-configs', '--config=foo.conf',
+                '--setting-0=foo', '--flag-0', 'arg']
+
+        def new_settings(n):
+            settings = cliapp.Settings('benchmark', '1.0')
+            for i in range(n):
+                settings.string(['setting-%d' % i], 'a string setting')
+                settings.integer(['number-%d' % i], 'an integer setting')
+                settings.boolean(['flag-%d' % i], 'a boolean setting')
+            return settings
+
+        rows = []
+        for n in [10, 100, 1000]:
+            def twice():
+                settings = new_settings(n)
+                for configs_only in [True, False]:
+                    p = settings.build_parser(configs_only=configs_only)
+                    p.parse_args(argv)
+
+            def once():
+                settings = new_settings(n)
+                settings.parse_args(argv, configs_only=True)
+                settings.parse_args(argv)
+
+            setup, _ = self.measure(lambda: new_settings(n))
+            for name, func in [('build twice', twice), ('scan, parse', once)]:
+                wall, _ = self.measure(func)
+                rows.append('%5d settings, %-12s %8.2f ms' %
+                            (3 * n, name, 1000.0 * (wall - setup)))
+        self.report('parsing the command line', rows)
+
+    def cmd_config_cache(self, args):
+        '''Measure loading config files, with and without a cache.
+
+        Writes a YAML and an INI config file, each setting 100
+        settings and having 1000 other sections of 20 values, and
+        loads them with Settings.load_configs: without config_cache,
+        with it when the cache does not exist yet, so that it gets
+        saved, and when it does.
+
+        '''
+
+        tempdir = tempfile.mkdtemp()
+        yaml_file = os.path.join(tempdir, 'benchmark.yaml')
+        ini_file = os.path.join(tempdir, 'benchmark.conf')
+        cache = os.path.join(tempdir, 'settings.cache')
+        with open(yaml_file, 'w') as f:
+            f.write('config:\n')
+            for i in range(100):
+                f.write('  setting-%d: value %d\n' % (i, i))
+            for i in range(1000):
+                f.write('section-%d:\n' % i)
+                for j in range(20):
+                    f.write('  key-%d: value %d\n' % (j, j))
+        with open(ini_file, 'w') as f:
+            f.write('[config]\n')
+            for i in range(100):
+                f.write('number-%d = %d\n' % (i, i))
+            for i in range(1000):
+                f.write('[other-%d]\n' % i)
+                for j in range(20):
+                    f.write('key-%d = value %d\n' % (j, j))
+
+        def load(use_cache):
+            settings = cliapp.Settings('benchmark', '1.0')
+            for i in range(100):
+                settings.string(['setting-%d' % i], 'a string setting')
+                settings.integer(['number-%d' % i], 'an integer setting')
+            settings.config_files = [yaml_file, ini_file]
+            if use_cache:
+                settings.config_cache = cache
+            settings.load_configs()
+            assert settings['number-99'] == 99
+
+        def cold():
+            if os.path.exists(cache):
+                os.remove(cache)
+            load(True)
+
+        rows = []
+        try:
+            for name, func in [('no cache', lambda: load(False)),
+                               ('saving cache', cold),
+                               ('using cache', lambda: load(True))]:
+                wall, _ = self.measure(func)
+                rows.append('%-20s %8.1f ms' % (name, 1000.0 * wall))
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.report('loading 2 config files of 21000 values', rows)
+
+    def cmd_yaml_config(self, args):
+        '''Measure loading a large YAML config file.
+
+        Writes a config file of 100 settings and 500 other sections
+        of 10 values each, like the configs of our bigger programs,
+        and loads it with Settings.load_configs, using the pure
+        Python YAML loader, and the libyaml one, if PyYAML has it.
+
+        '''
+
+        import yaml
+
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, 'benchmark.yaml')
+        with open(filename, 'w') as f:
+            f.write('config:\n')
+            for i in range(100):
+                f.write('  setting-%d: value %d\n' % (i, i))
+            for i in range(500):
+                f.write('section-%d:\n' % i)
+                for j in range(10):
+                    f.write('  key-%d: [value %d, %d, "%d"]\n' % (j, j, j, j))
+        with open(filename) as f:
+            lines = len(f.readlines())
+
+        def load():
+            settings = cliapp.Settings('benchmark', '1.0')
+            for i in range(100):
+                settings.string(['setting-%d' % i], 'a string setting')
+            settings.config_files = [filename]
+            settings.load_configs()
+            assert settings['setting-99'] == 'value 99'
+
+        loaders = [('SafeLoader', yaml.SafeLoader)]
+        if hasattr(yaml, 'CSafeLoader'):
+            loaders.append(('CSafeLoader (libyaml)', yaml.CSafeLoader))
+
+        rows = []
+        saved = settings_module._yaml_loader
+        try:
+            for name, loader in loaders:
+                settings_module._yaml_loader = lambda: loader
+                wall, _ = self.measure(load)
+                rows.append('%-24s %8.1f ms' % (name, 1000.0 * wall))
+        finally:
+            settings_module._yaml_loader = saved
+            shutil.rmtree(tempdir)
+        if len(loaders) == 1:
+            rows.append('(PyYAML has been built without libyaml)')
+
+        self.report('loading a YAML config of %d lines' % lines, rows)
+
+    def cmd_import_time(self, args):
+        '''Measure the time to start a program that uses cliapp.
+
+        Runs "python -X importtime -c 'import cliapp'" in a child
+        process --rounds times, and reports the best time the import
+        took, and the modules that took longest to import in that
+        round. Fails if the import takes longer than --import-budget,
+        so that this can catch a change that makes every program
+        using cliapp start slower. Also reports the wall clock time
+        of starting Python, of importing cliapp, and of getting
+        cliapp.Application, which imports most of the rest.
+
+        '''
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(cliapp.__file__)))
+
+        def python(code, *options):
+            argv = [sys.executable] + list(options) + ['-c', code]
+            p = subprocess.Popen(argv, env=env, stderr=subprocess.PIPE)
+            _, err = p.communicate()
+            if p.returncode != 0:
+                raise cliapp.AppException(err.decode(errors='replace'))
+            return err.decode()
+
+        # The first run may compile the modules to bytecode; that is
+        # not what a program normally pays.
+        python('import cliapp; cliapp.Application')
+
+        def import_times():
+            # Return the microseconds importing cliapp took, and the
+            # (own time, name) of each module it imported. Each line
+            # of output is for one module, after the modules it
+            # imported, which are indented more.
+            modules = []
+            err = python('import cliapp', '-X', 'importtime')
+            for line in err.splitlines():
+                fields = line.split('|')
+                if len(fields) != 3 or not fields[1].strip().isdigit():
+                    continue
+                own = int(fields[0].split(':')[1])
+                name = fields[2].strip()
+                modules.append((own, name))
+                if not fields[2].startswith('  '):
+                    if name == 'cliapp':
+                        return int(fields[1]), modules
+                    modules = []
+            raise cliapp.AppException('no import time for cliapp')
+
+        best = None
+        for _ in range(self.settings['rounds']):
+            total, modules = import_times()
+            if best is None or total < best[0]:
+                best = (total, sorted(modules, reverse=True))
+
+        total, modules = best
+        rows = ['%-28s %8.1f ms' % ('total', total / 1000.0)]
+        for own, name in modules[:10]:
+            rows.append('%-28s %8.1f ms' % (name, own / 1000.0))
+        self.report('import cliapp (-X importtime)', rows)
+
+        rows = []
+        for name, code in [('python', 'pass'),
+                           ('import cliapp', 'import cliapp'),
+                           ('cliapp.Application',
+                            'import cliapp; cliapp.Application')]:
+            wall, _ = self.measure(lambda: python(code))
+            rows.append('%-28s %8.1f ms' % (name, 1000.0 * wall))
+        self.report('starting python (wall clock)', rows)
+
+        budget = self.settings['import-budget']
+        if total > budget * 1000:
+            raise cliapp.AppException(
+                'import cliapp took %.1f ms, budget is %d ms' %
+                (total / 1000.0, budget))
+
+
+if __name__ == '__main__':
+    Benchmark().run()
@@ -27,22 +27,69 @@ Homepage: http://liw.fi/cliapp/
 '''
 
 
+import importlib
+import sys
+
 from .version import __version__, __version_info__
 
+# The runcmd functions are imported right away, since the function
+# cliapp.runcmd has the same name as the module cliapp.runcmd:
+# importing the module later would replace the function.
+from .runcmd import (runcmd, runcmd_unchecked, runcmd_iter, runcmd_many,
+                     shell_quote, ssh_runcmd, ssh_runcmd_unchecked,
+                     ssh_runcmd_many, ProcessStats, PipelineStats,
+                     CommandTotals, StatsCounter, SshSession, SshSessionPool)
+
+
+# Everything else is imported from its module when first used, so
+# that programs don't pay for importing modules, such as yaml, that
+# they don't need. The values are the names of the modules.
+_lazy = {
+    'MemoryProfileDumper': 'util',
+    'TextFormat': 'fmt',
+    'Application': 'app',
+    'AppException': 'app',
+    'Settings': 'settings',
+    'log_group_name': 'settings',
+    'config_group_name': 'settings',
+    'perf_group_name': 'settings',
+    'UnknownConfigVariable': 'settings',
+    'MalformedYamlConfig': 'settings',
+
+    # The plugin system
+    'Hook': 'hook',
+    'FilterHook': 'hook',
+    'HookManager': 'hookmgr',
+    'Plugin': 'plugin',
+    'PluginManager': 'pluginmgr',
+}
+
+
+def __getattr__(name):
+    module_name = _lazy.get(name)
+    if module_name is None:
+        raise AttributeError(
+            'module %r has no attribute %r' % (__name__, name))
+    module = importlib.import_module('.' + module_name, __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
 
-from .util import MemoryProfileDumper
-from .fmt import TextFormat
-from .app import Application, AppException
-from .settings import (Settings, log_group_name, config_group_name,
-                       perf_group_name, UnknownConfigVariable,
-                       MalformedYamlConfig)
-from .runcmd import runcmd, runcmd_unchecked, shell_quote, ssh_runcmd
 
-# The plugin system
-from .hook import Hook, FilterHook
-from .hookmgr import HookManager
-from .plugin import Plugin
-from .pluginmgr import PluginManager
+__all__ = [
+    '__version__', '__version_info__',
+    'runcmd', 'runcmd_unchecked', 'runcmd_iter', 'runcmd_many',
+    'shell_quote', 'ssh_runcmd', 'ssh_runcmd_unchecked', 'ssh_runcmd_many',
+    'ProcessStats', 'PipelineStats', 'CommandTotals', 'StatsCounter',
+    'SshSession', 'SshSessionPool',
+] + sorted(_lazy)
 
 
-__all__ = locals()
+if sys.version_info < (3, 7):  # pragma: no cover
+    # Module __getattr__ needs Python 3.7 (PEP 562): import everything.
+    for _name in _lazy:
+        __getattr__(_name)
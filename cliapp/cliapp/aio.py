@@ -0,0 +1,272 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Run external commands from asyncio code.
+
+This module has coroutine versions of ``cliapp.runcmd`` and
+``cliapp.runcmd_unchecked``. They take the same arguments and return
+the same values, but many commands can run concurrently in one
+thread::
+
+    out = await cliapp.aio.runcmd(['grep', 'foo'], ['wc', '-l'],
+                                  feed_stdin=b'foo\nbar\n')
+
+Subcommands of a ``cliapp.Application`` may be coroutine functions
+(``async def cmd_foo(self, args)``): the application runs them in an
+event loop.
+
+This module requires Python 3.7 or later. It is not imported by
+``import cliapp``; use ``import cliapp.aio``.
+
+'''
+
+
+import asyncio
+import logging
+import os
+import subprocess
+
+import cliapp
+from cliapp.runcmd import (
+    _OutputBuffer, _capture_options, _check_exit_code, _check_options,
+    _pipeline_options, _pop_options)
+
+
+# Amount of data to read from a pipe at a time, unless the caller
+# sets io_size.
+_default_io_size = 64 * 1024
+
+
+async def runcmd(argv, *argvs, **kwargs):
+    '''Run external command or pipeline.
+
+    Like ``cliapp.runcmd``, but a coroutine.
+
+    '''
+
+    opts = _pop_options(kwargs, _check_options)
+    exit_code, out, err = await runcmd_unchecked(argv, *argvs, **kwargs)
+    _check_exit_code(argv, exit_code, out, err, opts)
+    return out
+
+
+async def runcmd_unchecked(argv, *argvs, **kwargs):
+    '''Run external command or pipeline.
+
+    Like ``cliapp.runcmd_unchecked``, but a coroutine. The
+    ``stdout_to``, ``stats``, and ``launcher`` arguments are not
+    supported.
+
+    If there is no output for ``output_timeout`` seconds, and
+    ``timeout_callback`` is not given or returns a true value, the
+    pipeline is terminated.
+
+    '''
+
+    argvs = [argv] + list(argvs)
+    logging.debug('run external command: %r', argvs)
+    capture = _pop_options(kwargs, _capture_options)
+    opts = _pop_options(kwargs, _pipeline_options)
+    if opts['stdout_to'] is not None:
+        raise cliapp.AppException(
+            'cliapp.aio.runcmd does not support stdout_to')
+    if capture['stats']:
+        raise cliapp.AppException(
+            'cliapp.aio.runcmd does not support stats')
+    if opts['launcher'] != 'popen':
+        raise cliapp.AppException(
+            'cliapp.aio.runcmd does not support launcher')
+
+    procs, stderr, transport = await _start_pipeline(argvs, opts, kwargs)
+    try:
+        return await _run_pipeline(procs, stderr, capture, opts)
+    finally:
+        # If we were cancelled, or a callback failed, the processes
+        # may still be running: don't leave them behind.
+        if transport is not None:
+            transport.close()
+        await _terminate(procs)
+
+
+async def _run_pipeline(procs, stderr, capture, opts):
+    '''Feed and read the pipeline, and wait for it to finish.'''
+
+    out = _OutputBuffer(capture['max_memory'], capture['spill_dir'])
+    err = _OutputBuffer(capture['max_memory'], capture['spill_dir'])
+    loop = asyncio.get_running_loop()
+    io_size = opts['io_size'] or _default_io_size
+    latest_output = [loop.time()]
+
+    async def read(stream, callback, output):
+        while True:
+            data = await stream.read(io_size)
+            if not data:
+                break
+            latest_output[0] = loop.time()
+            data_new = callback(data)
+            if data_new is None:
+                data_new = data
+            output.append(data_new)
+
+    async def feed(stream, data):
+        for pos in range(0, len(data), io_size):
+            stream.write(data[pos:pos + io_size])
+            try:
+                await stream.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The first process does not want any more input.
+                break
+        stream.close()
+
+    tasks = []
+    try:
+        if procs[0].stdin is not None:
+            if opts['feed_stdin']:
+                tasks.append(asyncio.ensure_future(
+                    feed(procs[0].stdin, opts['feed_stdin'])))
+            else:
+                procs[0].stdin.close()
+        if procs[-1].stdout is not None:
+            tasks.append(asyncio.ensure_future(
+                read(procs[-1].stdout, opts['stdout_callback'], out)))
+        if stderr is not None:
+            tasks.append(asyncio.ensure_future(
+                read(stderr, opts['stderr_callback'], err)))
+
+        await _wait_for_output(procs, tasks, opts, latest_output)
+    finally:
+        # Only does anything if we are leaving early.
+        for task in tasks:
+            task.cancel()
+
+    for p in procs:
+        await p.wait()
+    errorcodes = [p.returncode for p in procs if p.returncode != 0] or [0]
+    return errorcodes[-1], out.getvalue(), err.getvalue()
+
+
+async def _terminate(procs):
+    '''Terminate the processes that are still running, and reap them.'''
+
+    for p in procs:
+        if p.returncode is None:
+            try:
+                p.terminate()
+            except ProcessLookupError:  # pragma: no cover
+                pass
+    for p in procs:
+        await p.wait()
+
+
+async def _start_pipeline(argvs, opts, kwargs):
+    '''Start the processes in a pipeline.
+
+    Return the list of processes, a stream for reading the standard
+    error output they share, and the transport behind that stream.
+    The stream and transport are None if stderr is not captured.
+
+    '''
+
+    loop = asyncio.get_running_loop()
+    procs = []
+
+    stderr = opts['stderr']
+    if stderr == subprocess.PIPE:
+        # Make pipe for all subprocesses to share
+        rpipe, wpipe = os.pipe()
+        stderr = wpipe
+
+    try:
+        stdin = opts['stdin']
+        for i, argv in enumerate(argvs):
+            if i == len(argvs) - 1:
+                stdout = opts['stdout']
+                next_stdin = None
+            else:
+                next_stdin, stdout = os.pipe()
+            try:
+                p = await asyncio.create_subprocess_exec(
+                    *argv, stdin=stdin, stdout=stdout, stderr=stderr,
+                    **kwargs)
+            except BaseException:
+                if next_stdin is not None:
+                    os.close(next_stdin)
+                raise
+            finally:
+                # Only the child processes must hold the pipes
+                # between them, so that they get EOF and SIGPIPE
+                # correctly.
+                if i != 0:
+                    os.close(stdin)
+                if next_stdin is not None:
+                    os.close(stdout)
+            procs.append(p)
+            stdin = next_stdin
+    except BaseException:
+        # A later command could not be started: don't leave the
+        # earlier ones running.
+        if opts['stderr'] == subprocess.PIPE:
+            os.close(rpipe)
+        await _terminate(procs)
+        raise
+    finally:
+        if opts['stderr'] == subprocess.PIPE:
+            os.close(wpipe)
+
+    if opts['stderr'] != subprocess.PIPE:
+        return procs, None, None
+
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.connect_read_pipe(
+        lambda: protocol, os.fdopen(rpipe, 'rb'))
+    return procs, reader, transport
+
+
+async def _wait_for_output(procs, tasks, opts, latest_output):
+    '''Wait for tasks to finish, while obeying output_timeout.'''
+
+    loop = asyncio.get_running_loop()
+    output_timeout = opts['output_timeout']
+    timeout_callback = opts['timeout_callback']
+
+    pending = tasks
+    while pending:
+        if output_timeout is None:
+            timeout = None
+        else:
+            since = loop.time() - latest_output[0]
+            timeout = max(0, output_timeout - since)
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        if not pending:
+            break
+
+        if loop.time() - latest_output[0] >= output_timeout:
+            if timeout_callback is None or timeout_callback():
+                for p in procs:
+                    if p.returncode is None:
+                        p.terminate()
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+                break
+            latest_output[0] = loop.time()
+
+    # Propagate exceptions from the tasks, such as from callbacks.
+    for task in tasks:
+        if not task.cancelled():
+            task.result()
@@ -0,0 +1,213 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import asyncio
+import mmap
+import os
+import tempfile
+import time
+import unittest
+
+import cliapp
+import cliapp.aio
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class AioRuncmdTests(unittest.TestCase):
+
+    def test_runcmd_returns_stdout_of_command(self):
+        self.assertEqual(run(cliapp.aio.runcmd(['echo', 'hello', 'world'])),
+                         b'hello world\n')
+
+    def test_runcmd_raises_error_on_failure(self):
+        self.assertRaises(cliapp.AppException, run,
+                          cliapp.aio.runcmd(['false'], log_error=False))
+
+    def test_runcmd_ignores_failures_on_request(self):
+        self.assertEqual(run(cliapp.aio.runcmd(['false'], ignore_fail=True)),
+                         b'')
+
+    def test_runcmd_obeys_cwd(self):
+        self.assertEqual(run(cliapp.aio.runcmd(['pwd'], cwd='/')), b'/\n')
+
+    def test_runcmd_unchecked_returns_values_on_failure(self):
+        exit_code, out, err = run(
+            cliapp.aio.runcmd_unchecked(['ls', 'notexist']))
+        self.assertNotEqual(exit_code, 0)
+        self.assertEqual(out, b'')
+        self.assertNotEqual(err, b'')
+
+    def test_runcmd_pipes_lots_of_data_through_pipeline(self):
+        data = b'x' * (4 * 1024 ** 2)
+        self.assertEqual(
+            run(cliapp.aio.runcmd(['cat'], ['cat'], ['cat'],
+                                  feed_stdin=data)),
+            data)
+
+    def test_runcmd_collects_stderr_of_every_command(self):
+        exit_code, out, err = run(cliapp.aio.runcmd_unchecked(
+            ['sh', '-c', 'echo foo; echo one 1>&2'],
+            ['sh', '-c', 'cat; sleep 0.1; echo two 1>&2']))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(out, b'foo\n')
+        self.assertEqual(err, b'one\ntwo\n')
+
+    def test_runcmd_returns_last_failing_exit_code(self):
+        self.assertEqual(
+            run(cliapp.aio.runcmd_unchecked(['sh', '-c', 'exit 2'], ['cat'])),
+            (2, b'', b''))
+
+    def test_runcmd_stops_feeding_stdin_when_command_exits(self):
+        data = b'x' * (10 * 1024 ** 2)
+        self.assertEqual(
+            run(cliapp.aio.runcmd_unchecked(['true'], feed_stdin=data)),
+            (0, b'', b''))
+
+    def test_runcmd_calls_callbacks(self):
+        msgs = []
+
+        def callback(data):
+            msgs.append(data)
+            return b'x'
+
+        exit_code, out, err = run(cliapp.aio.runcmd_unchecked(
+            ['sh', '-c', 'echo foo; echo bar 1>&2'],
+            stdout_callback=callback, stderr_callback=callback))
+        self.assertEqual((out, err), (b'x', b'x'))
+        self.assertEqual(sorted(msgs), [b'bar\n', b'foo\n'])
+
+    def test_runcmd_redirects_stdout_to_file(self):
+        fd, filename = tempfile.mkstemp()
+        exit_code, out, _ = run(
+            cliapp.aio.runcmd_unchecked(['echo', 'foo'], stdout=fd))
+        os.close(fd)
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'foo\n')
+        os.remove(filename)
+        self.assertEqual((exit_code, out), (0, b''))
+
+    def test_runcmd_terminates_pipeline_on_output_timeout(self):
+        started = time.time()
+        exit_code, _, _ = run(cliapp.aio.runcmd_unchecked(
+            ['sleep', '10'], output_timeout=0.1))
+        self.assertTrue(time.time() - started < 5)
+        self.assertNotEqual(exit_code, 0)
+
+    def test_runcmd_continues_if_timeout_callback_says_so(self):
+        calls = []
+
+        def callback():
+            calls.append(True)
+            return False
+
+        self.assertEqual(
+            run(cliapp.aio.runcmd(['sh', '-c', 'sleep 0.5; echo foo'],
+                                  output_timeout=0.1,
+                                  timeout_callback=callback)),
+            b'foo\n')
+        self.assertTrue(calls)
+
+    def _sleeper(self):
+        fd, pidfile = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, pidfile)
+        argv = ['sh', '-c', 'echo $$ > "$0"; echo foo; exec sleep 9.31',
+                pidfile]
+        return argv, pidfile
+
+    def assertNotRunning(self, pidfile):
+        with open(pidfile) as f:
+            pid = f.read()
+        if pid:
+            # Otherwise, it was stopped before it got this far.
+            self.assertRaises(ProcessLookupError, os.kill, int(pid), 0)
+
+    def test_runcmd_terminates_pipeline_when_cancelled(self):
+        argv, pidfile = self._sleeper()
+        self.assertRaises(
+            asyncio.TimeoutError, run,
+            asyncio.wait_for(cliapp.aio.runcmd(argv, ['cat']), 0.3))
+        self.assertNotRunning(pidfile)
+
+    def test_runcmd_terminates_pipeline_when_callback_fails(self):
+        argv, pidfile = self._sleeper()
+
+        def callback(data):
+            raise RuntimeError('callback failed')
+
+        self.assertRaises(
+            RuntimeError, run,
+            cliapp.aio.runcmd(argv, stdout_callback=callback))
+        self.assertNotRunning(pidfile)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc')
+    def test_runcmd_cleans_up_when_later_command_cannot_start(self):
+        argv, pidfile = self._sleeper()
+        fds = len(os.listdir('/proc/self/fd'))
+        self.assertRaises(
+            OSError, run,
+            cliapp.aio.runcmd(argv, ['cat'], ['/does/not/exist']))
+        self.assertNotRunning(pidfile)
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_runcmd_spills_large_output_to_disk(self):
+        data = b'x' * (1024 ** 2)
+        out = run(cliapp.aio.runcmd(['cat'], feed_stdin=data,
+                                    max_memory=1024))
+        self.assertTrue(isinstance(out, mmap.mmap))
+        self.assertEqual(out[:], data)
+
+    def test_runcmd_refuses_stats(self):
+        self.assertRaises(
+            cliapp.AppException, run,
+            cliapp.aio.runcmd(['true'], stats=True))
+
+    def test_runcmd_refuses_launcher(self):
+        self.assertRaises(
+            cliapp.AppException, run,
+            cliapp.aio.runcmd(['true'], launcher='posix_spawn'))
+
+    def test_runcmd_refuses_stdout_to(self):
+        self.assertRaises(
+            cliapp.AppException, run,
+            cliapp.aio.runcmd(['true'], stdout_to='/dev/null'))
+
+    def test_runcmd_runs_commands_concurrently(self):
+        async def main():
+            return await asyncio.gather(
+                *[cliapp.aio.runcmd(['sleep', '0.5']) for _ in range(10)])
+
+        started = time.time()
+        run(main())
+        self.assertTrue(time.time() - started < 5)
+
+
+class AioSubcommandTests(unittest.TestCase):
+
+    def test_runs_coroutine_subcommand(self):
+
+        class App(cliapp.Application):
+
+            async def cmd_foo(self, args):
+                self.out = await cliapp.aio.runcmd(['echo'] + args)
+
+        app = App()
+        app.run(['foo', 'bar'])
+        self.assertEqual(app.out, b'bar\n')
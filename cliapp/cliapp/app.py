@@ -17,20 +17,22 @@
 from __future__ import unicode_literals
 
 import errno
-import inspect
+import io
 import logging
-import logging.handlers
+import mmap
 import os
 try:
     from StringIO import StringIO
 except ImportError:            # pragma: no cover
     from io import StringIO
 import sys
-import traceback
-import platform
-import textwrap
+import stat
+import time
+import types
 
 import cliapp
+import cliapp.inputs
+import cliapp.outputs
 
 
 class AppException(Exception):
@@ -44,28 +46,59 @@ class AppException(Exception):
     '''
 
     def __init__(self, msg):
-        Exception.__init__(self)
+        Exception.__init__(self, msg)
         self.msg = msg
 
     def __str__(self):
         return self.msg
 
 
-class LogHandler(logging.handlers.RotatingFileHandler):  # pragma: no cover
+# logging.handlers, multiprocessing, pickle, and traceback are slow to
+# import, compared to the startup time of a typical program, so they
+# are imported only by the code that needs them. LogHandler, which
+# subclasses a class in logging.handlers, is created on first use.
 
-    '''Like RotatingFileHandler, but set permissions of new files.'''
+_log_handler_class = None
 
-    def __init__(self, filename, perms=0o600, *args, **kwargs):
-        self._perms = perms
-        logging.handlers.RotatingFileHandler.__init__(self, filename,
-                                                      *args, **kwargs)
 
-    def _open(self):
-        if not os.path.exists(self.baseFilename):
-            flags = os.O_CREAT | os.O_WRONLY
-            fd = os.open(self.baseFilename, flags, self._perms)
-            os.close(fd)
-        return logging.handlers.RotatingFileHandler._open(self)
+def _get_log_handler_class():  # pragma: no cover
+    global _log_handler_class
+    if _log_handler_class is not None:
+        return _log_handler_class
+
+    import logging.handlers
+
+    class LogHandler(logging.handlers.RotatingFileHandler):
+
+        '''Like RotatingFileHandler, but set permissions of new files.'''
+
+        def __init__(self, filename, perms=0o600, *args, **kwargs):
+            self._perms = perms
+            logging.handlers.RotatingFileHandler.__init__(self, filename,
+                                                          *args, **kwargs)
+
+        def _open(self):
+            if not os.path.exists(self.baseFilename):
+                flags = os.O_CREAT | os.O_WRONLY
+                fd = os.open(self.baseFilename, flags, self._perms)
+                os.close(fd)
+            return logging.handlers.RotatingFileHandler._open(self)
+
+    _log_handler_class = LogHandler
+    return LogHandler
+
+
+def __getattr__(name):  # pragma: no cover
+    # Module attributes that are created lazily (Python 3.7 or later).
+    if name == 'LogHandler':
+        return _get_log_handler_class()
+    raise AttributeError(
+        'module %r has no attribute %r' % (__name__, name))
+
+
+def _format_exc():
+    import traceback
+    return traceback.format_exc()
 
 
 class Application(object):
@@ -92,11 +125,42 @@ class Application(object):
 
     '''
 
+    # How many bytes' worth of lines process_input reads from a file
+    # at a time, and gives to process_input_lines.
+    input_batch_size = 256 * 1024
+
+    # How process_input reads input files: 'text' for lines as
+    # strings, 'binary' for lines as bytes, or 'mmap' for lines as
+    # memoryview slices of the memory-mapped file, for regular files,
+    # and as bytes otherwise.
+    input_mode = 'text'
+
+    # Should open_input decompress compressed input files? Set this
+    # to False in applications that want to read them as they are.
+    decompress_inputs = True
+
+    # Is self.output a 'text' or a 'binary' file?
+    output_mode = 'text'
+
+    # Should the values read from config files be cached, in
+    # settings.default_config_cache, so that later runs need not
+    # parse the files again, until they change?
+    cache_configs = False
+
     def __init__(self, progname=None, version='0.0.0', description=None,
                  epilog=None):
         self.fileno = 0
         self.global_lineno = 0
         self.lineno = 0
+        self.output = sys.stdout
+        # The file _run opened for self.output, if it is not stdout,
+        # and the AtomicFile under it with --atomic-output.
+        self._own_output = None
+        self._atomic_output = None
+        # With --checkpoint: when the last checkpoint was saved, and
+        # the (offset, lineno) where process_input should resume.
+        self._checkpoint_saved = None
+        self._resume_at = None
         self._description = description
         if not hasattr(self, 'arg_synopsis'):
             self.arg_synopsis = '[FILE]...'
@@ -119,6 +183,14 @@ class Application(object):
 
         self.memory_profile_dumper = cliapp.MemoryProfileDumper(self.settings)
 
+        # Resource usage of external commands run via self.runcmd and
+        # self.runcmd_unchecked.
+        self.runcmd_stats = cliapp.StatsCounter()
+
+        # Connections used by self.ssh_runcmd, closed at the end of
+        # the run.
+        self.ssh_sessions = cliapp.SshSessionPool()
+
         # For process duration.
         self._started = os.times()[-1]
 
@@ -158,7 +230,7 @@ class Application(object):
 
     def _set_process_name(self):  # pragma: no cover
         comm = '/proc/self/comm'
-        if platform.system() == 'Linux' and os.path.exists(comm):
+        if sys.platform.startswith('linux') and os.path.exists(comm):
             with open('/proc/self/comm', 'wb', 0) as f:
                 f.write(self.settings.progname[:15].encode())
 
@@ -169,30 +241,32 @@ class Application(object):
             self.setup_plugin_manager()
 
             # A little bit of trickery here to make --no-default-configs and
-            # --config=foo work right: we first parse the command line once,
-            # and pick up any config files. Then we read configs. Finally,
-            # we re-parse the command line to allow any options to override
-            # config file settings.
+            # --config=foo work right: we first scan the command line for
+            # just those, to pick up any config files. Then we read
+            # configs. Finally, we parse the command line to allow any
+            # options to override config file settings.
             self.setup()
             self.enable_plugins()
             if self.subcommands:
                 self.add_default_subcommands()
             args = sys.argv[1:] if args is None else args
             self.parse_args(args, configs_only=True)
+            if self.cache_configs:
+                self.settings.config_cache = (
+                    self.settings.default_config_cache)
             self.settings.load_configs()
             args = self.parse_args(args)
 
             self.setup_logging()
             self.log_config()
 
-            if self.settings['output']:
-                self.output = open(self.settings['output'], 'w')
-            else:
-                self.output = sys.stdout
+            self.output = self._open_output()
 
             self.process_args(args)
             self.cleanup()
             self.disable_plugins()
+            self.log_runcmd_stats()
+            self._close_output()
         except cliapp.UnknownConfigVariable as e:  # pragma: no cover
             stderr.write('ERROR: %s\n' % str(e))
             sys.exit(1)
@@ -200,7 +274,7 @@ class Application(object):
             stderr.write('ERROR: %s\n' % str(e))
             sys.exit(1)
         except AppException as e:
-            log(traceback.format_exc())
+            log(_format_exc())
             stderr.write('ERROR: %s\n' % str(e))
             sys.exit(1)
         except SystemExit as e:
@@ -215,27 +289,95 @@ class Application(object):
                 # We're writing to stdout, and it broke. This almost always
                 # happens when we're being piped to less, and the user quits
                 # less before we finish writing everything out. So we ignore
-                # the error in that case.
+                # the error in that case. Python flushes stdout again at
+                # exit, so point it at /dev/null to not fail again.
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+                os.close(devnull)
                 sys.exit(1)
-            log(traceback.format_exc())
+            log(_format_exc())
             stderr.write('ERROR: %s\n' % str(e))
             sys.exit(1)
         except OSError as e:  # pragma: no cover
-            log(traceback.format_exc())
+            log(_format_exc())
             if hasattr(e, 'filename') and e.filename:
                 stderr.write('ERROR: %s: %s\n' % (e.filename, e.strerror))
             else:
                 stderr.write('ERROR: %s\n' % e.strerror)
             sys.exit(1)
         except BaseException as e:  # pragma: no cover
-            log(traceback.format_exc())
-            stderr.write(traceback.format_exc())
+            log(_format_exc())
+            stderr.write(_format_exc())
             sys.exit(1)
+        finally:
+            self.ssh_sessions.close()
+            self._abandon_output()
 
         logging.info(
             '%s version %s ends normally',
             self.settings.progname, self.settings.version)
 
+    def _open_output(self):
+        # Open the file to use as self.output, as the settings say.
+        # Without any of the output settings in the Performance group,
+        # this is a plain file.
+
+        name = self.settings['output']
+        binary = self.output_mode == 'binary'
+        buffer_size = self.settings['output-buffer-size']
+        background = self.settings['output-in-background']
+        atomic = self.settings['atomic-output'] and name
+
+        if not (buffer_size or background or atomic):
+            if not name:
+                if binary:
+                    return getattr(sys.stdout, 'buffer', sys.stdout)
+                return sys.stdout
+            self._own_output = open(name, 'wb' if binary else 'w')
+            return self._own_output
+
+        if atomic:
+            raw = self._atomic_output = cliapp.outputs.AtomicFile(name)
+        elif name:
+            raw = io.FileIO(name, 'w')
+        else:
+            sys.stdout.flush()
+            raw = io.FileIO(sys.stdout.fileno(), 'w', closefd=False)
+        self._own_output = cliapp.outputs.open_output(
+            raw, binary=binary,
+            buffer_size=buffer_size or io.DEFAULT_BUFFER_SIZE,
+            background=background,
+            encoding=None if name else sys.stdout.encoding,
+            errors=None if name else sys.stdout.errors)
+        return self._own_output
+
+    def _close_output(self):
+        # Write out everything in the output, and with --atomic-output,
+        # make it appear as the --output file.
+
+        output, self._own_output = self._own_output, None
+        if output is None:
+            sys.stdout.flush()
+        else:
+            output.close()
+        if self._atomic_output is not None:
+            self._atomic_output.commit()
+            self._atomic_output = None
+
+    def _abandon_output(self):
+        # After an error, close the output while any background writer
+        # thread still runs. A partial --atomic-output file must not
+        # appear.
+        output, self._own_output = self._own_output, None
+        if output is not None:
+            try:
+                output.close()
+            except Exception:
+                pass
+        if self._atomic_output is not None:
+            self._atomic_output.discard()
+            self._atomic_output = None
+
     def compute_setting_values(self, settings):
         '''Compute setting values after configs and options are parsed.
 
@@ -333,7 +475,8 @@ class Application(object):
     def _subcommand_methodnames(self):
         return [x
                 for x in dir(self)
-                if x.startswith('cmd_') and inspect.ismethod(getattr(self, x))]
+                if x.startswith('cmd_') and
+                isinstance(getattr(self, x), types.MethodType)]
 
     def _normalize_cmd(self, cmd):
         return 'cmd_%s' % cmd.replace('-', '_')
@@ -390,6 +533,7 @@ class Application(object):
         if len(t) == 1:
             return doc
         else:
+            import textwrap
             first, rest = t
             return first + '\n' + textwrap.dedent(rest)
 
@@ -425,6 +569,7 @@ class Application(object):
     def setup_logging_handler_for_syslog(self):  # pragma: no cover
         '''Setup a logging.Handler for logging to syslog.'''
 
+        import logging.handlers
         handler = logging.handlers.SysLogHandler(address='/dev/log')
         formatter = self.setup_logging_formatter_for_syslog()
         handler.setFormatter(formatter)
@@ -454,7 +599,7 @@ class Application(object):
     def setup_logging_handler_for_file(self):  # pragma: no cover
         '''Setup a logging handler for logging to a named file.'''
 
-        handler = LogHandler(
+        handler = _get_log_handler_class()(
             self.settings['log'],
             perms=int(self.settings['log-mode'], 8),
             maxBytes=self.settings['log-max'],
@@ -572,7 +717,8 @@ class Application(object):
 
         The default is to call process_inputs with the argument list,
         or to invoke the requested subcommand, if subcommands have
-        been defined.
+        been defined. A subcommand may be a coroutine function, in
+        which case it is run in a new asyncio event loop.
 
         '''
 
@@ -590,7 +736,12 @@ class Application(object):
                     raise SystemExit('unknown subcommand %s' % args[0])
 
             method = self.subcommands[cmd]
-            method(args[1:])
+            result = method(args[1:])
+            if hasattr(result, '__await__'):
+                # The subcommand is a coroutine function, for example
+                # one that uses cliapp.aio.runcmd.
+                import asyncio
+                asyncio.run(result)
         else:
             self.process_inputs(args)
 
@@ -607,10 +758,255 @@ class Application(object):
         and count files and lines. The global line number is the
         line number as if all input files were one.
 
+        With ``--jobs`` greater than one, the inputs are processed by
+        that many processes in parallel instead. Each file, or each
+        part of a file larger than ``--input-part-size``, is processed
+        by calling ``process_input`` (or ``process_input_line`` for
+        each line of a part) in a process forked from this one, so it
+        starts with the state the application has now. Afterwards,
+        ``collect_input_result`` is called in that process. When all
+        files have been processed, the return values are given to
+        ``merge_input_result`` in this process, in input order, and
+        ``fileno`` and ``global_lineno`` are updated to count all files
+        and lines processed. In the worker processes, ``fileno`` is right, but
+        ``global_lineno`` counts only the lines of the file or part
+        being processed, and for a part of a file, so does
+        ``lineno``. Output written in the workers is not in any
+        particular order; return it via the results instead.
+
+        With ``--checkpoint``, the position in the input, the counters,
+        and the value returned by ``checkpoint_state`` are saved in a
+        file every ``--checkpoint-interval`` seconds, after a batch of
+        lines. If the program dies, running it again with the same
+        input files and ``--resume`` calls ``restore_checkpoint_state``
+        and continues from the position saved in the checkpoint, not
+        from the start. Output written after the checkpoint was saved
+        gets written again. Files that can't seek, such as pipes and
+        compressed files, are resumed only after they have been
+        processed in full. The checkpoint file is removed once all
+        input has been processed.
+
+        '''
+
+        names = args or ['-']
+        if self.settings['jobs'] > 1:
+            if self.settings['checkpoint']:
+                raise AppException('--checkpoint does not work with --jobs')
+            self._process_inputs_in_parallel(names)
+        elif self.settings['checkpoint']:
+            self._process_inputs_with_checkpoints(names)
+        else:
+            for arg in names:
+                self.process_input(arg)
+
+    def checkpoint_state(self):
+        '''Return the state of the application for a checkpoint.
+
+        With ``--checkpoint``, this is called each time a checkpoint is
+        saved, just after a batch of lines has been processed. The
+        return value must be picklable. The default is None.
+
         '''
 
-        for arg in args or ['-']:
-            self.process_input(arg)
+        return None
+
+    def restore_checkpoint_state(self, state):
+        '''Restore the state of the application from a checkpoint.
+
+        With ``--resume``, this is called with the value returned by
+        ``checkpoint_state`` when the checkpoint was saved, before
+        processing continues from there. The default does nothing.
+
+        '''
+
+    def _process_inputs_with_checkpoints(self, names):
+        # Like process_inputs, but save a checkpoint at least every
+        # --checkpoint-interval seconds, and with --resume, start from
+        # the checkpoint saved by an earlier run.
+
+        filename = self.settings['checkpoint']
+        first = 0
+        if self.settings['resume'] and os.path.exists(filename):
+            first = self._resume(filename, names)
+        self._checkpoint_saved = time.time()
+        try:
+            for name in names[first:]:
+                self.process_input(name)
+                self._save_checkpoint_if_due(name, None)
+        finally:
+            self._checkpoint_saved = None
+            self._resume_at = None
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def _resume(self, filename, names):
+        # Restore the state saved in a checkpoint, and return the index
+        # in names of the file to continue from.
+
+        import pickle
+        with open(filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+        fileno = checkpoint['fileno']
+        if (fileno > len(names) or
+                names[fileno - 1] != checkpoint['filename']):
+            raise AppException(
+                'checkpoint %s is for other input files' % filename)
+        logging.info('Resuming from checkpoint %s: %s, line %d',
+                     filename, checkpoint['filename'], checkpoint['lineno'])
+        self.global_lineno = checkpoint['global_lineno']
+        self.restore_checkpoint_state(checkpoint['state'])
+        if checkpoint['offset'] is None:
+            # The file was finished.
+            self.fileno = fileno
+            return fileno
+        self.fileno = fileno - 1
+        self._resume_at = (checkpoint['offset'], checkpoint['lineno'])
+        return fileno - 1
+
+    def _save_checkpoint_if_due(self, name, offset):
+        # Save a checkpoint saying the next line to process is at byte
+        # offset of file name, or with offset None, that all of the
+        # file has been processed.
+
+        now = time.time()
+        interval = self.settings['checkpoint-interval']
+        if now - self._checkpoint_saved < interval:
+            return
+        checkpoint = {
+            'fileno': self.fileno,
+            'filename': name,
+            'offset': offset,
+            'lineno': self.lineno,
+            'global_lineno': self.global_lineno,
+            'state': self.checkpoint_state(),
+        }
+        import pickle
+        f = cliapp.outputs.AtomicFile(self.settings['checkpoint'])
+        try:
+            f.write(pickle.dumps(checkpoint, protocol=2))
+        except BaseException:
+            f.discard()
+            raise
+        f.commit()
+        self._checkpoint_saved = now
+
+    def _take_resume_offset(self, f):
+        # Return the offset in f at which processing should start, and
+        # set lineno to match. Normally, this is the start of the file,
+        # but when resuming from a checkpoint, it is where the
+        # checkpoint was saved.
+
+        if self._resume_at is None:
+            return 0
+        (offset, self.lineno), self._resume_at = self._resume_at, None
+        if f is not None:
+            f.seek(offset)
+        return offset
+
+    def collect_input_result(self):
+        '''Return the result of processing part of the input.
+
+        With ``--jobs``, this is called in a worker process after it
+        has processed an input file or part of one. The return value
+        must be picklable. The default is None.
+
+        '''
+
+        return None
+
+    def merge_input_result(self, result):
+        '''Merge result of processing part of the input.
+
+        With ``--jobs``, this is called in the main process with the
+        value returned by ``collect_input_result``, for each input
+        file or part of one, in input order, once all have been
+        processed. The default does nothing.
+
+        '''
+
+    def _process_inputs_in_parallel(self, names):
+        parts = []
+        for fileno, name in enumerate(names, 1):
+            parts.extend(self._split_input(fileno, name))
+
+        # Anything buffered now would be written by every worker too.
+        self.output.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        global _parallel_app
+        _parallel_app = self
+        import multiprocessing
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:  # pragma: no cover
+            context = multiprocessing
+        # Each part gets a fresh worker, so that it starts from our
+        # current state rather than that left by the previous part.
+        # Workers are forked when needed, so we must not change our
+        # state before all are done.
+        pool = context.Pool(self.settings['jobs'], maxtasksperchild=1)
+        try:
+            results = pool.map(_process_input_part, parts, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+            _parallel_app = None
+
+        for lines, result in results:
+            self.global_lineno += lines
+            self.merge_input_result(result)
+        self.fileno += len(names)
+
+    def _split_input(self, fileno, name):
+        # Return the parts of an input file to process in parallel, as
+        # (fileno, name, start, end) tuples, where start and end are
+        # None for the whole file. Parts start at line boundaries.
+
+        part_size = self.settings['input-part-size']
+        whole = [(fileno, name, None, None)]
+        if part_size <= 0 or name == '-':
+            return whole
+        f = self.open_input(name, 'rb')
+        try:
+            seekable = getattr(f, 'seekable', None)
+            if seekable is None or not seekable():
+                # Compressed, read ahead, or not an io file at all.
+                return whole
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            starts = [0]
+            while True:
+                f.seek(starts[-1] + part_size)
+                f.readline()
+                start = f.tell()
+                if start >= size:
+                    break
+                starts.append(start)
+        finally:
+            f.close()
+        if len(starts) == 1:
+            return whole
+        ends = starts[1:] + [size]
+        return [(fileno, name, start, end)
+                for start, end in zip(starts, ends)]
+
+    def _process_input_range(self, name, start, end):
+        # Like process_input, but only for the lines between byte
+        # offsets start and end.
+
+        self.lineno = 0
+        f = self.open_input(name, 'rb')
+        mapped = self._mmap_input(f)
+        if mapped is not None:
+            self._process_mmap(name, mapped, start, end)
+        else:
+            f.seek(start)
+            part = io.BufferedReader(_RangeReader(f, end - start))
+            if self.input_mode == 'text':
+                part = io.TextIOWrapper(part)
+            self._process_lines(name, part, self.input_batch_size)
+        f.close()
 
     def open_input(self, name, mode='r'):
         '''Open an input file for reading.
@@ -623,29 +1019,255 @@ class Application(object):
         gets opened. It should allow reading. Some files should perhaps
         be opened in binary mode ('rb') instead of the default text mode.
 
+        Files compressed with gzip, bzip2, xz, or zstd, including
+        the standard input, are decompressed while they are read,
+        unless ``decompress_inputs`` is false. The format is
+        recognized from the data, not the name of the file. With
+        ``--decompress-in-background``, decompressing happens in a
+        separate thread, overlapping with processing the data.
+
+        With ``--read-ahead``, named files are read in a separate
+        thread, ahead of processing, and are not seekable. In
+        ``'mmap'`` mode, uncompressed files are left for
+        ``process_input`` to memory-map instead.
+
         '''
 
+        depth = self.settings['read-ahead']
         if name == '-':
-            return sys.stdin
+            f = getattr(sys.stdin, 'buffer', sys.stdin)
+            if (self.decompress_inputs and
+                    sys.version_info[0] < 3):  # pragma: no cover
+                # A Python 2 file can't peek at the data, and after
+                # peeking, sys.stdin would miss what was read.
+                f = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+                fmt = self._input_compression(f)
+            else:
+                fmt = self._input_compression(f)
+                if fmt is None:
+                    return f if 'b' in mode else sys.stdin
         else:
-            return open(name, mode)
+            # io.open, so that the file can peek, even on Python 2.
+            f = io.open(name, 'rb')
+            fmt = self._input_compression(f)
+            if fmt is None and (depth <= 0 or self.input_mode == 'mmap'):
+                if 'b' in mode:
+                    return f
+                f.close()
+                return open(name, mode)
+            if depth > 0:
+                f = self._read_ahead(f)
+
+        if fmt is not None:
+            try:
+                f = cliapp.inputs.open_decompressed(
+                    f, fmt, closefd=(name != '-'))
+            except BaseException:
+                if name != '-':
+                    f.close()
+                raise
+            if self.settings['decompress-in-background']:
+                f = self._read_ahead(f)
+        if 'b' in mode:
+            return f
+        return io.TextIOWrapper(f)
+
+    def _read_ahead(self, f):
+        # --decompress-in-background reads ahead even without
+        # --read-ahead, a couple of blocks.
+        return cliapp.inputs.read_ahead(
+            f, depth=max(self.settings['read-ahead'], 2),
+            block_size=self.settings['read-ahead-size'])
+
+    def _input_compression(self, f):
+        if not self.decompress_inputs:
+            return None
+        return cliapp.inputs.compression_format(f)
 
     def process_input(self, name, stdin=sys.stdin):
         '''Process a particular input file.
 
+        The file is opened with ``open_input``, in binary mode unless
+        ``input_mode`` is ``'text'``, and its lines are given to
+        ``process_input_lines`` in batches. In ``'mmap'`` mode,
+        regular files are memory-mapped instead of read, if
+        ``open_input`` returns them as ``io`` binary files; other
+        files are read, and their lines are bytes.
+
         The ``stdin`` argument is meant for unit test only.
 
         '''
 
         self.fileno += 1
         self.lineno = 0
-        f = self.open_input(name)
-        for line in f:
+        if self.input_mode == 'text':
+            f = self.open_input(name)
+        else:
+            f = self.open_input(name, 'rb')
+        mapped = self._mmap_input(f)
+        seekable = getattr(f, 'seekable', None)
+        if mapped is not None:
+            start = self._take_resume_offset(None)
+            self._process_mmap(name, mapped, start, len(mapped))
+        elif ((seekable is not None and seekable()) or
+              _is_regular_file(f)):
+            # A decompressed file is not seekable, but if it comes
+            # from a regular file, all of it is there already.
+            self._process_lines(name, f, self.input_batch_size)
+        else:
+            # Don't wait for a pipe or terminal to fill a whole batch:
+            # process each line as soon as it arrives.
+            self._process_lines(name, f, 1)
+        if f not in (stdin, getattr(stdin, 'buffer', None)):
+            f.close()
+
+    def _process_lines(self, name, f, batch_size):
+        if self._checkpoint_saved is not None:
+            self._process_lines_with_checkpoints(name, f, batch_size)
+            return
+        while True:
+            lines = f.readlines(batch_size)
+            if not lines:
+                break
+            self._process_batch(name, lines)
+
+    def _process_lines_with_checkpoints(self, name, f, batch_size):
+        # Like _process_lines, but save checkpoints with the offset of
+        # the next line, if f can seek there later.
+
+        binary = getattr(f, 'buffer', f)
+        seekable = getattr(binary, 'seekable', None)
+        if seekable is None or not seekable():
+            if self._resume_at is not None:
+                raise AppException(
+                    'cannot resume in the middle of %s' % name)
+            while True:
+                lines = f.readlines(batch_size)
+                if not lines:
+                    break
+                self._process_batch(name, lines)
+        elif binary is f:
+            self._take_resume_offset(f)
+            while True:
+                lines = f.readlines(batch_size)
+                if not lines:
+                    break
+                self._process_batch(name, lines)
+                self._save_checkpoint_if_due(name, f.tell())
+        else:
+            self._process_text_with_checkpoints(name, f, batch_size)
+
+    def _process_text_with_checkpoints(self, name, f, batch_size):
+        # A text file can't tell its position after readlines, so read
+        # its underlying binary file instead, a batch of whole lines at
+        # a time, and split the lines like the text file would. This
+        # assumes an encoding, like UTF-8, where newline is a b'\n'.
+
+        binary = f.buffer
+        offset = self._take_resume_offset(binary)
+        tail = b''
+        while True:
+            data = binary.read(batch_size)
+            if data:
+                data = tail + data
+                cut = data.rfind(b'\n') + 1
+                if cut == 0:
+                    tail = data
+                    continue
+                data, tail = data[:cut], data[cut:]
+            elif tail:
+                data, tail = tail, b''
+            else:
+                break
+            text = data.decode(f.encoding, f.errors)
+            self._process_batch(
+                name, io.StringIO(text, newline=None).readlines())
+            offset += len(data)
+            self._save_checkpoint_if_due(name, offset)
+
+    def _process_batch(self, name, lines):
+        lineno = self.lineno
+        global_lineno = self.global_lineno
+        self.process_input_lines(name, lines)
+        self.lineno = lineno + len(lines)
+        self.global_lineno = global_lineno + len(lines)
+
+    def _mmap_input(self, f):
+        # Return a read-only mmap of the open file f, if we're in
+        # mmap mode and f is a non-empty regular file, else None.
+
+        if self.input_mode != 'mmap':
+            return None
+        if not isinstance(getattr(f, 'raw', None), io.FileIO):
+            # Not a plain file, but perhaps a decompressed one, or
+            # something from an open_input override: read it instead.
+            # open_input opens files with io.open, even on Python 2,
+            # so that they pass this check.
+            return None
+        if not _is_regular_file(f) or os.fstat(f.fileno()).st_size == 0:
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        willneed = getattr(mmap, 'MADV_WILLNEED', None)
+        if self.settings['read-ahead'] > 0 and willneed is not None:
+            # Let the kernel read the file while we process it.
+            mapped.madvise(willneed)
+        return mapped
+
+    def _process_mmap(self, name, mapped, start, end):
+        # Process the lines between byte offsets start and end of
+        # mapped as memoryview slices, without copying them.
+
+        view = memoryview(mapped)
+        find = mapped.find
+        lines = []
+        batch_start = pos = start
+        while pos < end:
+            newline = find(b'\n', pos, end)
+            line_end = end if newline == -1 else newline + 1
+            lines.append(view[pos:line_end])
+            pos = line_end
+            if pos - batch_start >= self.input_batch_size or pos >= end:
+                self._process_batch(name, lines)
+                lines = []
+                batch_start = pos
+                if self._checkpoint_saved is not None:
+                    self._save_checkpoint_if_due(name, pos)
+        del view
+        try:
+            mapped.close()
+        except BufferError:
+            # The application kept some of the lines. The mapping goes
+            # away when they do.
+            pass
+
+    def process_input_lines(self, filename, lines):
+        '''Process a batch of lines of the input file.
+
+        ``lines`` is a list of lines, read from the file in one go:
+        about ``input_batch_size`` bytes' worth from a regular file,
+        or one line from a pipe or terminal. The lines are strings,
+        or if ``input_mode`` is ``'binary'``, bytes. In ``'mmap'``
+        mode, they are ``memoryview`` slices of the file for regular
+        files, and bytes otherwise. A memoryview can be sliced and
+        compared like bytes without copying the line; use
+        ``bytes(line)`` for the rest. Creating one costs more than
+        reading a short line into a bytes object, though, so this
+        pays off for long lines, of which only parts are looked at.
+
+        While this is called, ``lineno`` and ``global_lineno`` are the
+        numbers of the line just before the batch; afterwards, they
+        are advanced past it.
+
+        The default calls ``process_input_line`` for each line, and
+        keeps the counters right for it. Applications for which that
+        call per line is too slow can redefine this method instead.
+
+        '''
+
+        for line in lines:
             self.global_lineno += 1
             self.lineno += 1
-            self.process_input_line(name, line)
-        if f != stdin:
-            f.close()
+            self.process_input_line(filename, line)
 
     def process_input_line(self, filename, line):
         '''Process one line of the input file.
@@ -655,11 +1277,112 @@ class Application(object):
 
         '''
 
-    def runcmd(self, *args, **kwargs):  # pragma: no cover
-        return cliapp.runcmd(*args, **kwargs)
+    def runcmd(self, *args, **kwargs):
+        '''Like cliapp.runcmd, but count resource usage.
 
-    def runcmd_unchecked(self, *args, **kwargs):  # pragma: no cover
-        return cliapp.runcmd_unchecked(*args, **kwargs)
+        The resource usage of the commands is added to
+        ``self.runcmd_stats``, and logged at the end of the run.
+
+        '''
+
+        return self._runcmd_with_stats(cliapp.runcmd, 1, args, kwargs)
+
+    def runcmd_unchecked(self, *args, **kwargs):
+        '''Like cliapp.runcmd_unchecked, but count resource usage.'''
+        return self._runcmd_with_stats(
+            cliapp.runcmd_unchecked, 3, args, kwargs)
+
+    def ssh_runcmd(self, target, argv, *argvs, **kwargs):
+        '''Like cliapp.ssh_runcmd, but reuse connections.
+
+        Commands for the same target (and ``ssh_options``) share one
+        connection from ``self.ssh_sessions``. The connections are
+        closed when the application finishes. Resource usage of the
+        local ssh processes is counted like for ``runcmd``.
+
+        '''
+
+        return self._runcmd_with_stats(
+            self.ssh_sessions.ssh_runcmd, 1, (target, argv) + argvs, kwargs)
+
+    def _runcmd_with_stats(self, func, num_values, args, kwargs):
+        wanted = kwargs.get('stats', False)
+        kwargs['stats'] = True
+        result = func(*args, **kwargs)
+        self.runcmd_stats.add(result[-1])
+        if wanted:
+            return result
+        elif num_values == 1:
+            return result[0]
+        else:
+            return result[:num_values]
+
+    def log_runcmd_stats(self):
+        '''Log resource usage of external commands, if any were run.'''
+        if self.runcmd_stats.commands:
+            logging.info('Resource usage of external commands:')
+            for line in self.runcmd_stats.report():
+                logging.info('  %s', line)
 
     def dump_memory_profile(self, msg):  # pragma: no cover
         self.memory_profile_dumper.dump_memory_profile(msg)
+
+
+# The application whose input _process_input_part processes. Worker
+# processes are forked, so they inherit this.
+_parallel_app = None
+
+
+def _process_input_part(part):
+    fileno, name, start, end = part
+    app = _parallel_app
+    app.global_lineno = 0
+    try:
+        if start is None:
+            app.fileno = fileno - 1
+            app.process_input(name)
+        else:
+            app.fileno = fileno
+            app._process_input_range(name, start, end)
+        app.output.flush()
+        return app.global_lineno, app.collect_input_result()
+    except Exception as e:
+        # The exception is pickled to pass it to the main process. If
+        # it can't be unpickled there, multiprocessing hangs, so pass
+        # on something that can be.
+        import pickle
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            if isinstance(e, AppException):
+                raise AppException(str(e))
+            raise RuntimeError(_format_exc())
+        raise
+
+
+def _is_regular_file(f):
+    try:
+        fd = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+
+class _RangeReader(io.RawIOBase):
+
+    '''Read at most size bytes from a file, from where it is now.'''
+
+    def __init__(self, f, size):
+        io.RawIOBase.__init__(self)
+        self._f = f
+        self._left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = min(len(buf), self._left)
+        data = self._f.read(n)
+        buf[:len(data)] = data
+        self._left -= len(data)
+        return len(data)
@@ -22,12 +22,31 @@ try:
     TextIOBase = file
 except ImportError:
     from io import StringIO, TextIOBase
+import bz2
+import gzip
+import io
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import unittest
 
 import cliapp
 
 
+def gzip_compress(data):
+    # gzip.compress does not exist on Python 2.
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
 def devnull(msg):
     pass
 
@@ -116,6 +135,72 @@ class ApplicationTests(unittest.TestCase):
         self.app.run(args=['--output=/dev/null'])
         self.assertEqual(self.app.output.name, '/dev/null')
 
+    def run_writing_output(self, args, data='foo\n'):
+        # Run self.app with args, writing data to the output, and
+        # return the name of the --output file.
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        name = os.path.join(tempdir, 'output')
+        self.app.process_args = lambda args: self.app.output.write(data)
+        self.app.run(args=['--output=%s' % name] + args)
+        return name
+
+    def test_run_writes_output_with_large_buffer(self):
+        name = self.run_writing_output(['--output-buffer-size=1M'])
+        with open(name) as f:
+            self.assertEqual(f.read(), 'foo\n')
+
+    def test_run_writes_output_in_background(self):
+        data = 'foo\n' * 100000
+        name = self.run_writing_output(
+            ['--output-in-background', '--output-buffer-size=1k'], data)
+        with open(name) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_run_writes_binary_output(self):
+        self.app.output_mode = 'binary'
+        name = self.run_writing_output(
+            ['--output-in-background'], data=b'\xff\n')
+        with open(name, 'rb') as f:
+            self.assertEqual(f.read(), b'\xff\n')
+
+    def test_run_sets_output_to_stdout_buffer_in_binary_mode(self):
+        self.app.output_mode = 'binary'
+        self.app.process_args = lambda args: None
+        self.app.run(args=[])
+        self.assertEqual(self.app.output,
+                         getattr(sys.stdout, 'buffer', sys.stdout))
+
+    def test_run_renames_atomic_output_into_place(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        name = os.path.join(tempdir, 'output')
+        self.app.process_args = lambda args: self.app.output.write('foo\n')
+        self.app.run(args=['--output=%s' % name, '--atomic-output'])
+        with open(name) as f:
+            self.assertEqual(f.read(), 'foo\n')
+        self.assertEqual(os.listdir(tempdir), ['output'])
+
+    def test_run_does_not_replace_atomic_output_on_error(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        name = os.path.join(tempdir, 'output')
+        with open(name, 'w') as f:
+            f.write('old\n')
+
+        def process_args(args):
+            self.assertFalse(os.path.samefile(self.app.output.name, name))
+            self.app.output.write('new\n')
+            raise cliapp.AppException('oops')
+
+        self.app.process_args = process_args
+        with self.assertRaises(SystemExit):
+            self.app.run(args=['--output=%s' % name, '--atomic-output'],
+                         stderr=StringIO(), log=devnull)
+        with open(name) as f:
+            self.assertEqual(f.read(), 'old\n')
+        self.assertEqual(os.listdir(tempdir), ['output'])
+
     def test_run_calls_parse_args(self):
         class DummyOptions(object):
             def __init__(self):
@@ -282,6 +367,402 @@ class ApplicationTests(unittest.TestCase):
                           (2, 3, 1),
                           (2, 4, 2)])
 
+    def test_processes_input_lines_in_batches(self):
+        batches = []
+
+        class Foo(cliapp.Application):
+
+            input_batch_size = 10
+
+            def open_input(self, name, mode=None):
+                return StringIO(''.join('%s%d\n' % (name, i)
+                                        for i in range(3)))
+
+            def process_input_lines(self, name, lines):
+                batches.append((self.global_lineno, self.lineno, lines))
+
+        foo = Foo()
+        foo.run(args=['foo', 'bar'])
+        self.assertEqual(batches,
+                         [(0, 0, ['foo0\n', 'foo1\n', 'foo2\n']),
+                          (3, 0, ['bar0\n', 'bar1\n', 'bar2\n'])])
+        self.assertEqual((foo.global_lineno, foo.lineno), (6, 3))
+
+    def test_processes_batches_of_at_most_batch_size(self):
+        batches = []
+        self.app.input_batch_size = 5
+        self.app.open_input = lambda name: StringIO('foo\nbar\nfoobar\n')
+        self.app.process_input_lines = (
+            lambda name, lines: batches.append(lines))
+        self.app.process_input('foo')
+        self.assertEqual(batches, [['foo\n', 'bar\n'], ['foobar\n']])
+        self.assertEqual(self.app.lineno, 3)
+
+    def test_processes_unseekable_input_line_by_line(self):
+        batches = []
+
+        class Unseekable(StringIO):
+
+            def seekable(self):
+                return False
+
+        self.app.open_input = lambda name: Unseekable('foo\nbar\n')
+        self.app.process_input_lines = (
+            lambda name, lines: batches.append(lines))
+        self.app.process_input('foo')
+        self.assertEqual(batches, [['foo\n'], ['bar\n']])
+
+    def make_input_file(self, data):
+        fd, name = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, name)
+        return name
+
+    def test_processes_regular_file_as_bytes_in_binary_mode(self):
+        lines = []
+        self.app.input_mode = 'binary'
+        self.app.process_input_line = (
+            lambda name, line: lines.append(line))
+        self.app.process_input(self.make_input_file(b'foo\nbar'))
+        self.assertEqual(lines, [b'foo\n', b'bar'])
+
+    def test_processes_regular_file_as_memoryviews_in_mmap_mode(self):
+        lines = []
+        self.app.input_mode = 'mmap'
+        self.app.input_batch_size = 5
+        self.app.process_input_lines = (
+            lambda name, batch: lines.append(batch))
+        self.app.process_input(self.make_input_file(b'foo\nbar\nfoobar'))
+        self.assertTrue(isinstance(lines[0][0], memoryview))
+        self.assertEqual([[bytes(line) for line in batch] for batch in lines],
+                         [[b'foo\n', b'bar\n'], [b'foobar']])
+        self.assertEqual(self.app.lineno, 3)
+
+    def test_calls_process_input_line_with_memoryviews(self):
+        lines = []
+        self.app.input_mode = 'mmap'
+        self.app.process_input_line = (
+            lambda name, line: lines.append((self.app.lineno, line)))
+        self.app.process_input(self.make_input_file(b'foo\nbar\n'))
+        # The memoryviews outlive the mapping being closed.
+        self.assertEqual(lines, [(1, b'foo\n'), (2, b'bar\n')])
+
+    def test_processes_empty_file_in_mmap_mode(self):
+        self.app.input_mode = 'mmap'
+        self.app.process_input(self.make_input_file(b''))
+        self.assertEqual(self.app.lineno, 0)
+
+    def test_reads_file_that_is_not_an_io_file_in_mmap_mode(self):
+        class Wrapped(object):
+            def __init__(self, f):
+                self.readlines = f.readlines
+                self.fileno = f.fileno
+                self.close = f.close
+
+        lines = []
+        name = self.make_input_file(b'foo\nbar\n')
+        self.app.input_mode = 'mmap'
+        self.app.open_input = lambda name, mode: Wrapped(io.open(name, mode))
+        self.app.process_input_line = (
+            lambda name, line: lines.append(line))
+        self.app.process_input(name)
+        self.assertEqual(lines, [b'foo\n', b'bar\n'])
+        self.assertEqual([type(line) for line in lines], [bytes, bytes])
+
+    def test_processes_pipe_as_bytes_in_mmap_mode(self):
+        lines = []
+        rfd, wfd = os.pipe()
+        os.write(wfd, b'foo\nbar\n')
+        os.close(wfd)
+        f = os.fdopen(rfd, 'rb')
+        self.app.input_mode = 'mmap'
+        self.app.open_input = lambda name, mode: f
+        self.app.process_input_line = (
+            lambda name, line: lines.append(line))
+        self.app.process_input('-')
+        self.assertEqual(lines, [b'foo\n', b'bar\n'])
+        self.assertTrue(f.closed)
+
+    def test_opens_stdin_in_binary_mode(self):
+        self.assertEqual(self.app.open_input('-', 'rb'),
+                         getattr(sys.stdin, 'buffer', sys.stdin))
+
+    def test_decompresses_compressed_input_files(self):
+        compressors = [gzip_compress, bz2.compress]
+        if lzma is not None:
+            compressors.append(lzma.compress)
+        for compress in compressors:
+            lines = []
+            self.app.process_input_line = (
+                lambda name, line: lines.append(line))
+            self.app.process_input(
+                self.make_input_file(compress(b'foo\nbar\n')))
+            self.assertEqual(lines, ['foo\n', 'bar\n'])
+            self.assertEqual(self.app.lineno, 2)
+
+    def test_decompresses_input_in_background(self):
+        lines = []
+        self.app.settings['decompress-in-background'] = True
+        self.app.input_mode = 'binary'
+        self.app.process_input_line = lambda name, line: lines.append(line)
+        data = b''.join(b'%d\n' % i for i in range(100000))
+        self.app.process_input(self.make_input_file(gzip_compress(data)))
+        self.assertEqual(b''.join(lines), data)
+        self.assertEqual(self.app.lineno, 100000)
+
+    def test_decompresses_stdin(self):
+        stdin = io.TextIOWrapper(
+            io.BufferedReader(io.BytesIO(gzip_compress(b'foo\n'))))
+        saved = sys.stdin
+        sys.stdin = stdin
+        try:
+            f = self.app.open_input('-')
+            self.assertEqual(f.read(), 'foo\n')
+            f.close()
+        finally:
+            sys.stdin = saved
+        self.assertFalse(stdin.closed)
+
+    def test_does_not_decompress_when_told_not_to(self):
+        data = gzip_compress(b'foo\n')
+        self.app.decompress_inputs = False
+        f = self.app.open_input(self.make_input_file(data), 'rb')
+        self.assertEqual(f.read(), data)
+        f.close()
+
+    def test_does_not_mmap_compressed_file(self):
+        lines = []
+        self.app.input_mode = 'mmap'
+        self.app.process_input_line = lambda name, line: lines.append(line)
+        self.app.process_input(
+            self.make_input_file(gzip_compress(b'foo\nbar\n')))
+        self.assertEqual(lines, [b'foo\n', b'bar\n'])
+        self.assertEqual([type(line) for line in lines], [bytes, bytes])
+
+    def test_does_not_split_file_that_cannot_tell_if_seekable(self):
+        class Unsplittable(object):
+            def __init__(self, data):
+                self.read = io.BytesIO(data).read
+
+            def close(self):
+                pass
+
+        self.app.settings['input-part-size'] = 4
+        self.app.open_input = lambda name, mode: Unsplittable(b'foo\n' * 9)
+        self.assertEqual(self.app._split_input(1, 'foo'),
+                         [(1, 'foo', None, None)])
+
+    def test_does_not_split_compressed_file(self):
+        self.app.settings['input-part-size'] = 4
+        name = self.make_input_file(gzip_compress(b'foo\nbar\nfoobar\n'))
+        self.assertEqual(self.app._split_input(1, name),
+                         [(1, name, None, None)])
+
+    def test_reads_ahead(self):
+        lines = []
+        self.app.settings['read-ahead'] = 2
+        self.app.settings['read-ahead-size'] = 7
+        self.app.process_input_line = lambda name, line: lines.append(line)
+        self.app.process_input(self.make_input_file(b'foo\nbar\nfoobar\n'))
+        self.assertEqual(lines, ['foo\n', 'bar\n', 'foobar\n'])
+        self.assertEqual(self.app.lineno, 3)
+
+    def test_reads_compressed_file_ahead(self):
+        self.app.settings['read-ahead'] = 2
+        f = self.app.open_input(
+            self.make_input_file(gzip_compress(b'foo\n')), 'rb')
+        self.assertEqual(f.read(), b'foo\n')
+        f.close()
+
+    def test_reads_ahead_in_mmap_mode_by_mapping_file(self):
+        lines = []
+        self.app.settings['read-ahead'] = 2
+        self.app.input_mode = 'mmap'
+        self.app.process_input_line = lambda name, line: lines.append(line)
+        self.app.process_input(self.make_input_file(b'foo\nbar\n'))
+        self.assertEqual(lines, [b'foo\n', b'bar\n'])
+        self.assertEqual([type(line) for line in lines],
+                         [memoryview, memoryview])
+
+    def test_does_not_split_file_read_ahead(self):
+        self.app.settings['read-ahead'] = 2
+        self.app.settings['input-part-size'] = 4
+        name = self.make_input_file(b'foo\nbar\nfoobar\n')
+        self.assertEqual(self.app._split_input(1, name),
+                         [(1, name, None, None)])
+
+    def test_processes_parts_of_files_in_mmap_mode(self):
+
+        class Foo(cliapp.Application):
+
+            input_mode = 'mmap'
+
+            def setup(self):
+                self.lines = []
+
+            def process_input_line(self, name, line):
+                self.lines.append(bytes(line))
+
+            def collect_input_result(self):
+                return self.lines
+
+            def merge_input_result(self, result):
+                self.lines.extend(result)
+
+        data = b''.join(b'line %d\n' % i for i in range(1000))
+        foo = Foo()
+        foo.run(args=['--jobs=2', '--input-part-size=1000',
+                      self.make_input_file(data)])
+        self.assertEqual(b''.join(foo.lines), data)
+
+    def test_processes_inputs_in_parallel(self):
+
+        class Foo(cliapp.Application):
+
+            def setup(self):
+                self.seen = []
+                self.merged = []
+
+            def open_input(self, name, mode=None):
+                return StringIO(''.join('%s%d\n' % (name, i)
+                                        for i in range(2)))
+
+            def process_input_line(self, name, line):
+                self.seen.append(
+                    (self.fileno, self.global_lineno, self.lineno, line))
+
+            def collect_input_result(self):
+                return self.seen
+
+            def merge_input_result(self, result):
+                self.merged.append(result)
+
+        foo = Foo()
+        foo.run(args=['--jobs=2', 'foo', 'bar', 'foobar'])
+        self.assertEqual(
+            foo.merged,
+            [[(1, 1, 1, 'foo0\n'), (1, 2, 2, 'foo1\n')],
+             [(2, 1, 1, 'bar0\n'), (2, 2, 2, 'bar1\n')],
+             [(3, 1, 1, 'foobar0\n'), (3, 2, 2, 'foobar1\n')]])
+        self.assertEqual(foo.seen, [])
+        self.assertEqual((foo.fileno, foo.global_lineno), (3, 6))
+
+    def test_processes_parts_of_large_inputs_in_parallel(self):
+
+        class Foo(cliapp.Application):
+
+            def setup(self):
+                self.lines = []
+
+            def process_input_line(self, name, line):
+                self.lines.append((self.fileno, line))
+
+            def collect_input_result(self):
+                return self.lines
+
+            def merge_input_result(self, result):
+                self.lines.extend(result)
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            names = []
+            for i, count in enumerate([1000, 10, 0]):
+                name = os.path.join(tempdir, 'input%d' % i)
+                with open(name, 'w') as f:
+                    for j in range(count):
+                        f.write('%d line %d\n' % (i, j))
+                names.append(name)
+            foo = Foo()
+            foo.run(args=['--jobs=3', '--input-part-size=1000'] + names)
+        finally:
+            shutil.rmtree(tempdir)
+
+        self.assertEqual(
+            foo.lines,
+            [(1, '0 line %d\n' % j) for j in range(1000)] +
+            [(2, '1 line %d\n' % j) for j in range(10)])
+        self.assertEqual((foo.fileno, foo.global_lineno), (3, 1010))
+
+    def test_parallel_processing_passes_on_errors(self):
+
+        class Foo(cliapp.Application):
+
+            def open_input(self, name, mode=None):
+                return StringIO('foo\n')
+
+            def process_input_line(self, name, line):
+                raise cliapp.AppException('bad line: %s' % line.strip())
+
+        foo = Foo()
+        foo.settings['jobs'] = 2
+        self.assertRaises(cliapp.AppException, foo.process_inputs, ['foo'])
+
+    def test_parallel_processing_passes_on_unpicklable_errors(self):
+
+        class BadLine(cliapp.AppException):
+
+            def __init__(self, line, why):
+                cliapp.AppException.__init__(self, '%s: %s' % (line, why))
+
+        class Oops(Exception):
+
+            def __init__(self, what, why):
+                Exception.__init__(self, what)
+
+        class Foo(cliapp.Application):
+
+            def open_input(self, name, mode=None):
+                return StringIO('%s\n' % name)
+
+            def process_input_line(self, name, line):
+                if name == 'app':
+                    raise BadLine(line.strip(), 'bad')
+                raise Oops(line, 'bad')
+
+        foo = Foo()
+        foo.settings['jobs'] = 2
+        with self.assertRaises(cliapp.AppException) as cm:
+            foo.process_inputs(['app'])
+        self.assertEqual(str(cm.exception), 'app: bad')
+        self.assertRaises(RuntimeError, foo.process_inputs, ['other'])
+
+    def test_runcmd_counts_resource_usage(self):
+        self.assertEqual(self.app.runcmd(['echo', 'foo']), b'foo\n')
+        self.assertEqual(self.app.runcmd_unchecked(['cat'], ['true']),
+                         (0, b'', b''))
+        out, stats = self.app.runcmd(['true'], stats=True)
+        self.assertEqual(out, b'')
+        self.assertTrue(isinstance(stats, cliapp.PipelineStats))
+        commands = self.app.runcmd_stats.commands
+        self.assertEqual(sorted(commands), ['cat', 'echo', 'true'])
+        self.assertEqual(commands['true'].runs, 2)
+        self.assertEqual(self.app.runcmd_stats.stdout_bytes, 4)
+
+    def test_run_logs_resource_usage_of_commands(self):
+        self.app.process_args = lambda args: self.app.runcmd(['true'])
+        self.app.run(args=[])
+        self.assertEqual(list(self.app.runcmd_stats.commands), ['true'])
+
+    def test_ssh_runcmd_uses_session_pool(self):
+        calls = []
+
+        class FakePool(object):
+
+            def ssh_runcmd(self, target, argv, **kwargs):
+                calls.append((target, argv))
+                return cliapp.runcmd(['echo', target], **kwargs)
+
+            def close(self):
+                calls.append('close')
+
+        self.app.ssh_sessions = FakePool()
+        self.app.process_args = (
+            lambda args: self.app.ssh_runcmd('host', ['true']))
+        self.app.run(args=[])
+        self.assertEqual(calls, [('host', ['true']), 'close'])
+        self.assertEqual(list(self.app.runcmd_stats.commands), ['echo'])
+
     def test_run_prints_out_error_for_appexception(self):
         def raise_error(args):
             raise cliapp.AppException('xxx')
@@ -313,6 +794,142 @@ class ApplicationTests(unittest.TestCase):
         self.assertRaises(SystemExit, self.app.run, [], stderr=f, log=devnull)
 
 
+class Crash(Exception):
+
+    pass
+
+
+class CheckpointApp(cliapp.Application):
+
+    '''Collect lines, and crash at a given one.'''
+
+    input_batch_size = 1
+    crash_at = None
+
+    def __init__(self, *args, **kwargs):
+        cliapp.Application.__init__(self, *args, **kwargs)
+        self.seen = []
+
+    def process_input_line(self, filename, line):
+        if isinstance(line, memoryview):
+            line = bytes(line)
+        if line == self.crash_at:
+            raise Crash()
+        self.seen.append((self.fileno, self.lineno, self.global_lineno, line))
+
+    def checkpoint_state(self):
+        return list(self.seen)
+
+    def restore_checkpoint_state(self, state):
+        self.seen = state
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tempdir, 'checkpoint')
+        self.inputs = []
+        for i, data in enumerate([b'foo\nbar\n', b'foobar\nyo\n']):
+            name = os.path.join(self.tempdir, 'input%d' % i)
+            with open(name, 'wb') as f:
+                f.write(data)
+            self.inputs.append(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def make_app(self, input_mode='text', crash_at=None, resume=False):
+        app = CheckpointApp()
+        app.input_mode = input_mode
+        app.crash_at = crash_at
+        app.settings['checkpoint'] = self.checkpoint
+        app.settings['checkpoint-interval'] = 0
+        app.settings['resume'] = resume
+        return app
+
+    def run_with_crash(self, input_mode, crash_at):
+        app = self.make_app(input_mode, crash_at=crash_at)
+        with self.assertRaises(Crash):
+            app.process_inputs(self.inputs)
+        self.assertTrue(os.path.exists(self.checkpoint))
+        app = self.make_app(input_mode, resume=True)
+        app.process_inputs(self.inputs)
+        return app
+
+    def expected(self, lines):
+        return [(1, 1, 1, lines[0]), (1, 2, 2, lines[1]),
+                (2, 1, 3, lines[2]), (2, 2, 4, lines[3])]
+
+    def test_resumes_in_middle_of_text_file(self):
+        app = self.run_with_crash('text', 'yo\n')
+        self.assertEqual(
+            app.seen, self.expected(['foo\n', 'bar\n', 'foobar\n', 'yo\n']))
+        self.assertEqual(app.fileno, 2)
+        self.assertEqual(app.global_lineno, 4)
+
+    def test_resumes_in_middle_of_binary_file(self):
+        app = self.run_with_crash('binary', b'bar\n')
+        self.assertEqual(
+            app.seen,
+            self.expected([b'foo\n', b'bar\n', b'foobar\n', b'yo\n']))
+
+    def test_resumes_in_middle_of_mapped_file(self):
+        app = self.run_with_crash('mmap', b'yo\n')
+        self.assertEqual(
+            app.seen,
+            self.expected([b'foo\n', b'bar\n', b'foobar\n', b'yo\n']))
+
+    def test_resumes_after_unseekable_file(self):
+
+        class Unseekable(StringIO):
+
+            def seekable(self):
+                return False
+
+        def open_input(name, mode='r'):
+            if name == self.inputs[0]:
+                return Unseekable('foo\nbar\n')
+            return open(name, mode)
+
+        app = self.make_app(crash_at='foobar\n')
+        app.open_input = open_input
+        with self.assertRaises(Crash):
+            app.process_inputs(self.inputs)
+        app = self.make_app(resume=True)
+        app.process_inputs(self.inputs)
+        self.assertEqual(
+            app.seen, self.expected(['foo\n', 'bar\n', 'foobar\n', 'yo\n']))
+
+    def test_removes_checkpoint_when_done(self):
+        app = self.make_app()
+        app.process_inputs(self.inputs)
+        self.assertEqual(len(app.seen), 4)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_starts_from_beginning_without_resume(self):
+        app = self.make_app(crash_at='yo\n')
+        with self.assertRaises(Crash):
+            app.process_inputs(self.inputs)
+        app = self.make_app()
+        app.process_inputs(self.inputs)
+        self.assertEqual(len(app.seen), 4)
+
+    def test_refuses_checkpoint_for_other_inputs(self):
+        app = self.make_app(crash_at='yo\n')
+        with self.assertRaises(Crash):
+            app.process_inputs(self.inputs)
+        app = self.make_app(resume=True)
+        with self.assertRaises(cliapp.AppException):
+            app.process_inputs(list(reversed(self.inputs)))
+
+    def test_refuses_checkpoint_with_jobs(self):
+        app = self.make_app()
+        app.settings['jobs'] = 2
+        with self.assertRaises(cliapp.AppException):
+            app.process_inputs(self.inputs)
+
+
 class DummySubcommandApp(cliapp.Application):
 
     def cmd_foo(self, args):
@@ -372,3 +989,38 @@ class ExtensibleSubcommandTests(unittest.TestCase):
             pass
         self.app.add_subcommand('foo', help_callback)
         self.assertEqual(self.app.subcommands, {'foo': help_callback})
+
+
+class ImportTests(unittest.TestCase):
+
+    def run_python(self, code):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(cliapp.__file__)))
+        return subprocess.check_output(
+            [sys.executable, '-c', code], env=env).decode().split()
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs PEP 562')
+    def test_does_not_import_slow_modules(self):
+        slow = ['yaml', 'logging.handlers', 'multiprocessing', 'pickle',
+                'inspect', 'imp', 'optparse', 'cliapp.app',
+                'cliapp.settings']
+        imported = self.run_python(
+            'import sys, cliapp\n'
+            'print(" ".join(sys.modules))\n')
+        self.assertEqual([x for x in slow if x in imported], [])
+
+    def test_imports_names_when_used(self):
+        names = self.run_python(
+            'import cliapp\n'
+            'print(cliapp.Application.__name__, cliapp.Plugin.__name__)\n'
+            'print(cliapp.runcmd.__name__)\n')
+        self.assertEqual(names, ['Application', 'Plugin', 'runcmd'])
+
+    def test_exports_everything_in_all(self):
+        for name in cliapp.__all__:
+            self.assertTrue(hasattr(cliapp, name), name)
+
+    def test_raises_attribute_error_for_unknown_name(self):
+        with self.assertRaises(AttributeError):
+            cliapp.no_such_name
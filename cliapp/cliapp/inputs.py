@@ -0,0 +1,314 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Reading input files.
+
+``Application.open_input`` uses these to decompress compressed
+input files transparently, and to read input files ahead of
+processing them. The compression format is recognized from the
+first bytes of the file, not its name, so this works for the
+standard input as well.
+
+'''
+
+
+import io
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+import threading
+
+import cliapp
+
+
+# The first bytes of a file in each compression format.
+_magic = [
+    ('gzip', b'\x1f\x8b'),
+    ('bzip2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+]
+
+# How much data a background thread reads at a time, and how many
+# such blocks it may read ahead of the reader, by default.
+_block_size = 1024 ** 2
+_queue_depth = 4
+
+
+def compression_format(f):
+    '''Return the compression format of the data in a binary file.
+
+    The result is one of ``'gzip'``, ``'bzip2'``, ``'xz'``, or
+    ``'zstd'``, or None for data that is not compressed. The first
+    bytes of the file are peeked at without consuming them, so ``f``
+    must have a ``peek`` method, like ``io.BufferedReader``. Files
+    without one, and terminals, are never compressed.
+
+    '''
+
+    peek = getattr(f, 'peek', None)
+    if peek is None or f.isatty():
+        return None
+    head = peek(8)
+    for fmt, magic in _magic:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def open_decompressed(f, fmt, closefd=True):
+    '''Return a binary file for reading the decompressed data of f.
+
+    ``fmt`` is the compression format, as returned by
+    ``compression_format``. Closing the returned file closes ``f``
+    too, unless ``closefd`` is false. To decompress in a background
+    thread, while the data is being processed, give the returned
+    file to ``read_ahead``.
+
+    The zstd format needs the ``zstandard`` Python module, or the
+    ``zstd`` program, which is then run in a child process. On
+    Python 2, bzip2 and xz are decompressed with the ``bzip2`` and
+    ``xz`` programs in the same way.
+
+    '''
+
+    return io.BufferedReader(
+        _DecompressingReader(f, fmt, closefd), buffer_size=_block_size)
+
+
+def read_ahead(f, depth=_queue_depth, block_size=_block_size, closefd=True):
+    '''Return a binary file that reads f in a background thread.
+
+    The thread reads blocks of ``block_size`` bytes from ``f`` into
+    a queue, at most ``depth`` blocks ahead of the reader, so that
+    waiting for slow storage overlaps with processing the data
+    already read. The returned file is not seekable. Closing it
+    closes ``f`` too, unless ``closefd`` is false.
+
+    '''
+
+    return io.BufferedReader(
+        _ReadAheadReader(f, depth, block_size, closefd),
+        buffer_size=block_size)
+
+
+def _decompressor(f, fmt):
+    # Return a binary file object from which to read the decompressed
+    # data of f, and a cleanup function to call after closing it,
+    # with a flag telling if all the data was read. The modules for
+    # each format are imported only when needed, since most runs read
+    # no compressed input.
+
+    if fmt == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=f, mode='rb'), None
+    elif fmt == 'bzip2':
+        import bz2
+        try:
+            return bz2.BZ2File(f), None
+        except TypeError:  # pragma: no cover
+            # Python 2's BZ2File can only open files by name.
+            return _program_decompressor(
+                ['bzip2', '-dcq'], f, fmt, 'the bzip2 program')
+    elif fmt == 'xz':
+        try:
+            import lzma
+        except ImportError:  # pragma: no cover
+            return _program_decompressor(
+                ['xz', '-dcq'], f, fmt,
+                'the lzma Python module or the xz program')
+        return lzma.LZMAFile(f), None
+    elif fmt == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            return _program_decompressor(
+                ['zstd', '-dcq'], f, fmt,
+                'the zstandard Python module or the zstd program')
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True)  # pragma: no cover
+        return reader, None  # pragma: no cover
+    raise cliapp.AppException('cannot decompress %s input' % fmt)
+
+
+def _program_decompressor(argv, f, fmt, need):
+    # Like _decompressor, with the program argv, if it is installed.
+
+    if _which(argv[0]) is None:
+        raise cliapp.AppException(
+            'cannot decompress %s input: need %s' % (fmt, need))
+    return _command_decompressor(argv, f)
+
+
+def _which(program):
+    # Return the pathname of program in $PATH, or None. Python 2 has
+    # no shutil.which.
+
+    import shutil
+    try:
+        which = shutil.which
+    except AttributeError:  # pragma: no cover
+        import os
+        path = os.environ.get('PATH', os.defpath)
+        for dirname in path.split(os.pathsep):
+            pathname = os.path.join(dirname, program)
+            if os.path.isfile(pathname) and os.access(pathname, os.X_OK):
+                return pathname
+        return None
+    return which(program)
+
+
+def _command_decompressor(argv, f):
+    # Decompress f with an external program. A thread copies f to it,
+    # since f may have data in its buffer, which the program would not
+    # see if it read from the underlying file directly.
+
+    import subprocess
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            while True:
+                data = f.read(_block_size)
+                if not data:
+                    break
+                p.stdin.write(data)
+        except (IOError, OSError, ValueError):
+            # The program died, or we are closing: stop feeding it.
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):  # pragma: no cover
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    def cleanup(finished):
+        if not finished:
+            p.kill()
+        p.wait()
+        feeder.join()
+        if finished and p.returncode != 0:
+            raise cliapp.AppException(
+                '%s failed with exit code %d' % (argv[0], p.returncode))
+
+    return p.stdout, cleanup
+
+
+class _DecompressingReader(io.RawIOBase):
+
+    '''Read the decompressed data of a file.'''
+
+    def __init__(self, f, fmt, closefd):
+        io.RawIOBase.__init__(self)
+        self._f = f
+        self._closefd = closefd
+        self._stream, self._cleanup = _decompressor(f, fmt)
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        # The compressed file: it tells the reader whether the data
+        # comes from a regular file, or arrives through a pipe.
+        return self._f.fileno()
+
+    def readinto(self, buf):
+        n = self._stream.readinto(buf)
+        self._finished = n == 0 and len(buf) > 0
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._stream.close()
+            if self._cleanup is not None:
+                self._cleanup(self._finished)
+        finally:
+            if self._closefd:
+                self._f.close()
+            io.RawIOBase.close(self)
+
+
+class _ReadAheadReader(io.RawIOBase):
+
+    '''Read a file in a background thread, ahead of the reader.'''
+
+    def __init__(self, f, depth, block_size, closefd):
+        io.RawIOBase.__init__(self)
+        self._f = f
+        self._block_size = block_size
+        self._closefd = closefd
+        self._queue = queue.Queue(depth)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._stopping = False
+        self._thread = threading.Thread(target=self._read_ahead)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def readinto(self, buf):
+        if not self._block and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._block = memoryview(item)
+            self._eof = not item
+        n = min(len(buf), len(self._block))
+        buf[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def _read_ahead(self):
+        # Run in the background thread: read blocks into the queue,
+        # until the end of the file, or an error.
+        while not self._stopping:
+            try:
+                item = self._f.read(self._block_size)
+            except Exception as e:
+                item = e
+            self._queue.put(item)
+            if not item or isinstance(item, Exception):
+                break
+
+    def close(self):
+        if self.closed:
+            return
+        self._stopping = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        try:
+            if self._closefd:
+                self._f.close()
+        finally:
+            io.RawIOBase.close(self)
@@ -0,0 +1,232 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import bz2
+import gzip
+import io
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+import os
+import subprocess
+import unittest
+
+import cliapp
+import cliapp.inputs
+
+
+no_zstd = cliapp.inputs._which('zstd') is None
+
+
+def binary_file(data):
+    return io.BufferedReader(io.BytesIO(data))
+
+
+def gzip_compress(data):
+    # gzip.compress does not exist on Python 2.
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+def zstd_compress(data):
+    p = subprocess.Popen(['zstd', '-cq'], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    out, _ = p.communicate(data)
+    return out
+
+
+class CompressionFormatTests(unittest.TestCase):
+
+    def test_recognizes_formats(self):
+        data = b'foo\n' * 10
+        self.assertEqual(
+            cliapp.inputs.compression_format(
+                binary_file(gzip_compress(data))),
+            'gzip')
+        self.assertEqual(
+            cliapp.inputs.compression_format(binary_file(bz2.compress(data))),
+            'bzip2')
+        self.assertEqual(
+            cliapp.inputs.compression_format(
+                binary_file(b'\xfd7zXZ\x00' + data)),
+            'xz')
+        self.assertEqual(
+            cliapp.inputs.compression_format(
+                binary_file(b'\x28\xb5\x2f\xfd' + data)),
+            'zstd')
+
+    def test_returns_none_for_uncompressed_data(self):
+        self.assertEqual(
+            cliapp.inputs.compression_format(binary_file(b'foo\n')), None)
+
+    def test_returns_none_for_empty_file(self):
+        self.assertEqual(
+            cliapp.inputs.compression_format(binary_file(b'')), None)
+
+    def test_returns_none_for_file_that_cannot_peek(self):
+        self.assertEqual(
+            cliapp.inputs.compression_format(io.BytesIO(b'\x1f\x8b')), None)
+
+    def test_does_not_consume_data(self):
+        f = binary_file(gzip_compress(b'foo'))
+        cliapp.inputs.compression_format(f)
+        self.assertEqual(f.read(2), b'\x1f\x8b')
+
+
+class OpenDecompressedTests(unittest.TestCase):
+
+    data = b''.join(b'line %d\n' % i for i in range(10000))
+
+    def decompress(self, compressed, fmt, background=False):
+        f = cliapp.inputs.open_decompressed(binary_file(compressed), fmt)
+        if background:
+            f = cliapp.inputs.read_ahead(f)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_decompresses_gzip(self):
+        self.assertEqual(
+            self.decompress(gzip_compress(self.data), 'gzip'), self.data)
+
+    def test_decompresses_concatenated_gzip(self):
+        compressed = gzip_compress(b'foo\n') + gzip_compress(b'bar\n')
+        self.assertEqual(self.decompress(compressed, 'gzip'), b'foo\nbar\n')
+
+    def test_decompresses_bzip2(self):
+        self.assertEqual(
+            self.decompress(bz2.compress(self.data), 'bzip2'), self.data)
+
+    @unittest.skipIf(lzma is None, 'no lzma module')
+    def test_decompresses_xz(self):
+        self.assertEqual(
+            self.decompress(lzma.compress(self.data), 'xz'), self.data)
+
+    @unittest.skipIf(no_zstd, 'no zstd program')
+    def test_decompresses_zstd(self):
+        self.assertEqual(
+            self.decompress(zstd_compress(self.data), 'zstd'), self.data)
+
+    @unittest.skipIf(no_zstd, 'no zstd program')
+    def test_reports_corrupt_zstd(self):
+        compressed = zstd_compress(self.data)
+        compressed = compressed[:len(compressed) // 2]
+        with self.assertRaises(cliapp.AppException):
+            self.decompress(compressed, 'zstd')
+
+    @unittest.skipIf(no_zstd, 'no zstd program')
+    def test_closes_zstd_before_end(self):
+        f = cliapp.inputs.open_decompressed(
+            binary_file(zstd_compress(self.data * 10)), 'zstd')
+        self.assertEqual(f.readline(), b'line 0\n')
+        f.close()
+
+    def test_decompresses_in_background(self):
+        self.assertEqual(
+            self.decompress(gzip_compress(self.data * 100), 'gzip',
+                            background=True),
+            self.data * 100)
+
+    def test_reports_corrupt_data_in_background(self):
+        with self.assertRaises(EOFError):
+            self.decompress(gzip_compress(self.data)[:-20], 'gzip',
+                            background=True)
+
+    def test_closes_background_reader_before_end(self):
+        f = cliapp.inputs.read_ahead(cliapp.inputs.open_decompressed(
+            binary_file(gzip_compress(self.data * 100)), 'gzip'))
+        self.assertEqual(f.readline(), b'line 0\n')
+        f.close()
+        self.assertTrue(f.closed)
+
+    def test_closes_compressed_file(self):
+        compressed = binary_file(gzip_compress(self.data))
+        f = cliapp.inputs.open_decompressed(compressed, 'gzip')
+        f.close()
+        self.assertTrue(compressed.closed)
+
+    def test_leaves_compressed_file_open_if_asked(self):
+        compressed = binary_file(gzip_compress(self.data))
+        f = cliapp.inputs.open_decompressed(compressed, 'gzip', closefd=False)
+        f.close()
+        self.assertFalse(compressed.closed)
+
+    def test_fileno_is_that_of_compressed_file(self):
+        rfd, wfd = os.pipe()
+        os.close(wfd)
+        with os.fdopen(rfd, 'rb') as compressed:
+            f = cliapp.inputs.open_decompressed(
+                compressed, 'gzip', closefd=False)
+            self.assertEqual(f.fileno(), rfd)
+            f.close()
+
+    def test_raises_error_for_unknown_format(self):
+        with self.assertRaises(cliapp.AppException):
+            cliapp.inputs.open_decompressed(binary_file(b''), 'foo')
+
+
+class ReadAheadTests(unittest.TestCase):
+
+    data = b''.join(b'line %d\n' % i for i in range(10000))
+
+    def test_reads_all_data(self):
+        f = cliapp.inputs.read_ahead(
+            binary_file(self.data), depth=2, block_size=1000)
+        self.assertEqual(f.readlines(), self.data.splitlines(True))
+        f.close()
+
+    def test_reads_empty_file(self):
+        f = cliapp.inputs.read_ahead(binary_file(b''))
+        self.assertEqual(f.read(), b'')
+        f.close()
+
+    def test_reports_read_error(self):
+
+        class Broken(io.RawIOBase):
+
+            def readable(self):
+                return True
+
+            def readinto(self, buf):
+                raise IOError('oops')
+
+        f = cliapp.inputs.read_ahead(Broken())
+        with self.assertRaises(IOError):
+            f.read()
+        f.close()
+
+    def test_closes_file_before_end(self):
+        data = binary_file(self.data)
+        f = cliapp.inputs.read_ahead(data, depth=1, block_size=10)
+        self.assertEqual(f.read(5), b'line ')
+        f.close()
+        self.assertTrue(data.closed)
+
+    def test_leaves_file_open_if_asked(self):
+        data = binary_file(self.data)
+        f = cliapp.inputs.read_ahead(data, closefd=False)
+        f.close()
+        self.assertFalse(data.closed)
+
+    def test_is_not_seekable(self):
+        f = cliapp.inputs.read_ahead(binary_file(self.data))
+        self.assertFalse(f.seekable())
+        f.close()
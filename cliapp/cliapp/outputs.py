@@ -0,0 +1,202 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Writing output files.
+
+``Application`` uses these for ``self.output``, when the output
+settings in the Performance group ask for more than a plain file.
+
+'''
+
+
+import io
+import os
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+import threading
+
+
+# How many writes of a full buffer the background thread may lag
+# behind, by default.
+_queue_depth = 4
+
+
+def open_output(raw, binary=False, buffer_size=io.DEFAULT_BUFFER_SIZE,
+                background=False, encoding=None, errors=None):
+    '''Return a file object for writing output to a raw file.
+
+    ``raw`` is an unbuffered binary file, such as an ``io.FileIO``
+    or an ``AtomicFile``. Output is collected into a buffer of
+    ``buffer_size`` bytes, and written to ``raw`` when the buffer
+    is full, or when the returned file is flushed or closed. With
+    ``background`` true, the writing happens in a background thread,
+    while the caller produces more output; errors from it are raised
+    by later writes, or by flushing or closing the file. The
+    returned file is binary if ``binary`` is true, and otherwise
+    text, encoded with ``encoding`` and ``errors``, as with
+    ``open``.
+
+    '''
+
+    if background:
+        f = _FlushingWriter(
+            _BackgroundWriter(raw, _queue_depth), buffer_size=buffer_size)
+    else:
+        f = io.BufferedWriter(raw, buffer_size=buffer_size)
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors)
+
+
+class AtomicFile(io.FileIO):
+
+    '''Write a file so that only all of it ever appears.
+
+    The data is written to a temporary file in the same directory as
+    ``name``. Calling ``commit`` closes it and renames it to
+    ``name``, replacing any existing file; ``discard`` closes and
+    removes it instead. Unless ``commit`` is called with ``sync``
+    false, the data and the rename are synced to disk, so that after
+    a crash the file has either the old or the new contents.
+
+    '''
+
+    def __init__(self, name):
+        import tempfile
+        dirname, basename = os.path.split(os.path.abspath(name))
+        fd, self.temp_name = tempfile.mkstemp(
+            dir=dirname, prefix='.%s.' % basename)
+        # mkstemp makes the file private; give it the permissions a
+        # new file would normally get.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0o666 & ~umask)
+        io.FileIO.__init__(self, fd, 'w')
+        self.target = name
+
+    def commit(self, sync=True):
+        if sync:
+            if self.closed:
+                _fsync_path(self.temp_name)
+            else:
+                os.fsync(self.fileno())
+        self.close()
+        os.rename(self.temp_name, self.target)
+        if sync:
+            try:
+                _fsync_path(os.path.dirname(os.path.abspath(self.target)))
+            except OSError:  # pragma: no cover
+                # Not all systems can sync a directory; the rename
+                # still happens, it may just not survive a crash.
+                pass
+
+    def discard(self):
+        self.close()
+        os.remove(self.temp_name)
+
+
+class _FlushingWriter(io.BufferedWriter):
+
+    '''A BufferedWriter whose flush also flushes the raw file.'''
+
+    def flush(self):
+        io.BufferedWriter.flush(self)
+        self.raw.flush()
+
+
+class _BackgroundWriter(io.RawIOBase):
+
+    '''Write to a raw file in a background thread.'''
+
+    def __init__(self, raw, depth):
+        io.RawIOBase.__init__(self)
+        self._raw = raw
+        self._queue = queue.Queue(depth)
+        self._error = None
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._write_behind)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def write(self, data):
+        self._raise_error()
+        if os.getpid() != self._pid:
+            # We've been forked, but the thread was not: write here.
+            _write_all(self._raw, data)
+        else:
+            self._queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        if os.getpid() == self._pid:
+            self._queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_behind(self):
+        # Run in the background thread. After an error, data is
+        # dropped until the error has been raised to the writer.
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    break
+                if self._error is None:
+                    _write_all(self._raw, data)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if os.getpid() == self._pid:
+                self._queue.put(None)
+                self._thread.join()
+            self._raise_error()
+        finally:
+            io.RawIOBase.close(self)
+            self._raw.close()
+
+
+def _fsync_path(pathname):
+    fd = os.open(pathname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_all(raw, data):
+    data = memoryview(data)
+    while data:
+        n = raw.write(data)
+        data = data[n:]
@@ -0,0 +1,217 @@
+# Copyright (C) 2018  Lars Wirzenius
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import io
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cliapp.outputs
+
+
+class RawBytes(io.RawIOBase):
+
+    '''A raw file that collects what is written to it.'''
+
+    def __init__(self, fail=False):
+        io.RawIOBase.__init__(self)
+        self.data = b''
+        self.fail = fail
+        self.writes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.fail:
+            raise IOError('oops')
+        self.data += bytes(data)
+        self.writes += 1
+        return len(data)
+
+
+class OpenOutputTests(unittest.TestCase):
+
+    def test_writes_text(self):
+        raw = RawBytes()
+        f = cliapp.outputs.open_output(raw, encoding='utf-8')
+        f.write(u'fooä\n')
+        f.close()
+        self.assertEqual(raw.data, u'fooä\n'.encode('utf-8'))
+
+    def test_writes_binary(self):
+        raw = RawBytes()
+        f = cliapp.outputs.open_output(raw, binary=True)
+        f.write(b'\xff')
+        f.close()
+        self.assertEqual(raw.data, b'\xff')
+
+    def test_buffers_output(self):
+        raw = RawBytes()
+        f = cliapp.outputs.open_output(raw, binary=True, buffer_size=1000)
+        for _ in range(100):
+            f.write(b'foo\n')
+        self.assertEqual(raw.writes, 0)
+        f.flush()
+        self.assertEqual(raw.writes, 1)
+        f.close()
+
+    def test_writes_in_background(self):
+        raw = RawBytes()
+        f = cliapp.outputs.open_output(
+            raw, binary=True, buffer_size=10, background=True)
+        for i in range(1000):
+            f.write(b'%d\n' % i)
+        f.flush()
+        self.assertEqual(raw.data, b''.join(b'%d\n' % i for i in range(1000)))
+        f.close()
+        self.assertTrue(raw.closed)
+
+    def test_reports_background_write_error(self):
+        f = cliapp.outputs.open_output(
+            RawBytes(fail=True), binary=True, background=True)
+        f.write(b'foo\n')
+        with self.assertRaises(IOError):
+            f.flush()
+        f.close()
+
+    def test_writes_directly_in_forked_child(self):
+        rfd, wfd = os.pipe()
+        f = cliapp.outputs.open_output(
+            io.FileIO(wfd, 'w'), binary=True, background=True)
+        f.write(b'parent\n')
+        f.flush()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            f.write(b'child\n')
+            f.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        f.close()
+        with os.fdopen(rfd, 'rb') as r:
+            self.assertEqual(r.read(), b'parent\nchild\n')
+
+
+class AtomicFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.name = os.path.join(self.tempdir, 'foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_commit_replaces_file(self):
+        with open(self.name, 'w') as f:
+            f.write('old')
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        with open(self.name) as old:
+            self.assertEqual(old.read(), 'old')
+        f.commit()
+        with open(self.name) as new:
+            self.assertEqual(new.read(), 'new')
+        self.assertEqual(os.listdir(self.tempdir), ['foo'])
+
+    def test_commit_after_close_works(self):
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        f.close()
+        f.commit()
+        self.assertEqual(os.listdir(self.tempdir), ['foo'])
+
+    def test_discard_removes_temporary_file(self):
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        f.discard()
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def fsynced(self, commit):
+        synced = []
+        fsync = os.fsync
+
+        def record(fd):
+            synced.append(os.fstat(fd).st_ino)
+            fsync(fd)
+
+        os.fsync = record
+        try:
+            commit()
+        finally:
+            os.fsync = fsync
+        return synced
+
+    def test_commit_syncs_file_and_directory(self):
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        synced = self.fsynced(f.commit)
+        self.assertEqual(
+            synced, [os.stat(self.name).st_ino, os.stat(self.tempdir).st_ino])
+
+    def test_commit_after_close_syncs_file(self):
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        f.close()
+        synced = self.fsynced(f.commit)
+        self.assertEqual(synced[0], os.stat(self.name).st_ino)
+
+    def test_commit_syncs_nothing_on_request(self):
+        f = cliapp.outputs.AtomicFile(self.name)
+        f.write(b'new')
+        self.assertEqual(self.fsynced(lambda: f.commit(sync=False)), [])
+        with open(self.name) as new:
+            self.assertEqual(new.read(), 'new')
+
+    def test_file_gets_permissions_of_new_file(self):
+        umask = os.umask(0o022)
+        try:
+            f = cliapp.outputs.AtomicFile(self.name)
+            f.commit()
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.name).st_mode), 0o644)
+
+
+class BrokenPipeTests(unittest.TestCase):
+
+    def test_exits_quietly_when_output_reader_goes_away(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        script = os.path.join(tempdir, 'app.py')
+        with open(script, 'w') as f:
+            f.write('\n'.join([
+                'import cliapp',
+                'class App(cliapp.Application):',
+                '    def process_args(self, args):',
+                '        for i in range(100000):',
+                '            self.output.write("%d\\n" % i)',
+                'App().run()',
+            ]))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(cliapp.outputs.__file__)))
+        for args in [[], ['--output-in-background',
+                          '--output-buffer-size=1M']]:
+            argv = ['sh', '-c', '"$0" "$@" | head -n1 >/dev/null',
+                    sys.executable, script, '--no-default-configs'] + args
+            p = subprocess.Popen(argv, stderr=subprocess.PIPE, env=env)
+            _, err = p.communicate()
+            self.assertEqual(err, b'')
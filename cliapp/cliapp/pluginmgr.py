@@ -26,8 +26,6 @@ other modules as well, such as unit tests, in the same locations.)
 '''
 
 
-import imp
-import inspect
 import os
 
 
@@ -126,6 +124,11 @@ class PluginManager(object):
     def load_plugin_file(self, pathname):
         '''Return plugin classes in a plugin file.'''
 
+        # Imported here, since they are slow to import, and only
+        # needed by programs that have plugins.
+        import imp
+        import inspect
+
         name, _ = os.path.splitext(os.path.basename(pathname))
         f = open(pathname, 'r')
         module = imp.load_module(name, f, pathname,
@@ -18,15 +18,33 @@
 
 import errno
 import fcntl
+import io
 import logging
+import mmap
 import os
-import select
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors34 as selectors
+import shutil
+import signal
 import subprocess
+import threading
 import time
 
 import cliapp
 
 
+# The selector class used to wait for pipeline I/O. DefaultSelector
+# picks the most efficient implementation available: epoll on Linux,
+# kqueue on BSD, and so on.
+_selector_class = selectors.DefaultSelector
+
+# Limits for the adaptive chunk size used for pipeline I/O.
+_min_io_size = 4096
+_max_io_size = 1024 ** 2
+
+
 def runcmd(argv, *args, **kwargs):
     '''Run external command or pipeline.
 
@@ -41,20 +59,389 @@ def runcmd(argv, *args, **kwargs):
 
     '''
 
-    our_options = (
-        ('ignore_fail', False),
-        ('log_error', True),
-    )
+    opts = _pop_options(kwargs, _check_options)
+    result = runcmd_unchecked(argv, *args, **kwargs)
+    exit_code, out, err = result[:3]
+    _check_exit_code(argv, exit_code, out, err, opts)
+    if len(result) > 3:
+        return out, result[3]
+    return out
+
+
+def runcmd_unchecked(argv, *argvs, **kwargs):
+    '''Run external command or pipeline.
+
+    Return the exit code, and contents of standard output and error
+    of the command.
+
+    Data is moved to and from the pipeline in chunks of at most
+    ``io_size`` bytes. By default, the chunk size starts small and
+    grows, up to 1 MiB, while reads and writes keep filling whole
+    chunks, so that commands with lots of output don't cost one
+    system call per kilobyte. Give ``io_size`` an integer value to
+    use a fixed chunk size instead.
+
+    To write the standard output of the command to a file instead of
+    returning it, give ``stdout_to`` a file descriptor or a pathname;
+    a named file is created or truncated. Unlike with ``stdout``,
+    the output still passes through the pipeline machinery, so
+    ``output_timeout`` sees it, but on Linux it is moved inside the
+    kernel with splice(2) and never copied into Python objects.
+    ``stdout_callback`` is not called for it.
+
+    Output is collected in memory, unless ``max_memory`` is set:
+    once the standard output or error of the command grows larger
+    than ``max_memory`` bytes, it is moved to an anonymous temporary
+    file in ``spill_dir`` (default is the usual temporary directory),
+    and returned as a read-only ``mmap.mmap`` object instead of a
+    byte string. An mmap object supports ``len``, slicing, ``find``,
+    ``read``, ``readline``, and can be given to ``bytes`` or
+    anything else that accepts a buffer.
+
+    With ``stats=True``, return a ``PipelineStats`` object as a
+    fourth value, with the CPU time, peak memory use, and wall clock
+    time of each command, and the amount of data fed to and read from
+    the pipeline. ``runcmd`` then returns the output and the stats.
+
+    With ``launcher='posix_spawn'``, the commands are started with
+    ``os.posix_spawnp`` instead of ``subprocess.Popen``. This avoids
+    the cost of forking a process that uses a lot of memory, and of
+    closing file descriptors one by one, but the only other keyword
+    argument allowed is ``env``, and file descriptors the caller has
+    made inheritable are not closed in the commands. It requires
+    Python 3.8 or later. (On Linux, Python 3.10 and later already
+    use vfork in ``subprocess.Popen``, so the difference is smaller
+    there.)
+
+    See also ``runcmd``.
+
+    '''
+
+    capture = _pop_options(kwargs, _capture_options)
+    out = _OutputBuffer(capture['max_memory'], capture['spill_dir'])
+    err = _OutputBuffer(capture['max_memory'], capture['spill_dir'])
+    for kind, data in _runcmd_events([argv] + list(argvs), kwargs):
+        if kind == 'stdout':
+            out.append(data)
+        elif kind == 'stderr':
+            err.append(data)
+        elif kind == 'stats':
+            stats = data
+        else:
+            exit_code = data
+    if capture['stats']:
+        return exit_code, out.getvalue(), err.getvalue(), stats
+    return exit_code, out.getvalue(), err.getvalue()
+
+
+def runcmd_iter(argv, *argvs, **kwargs):
+    '''Run external command or pipeline, iterating over its output.
+
+    Example: ``for line in runcmd_iter(['find', '/']): ...``
+
+    Return an iterator over the standard output of the command. The
+    output is given to the caller as it arrives, instead of being
+    collected in memory. With ``mode='lines'`` (the default), each
+    item is one line, including the newline, except possibly the
+    last one; with ``mode='chunks'``, each item is a chunk of bytes
+    as it was read from the pipe.
+
+    The standard error output is collected, obeying ``max_memory``
+    and ``spill_dir`` like ``runcmd_unchecked`` does. When the
+    iterator is exhausted, its ``exit_code``, ``stderr``, and
+    ``stats`` (a ``PipelineStats``) attributes are set; ``stats`` is
+    set whether or not ``stats=True`` was given.
+    If the exit code is non-zero, ``cliapp.AppException`` is raised,
+    like ``runcmd`` does; the ``ignore_fail`` and ``log_error``
+    arguments work the same way. Other arguments are as for
+    ``runcmd_unchecked``.
+
+    If the caller stops iterating early, the iterator's ``close``
+    method terminates the pipeline. This also happens when the
+    iterator is garbage collected.
+
+    '''
+
+    mode = kwargs.pop('mode', 'lines')
+    if mode not in ('lines', 'chunks'):
+        raise cliapp.AppException('Unknown runcmd_iter mode %s' % mode)
+    opts = _pop_options(kwargs, _check_options)
+    capture = _pop_options(kwargs, _capture_options)
+    events = _runcmd_events([argv] + list(argvs), kwargs)
+    return _OutputIterator(argv, events, mode, opts, capture)
+
+
+def runcmd_many(jobs, max_workers=None, ordered=True, fail_fast=False,
+                **kwargs):
+    '''Run many external commands or pipelines concurrently.
+
+    Example: ``for i, exit_code, out, err in runcmd_many(
+    [['gzip', '-t', name] for name in filenames], max_workers=8): ...``
+
+    Each job is an argv list for a single command, or a list of argv
+    lists for a pipeline. At most ``max_workers`` jobs run at the
+    same time; the default is the number of CPUs. All running jobs
+    are handled by one event loop in the calling thread, not by a
+    thread each. Other keyword arguments are as for
+    ``runcmd_unchecked``, and apply to every job.
+
+    Return an iterator of ``(index, exit_code, out, err)`` tuples,
+    where ``index`` is the position of the job in ``jobs``; with
+    ``stats=True``, a ``PipelineStats`` is added to each. Results
+    come in the order of ``jobs``, or, with ``ordered=False``, in the
+    order the jobs finish. Jobs are started as results are consumed.
+
+    Jobs that fail are reported with their exit code, unless
+    ``fail_fast`` is true: then the first failing job makes
+    ``runcmd_many`` terminate the jobs that are running, not start
+    any more, and raise ``cliapp.AppException``.
+
+    A job that times out (see ``output_timeout``) is terminated, so
+    that it does not keep running next to the ``max_workers`` others.
+
+    '''
+
+    if max_workers is None:
+        max_workers = _cpu_count()
+    if max_workers < 1:
+        raise cliapp.AppException('runcmd_many: max_workers must be >= 1')
+    capture = _pop_options(kwargs, _capture_options)
+    jobs = ((index, _job_argvs(job), kwargs)
+            for index, job in enumerate(jobs))
+    return _run_many(jobs, max_workers, ordered, fail_fast, capture)
+
+
+def _job_argvs(job):
+    # A job is an argv, or a list of them.
+    if job and isinstance(job[0], (list, tuple)):
+        return list(job)
+    return [job]
+
+
+def _cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # pragma: no cover
+        return 1
+
+
+def _run_many(jobs, max_workers, ordered, fail_fast, capture):
+    # Run jobs, given as (index, argvs, kwargs) triples, where kwargs
+    # are for _start_pipeline.
+
+    selector = _selector_class()
+    states = {}
+    running = []
+    reaping = []
+    finished = {}
+    next_index = 0
+
+    try:
+        while True:
+            while len(states) < max_workers:
+                try:
+                    index, argvs, kwargs = next(jobs)
+                except StopIteration:
+                    break
+                pipeline = _start_pipeline(argvs, dict(kwargs))
+                pipeline.start(selector)
+                out = _OutputBuffer(
+                    capture['max_memory'], capture['spill_dir'])
+                err = _OutputBuffer(
+                    capture['max_memory'], capture['spill_dir'])
+                states[pipeline] = (index, argvs, out, err)
+                running.append(pipeline)
+
+            if not states:
+                break
+
+            now = time.time()
+            for pipeline in running[:]:
+                remaining = pipeline.timeout_remaining(now)
+                if remaining is not None and remaining <= 0:
+                    pipeline.on_timeout()
+                if not pipeline.active:
+                    running.remove(pipeline)
+                    reaping.append(pipeline)
+
+            reaped = False
+            for pipeline in reaping[:]:
+                if pipeline.timed_out:
+                    pipeline.terminate()
+                elif not pipeline.poll():
+                    continue
+                reaped = True
+                reaping.remove(pipeline)
+                pipeline.close()
+                index, argvs, out, err = states.pop(pipeline)
+                result = (index, pipeline.exit_code,
+                          out.getvalue(), err.getvalue())
+                if capture['stats']:
+                    result += (pipeline.stats,)
+                if fail_fast:
+                    _check_exit_code(argvs[0], result[1], result[2],
+                                     result[3], {'ignore_fail': False,
+                                                 'log_error': True})
+                if ordered:
+                    finished[index] = result
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+                else:
+                    yield result
+
+            if reaped:
+                # Start more jobs, if there are any left, before
+                # waiting for anything.
+                continue
+
+            timeout = _reap_interval if reaping else None
+            for pipeline in running:
+                remaining = pipeline.timeout_remaining(now)
+                if remaining is not None:
+                    if timeout is None or remaining < timeout:
+                        timeout = remaining
+
+            if timeout is not None:
+                timeout = max(0, timeout)
+            for key, _ in selector.select(timeout):
+                pipeline = key.data[0]
+                event = pipeline.handle(key)
+                if event is not None:
+                    kind, data = event
+                    _, _, out, err = states[pipeline]
+                    if kind == 'stdout':
+                        out.append(data)
+                    else:
+                        err.append(data)
+    finally:
+        for pipeline in states:
+            pipeline.close()
+        selector.close()
+
+
+class _OutputIterator(object):
+
+    '''Iterator returned by runcmd_iter.'''
+
+    def __init__(self, argv, events, mode, opts, capture):
+        self.exit_code = None
+        self.stderr = None
+        self.stats = None
+        self._argv = argv
+        self._events = events
+        self._opts = opts
+        self._capture = capture
+        if mode == 'lines':
+            self._items = self._lines()
+        else:
+            self._items = self._chunks()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    next = __next__
+
+    def close(self):
+        self._items.close()
+        self._events.close()
+
+    def _chunks(self):
+        err = _OutputBuffer(
+            self._capture['max_memory'], self._capture['spill_dir'])
+        for kind, data in self._events:
+            if kind == 'stdout':
+                yield data
+            elif kind == 'stderr':
+                err.append(data)
+            elif kind == 'stats':
+                self.stats = data
+            else:
+                self.exit_code = data
+        self.stderr = err.getvalue()
+        _check_exit_code(
+            self._argv, self.exit_code, b'', self.stderr, self._opts)
+
+    def _lines(self):
+        # Pieces of a line for which no newline has been seen yet.
+        partial = []
+        for data in self._chunks():
+            end = data.find(b'\n') + 1
+            if end == 0:
+                partial.append(data)
+                continue
+            partial.append(data[:end])
+            yield b''.join(partial)
+            start = end
+            end = data.find(b'\n', start) + 1
+            while end > 0:
+                yield data[start:end]
+                start = end
+                end = data.find(b'\n', start) + 1
+            partial = [data[start:]]
+        last = b''.join(partial)
+        if last:
+            yield last
+
+
+# Options for runcmd and runcmd_iter, and their default values.
+_check_options = (
+    ('ignore_fail', False),
+    ('log_error', True),
+)
+
+
+def _noop(_):
+    pass
+
+
+# Options for what runcmd_unchecked and friends collect and return.
+_capture_options = (
+    ('max_memory', None),
+    ('spill_dir', None),
+    ('stats', False),
+)
+
+
+# Options for running pipelines, and their default values. Anything
+# else given to runcmd_unchecked is passed on to subprocess.Popen.
+_pipeline_options = (
+    ('feed_stdin', ''),
+    ('stdin', subprocess.PIPE),
+    ('stdout', subprocess.PIPE),
+    ('stderr', subprocess.PIPE),
+    ('stdout_callback', _noop),
+    ('stderr_callback', _noop),
+    ('output_timeout', None),
+    ('timeout_callback', None),
+    ('io_size', None),
+    ('stdout_to', None),
+    ('launcher', 'popen'),
+)
+
+
+def _pop_options(kwargs, our_options):
+    '''Remove our_options from kwargs, return them as a dict.'''
+
     opts = {}
     for name, default in our_options:
         opts[name] = default
         if name in kwargs:
             opts[name] = kwargs[name]
             del kwargs[name]
+    return opts
 
-    exit_code, out, err = runcmd_unchecked(argv, *args, **kwargs)
+
+def _check_exit_code(argv, exit_code, out, err, opts, exit_codes=None):
     if exit_code != 0:
-        msg = 'Command failed: %s\n%s\n%s' % (' '.join(argv), out, err)
+        command = ' '.join(argv)
+        if exit_codes is not None and len(exit_codes) > 1:
+            command += ' (exit codes: %s)' % ' '.join(map(str, exit_codes))
+        msg = 'Command failed: %s\n%s\n%s' % (
+            command, _message_output(out), _message_output(err))
         if opts['ignore_fail']:
             if opts['log_error']:
                 logging.info(msg)
@@ -62,59 +449,81 @@ def runcmd(argv, *args, **kwargs):
             if opts['log_error']:
                 logging.error(msg)
             raise cliapp.AppException(msg)
-    return out
 
 
-def runcmd_unchecked(argv, *argvs, **kwargs):
-    '''Run external command or pipeline.
+# How much of output that has spilled to disk goes in error messages.
+_max_message_output = 4096
 
-    Return the exit code, and contents of standard output and error
-    of the command.
 
-    See also ``runcmd``.
+def _message_output(output):
+    '''Return output, or a bounded prefix of it if it was spilled.'''
+
+    if not isinstance(output, mmap.mmap):
+        return output
+    if len(output) <= _max_message_output:
+        return bytes(output[:])
+    return bytes(output[:_max_message_output]) + (
+        b'... (%d bytes in total)' % len(output))
+
+
+def _runcmd_events(argvs, kwargs):
+    '''Run pipeline, generate its output as events.
+
+    The events are pairs. ``('stdout', data)`` and ``('stderr',
+    data)`` are output from the pipeline, and the last event is
+    ``('exit', exit_code)``, right after ``('stats', stats)``.
 
     '''
 
-    argvs = [argv] + list(argvs)
-    logging.debug('run external command: %r', argvs)
+    events = _iter_pipeline(_start_pipeline(argvs, kwargs))
+    next(events)  # Wait for 'started'.
+    return events
 
-    def pop_kwarg(name, default):
-        if name in kwargs:
-            value = kwargs[name]
-            del kwargs[name]
-            return value
-        else:
-            return default
 
-    def noop(_):
-        pass
+def _start_pipeline(argvs, kwargs):
+    '''Start a pipeline, return it as a _Pipeline.'''
+
+    logging.debug('run external command: %r', argvs)
+    opts = _pop_options(kwargs, _pipeline_options)
+    started = time.time()
+
+    stdout_to = opts['stdout_to']
+    stdout_to_fd = None
+    if stdout_to is not None:
+        if opts['stdout'] != subprocess.PIPE:
+            raise cliapp.AppException(
+                'runcmd: stdout and stdout_to cannot both be used')
+        if isinstance(stdout_to, int):
+            stdout_to_fd = stdout_to
+        else:
+            stdout_to_fd = os.open(
+                stdout_to, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
 
-    feed_stdin = pop_kwarg('feed_stdin', '')
-    pipe_stdin = pop_kwarg('stdin', subprocess.PIPE)
-    pipe_stdout = pop_kwarg('stdout', subprocess.PIPE)
-    pipe_stderr = pop_kwarg('stderr', subprocess.PIPE)
-    stdout_callback = pop_kwarg('stdout_callback', noop)
-    stderr_callback = pop_kwarg('stderr_callback', noop)
-    output_timeout = pop_kwarg('output_timeout', None)
-    timeout_callback = pop_kwarg('timeout_callback', None)
+    if opts['launcher'] == 'popen':
+        build = _build_pipeline
+    elif opts['launcher'] == 'posix_spawn':
+        build = _spawn_pipeline
+    else:
+        raise cliapp.AppException(
+            'runcmd: unknown launcher %r' % opts['launcher'])
 
     try:
-        pipeline = _build_pipeline(argvs,
-                                   pipe_stdin,
-                                   pipe_stdout,
-                                   pipe_stderr,
-                                   kwargs)
-        return _run_pipeline(pipeline, feed_stdin, pipe_stdin,
-                             pipe_stdout, pipe_stderr,
-                             stdout_callback, stderr_callback,
-                             output_timeout, timeout_callback)
+        procs = build(argvs,
+                      opts['stdin'],
+                      opts['stdout'],
+                      opts['stderr'],
+                      kwargs)
     except OSError as e:  # pragma: no cover
+        if stdout_to_fd is not None and stdout_to_fd != stdout_to:
+            os.close(stdout_to_fd)
         if e.errno == errno.ENOENT and e.filename is None:
-            e.filename = argv[0]
+            e.filename = argvs[0][0]
             raise e
         else:
             raise
 
+    return _Pipeline(argvs, procs, opts, stdout_to_fd, started)
+
 
 def _build_pipeline(argvs, pipe_stdin, pipe_stdout, pipe_stderr, kwargs):
     procs = []
@@ -163,121 +572,774 @@ def _build_pipeline(argvs, pipe_stdin, pipe_stdout, pipe_stderr, kwargs):
     return procs
 
 
-def _run_pipeline(procs, feed_stdin, pipe_stdin, pipe_stdout, pipe_stderr,
-                  stdout_callback, stderr_callback, output_timeout,
-                  timeout_callback):
+def _spawn_pipeline(argvs, pipe_stdin, pipe_stdout, pipe_stderr, kwargs):
+    # Like _build_pipeline, but with os.posix_spawnp, which avoids
+    # copying the page tables of the parent process, and closing
+    # every file descriptor one by one in the child. The pipes we
+    # make are not inheritable, so only the ones we dup2 in place
+    # end up in the commands.
 
-    stdout_eof = False
-    stderr_eof = False
-    out = []
-    err = []
-    pos = 0
-    io_size = 1024
-    latest_output = time.time()
-    timeout_quit = False
-    timeout = False
+    env = kwargs.pop('env', None)
+    if kwargs:
+        raise cliapp.AppException(
+            'runcmd: posix_spawn launcher does not support %s' %
+            ', '.join(sorted(kwargs)))
+    if env is None:
+        env = os.environ
 
-    def set_nonblocking(fd):
-        flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
-        flags = flags | os.O_NONBLOCK
-        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    procs = []
+    # File descriptors we've opened in the parent only for the
+    # commands to inherit.
+    to_close = []
+
+    def child_fd(what, parent_mode, child_end):
+        # Return the fd the command should get for stdin, stdout, or
+        # stderr, and our end of the pipe, if we made one.
+        if what == subprocess.PIPE:
+            rfd, wfd = os.pipe()
+            if child_end == 0:
+                to_close.append(rfd)
+                return rfd, os.fdopen(wfd, parent_mode)
+            to_close.append(wfd)
+            return wfd, os.fdopen(rfd, parent_mode)
+        if what == subprocess.DEVNULL:
+            fd = os.open(os.devnull, os.O_RDWR)
+            to_close.append(fd)
+            return fd, None
+        if what is None or isinstance(what, int):
+            return what, None
+        return what.fileno(), None
 
-    if feed_stdin and pipe_stdin == subprocess.PIPE:
-        set_nonblocking(procs[0].stdin.fileno())
-    if pipe_stdout == subprocess.PIPE:
-        set_nonblocking(procs[-1].stdout.fileno())
-    if pipe_stderr == subprocess.PIPE:
-        set_nonblocking(procs[-1].stderr.fileno())
-
-    def still_running():
-        for p in procs:
-            p.poll()
-        for p in procs:
-            if p.returncode is None:
-                return True
-        if pipe_stdout == subprocess.PIPE and not stdout_eof:
-            return True  # pragma: no cover
-        if pipe_stderr == subprocess.PIPE and not stderr_eof:
-            return True  # pragma: no cover
-        return False
-
-    while not timeout_quit and still_running():
-        rlist = []
-        if not stdout_eof and pipe_stdout == subprocess.PIPE:
-            rlist.append(procs[-1].stdout)
-        if not stderr_eof and pipe_stderr == subprocess.PIPE:
-            rlist.append(procs[-1].stderr)
-
-        wlist = []
-        if pipe_stdin == subprocess.PIPE and pos < len(feed_stdin):
-            wlist.append(procs[0].stdin)
-
-        if rlist or wlist:
-            try:
-                r, w, _ = select.select(rlist, wlist, [], output_timeout)
-            except select.error as e:  # pragma: no cover
-                if e.args[0] == errno.EINTR:
-                    break
-                raise
+    try:
+        stderr_fd, stderr_pipe = None, None
+        if pipe_stderr != subprocess.STDOUT:
+            stderr_fd, stderr_pipe = child_fd(pipe_stderr, 'rb', 1)
+
+        stdin_fd, stdin_pipe = child_fd(pipe_stdin, 'wb', 0)
+        for i, argv in enumerate(argvs):
+            if i == len(argvs) - 1:
+                stdout_fd, stdout_pipe = child_fd(pipe_stdout, 'rb', 1)
+            else:
+                next_stdin, stdout_fd = os.pipe()
+                to_close.extend([stdout_fd, next_stdin])
+                stdout_pipe = None
+
+            actions = []
+            for fd, target in [(stdin_fd, 0), (stdout_fd, 1)]:
+                if fd is not None:
+                    actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+            if pipe_stderr == subprocess.STDOUT:
+                actions.append((os.POSIX_SPAWN_DUP2, 1, 2))
+            elif stderr_fd is not None:
+                actions.append((os.POSIX_SPAWN_DUP2, stderr_fd, 2))
+
+            # Python ignores SIGPIPE, and the commands would inherit
+            # that; subprocess.Popen resets these too.
+            pid = os.posix_spawnp(
+                argv[0], argv, env, file_actions=actions,
+                setsigdef=[signal.SIGPIPE, signal.SIGXFSZ])
+            procs.append(_SpawnedProcess(pid, stdin_pipe, stdout_pipe))
+            stdin_pipe = None
+            if i != len(argvs) - 1:
+                stdin_fd = next_stdin
+    finally:
+        # Only the commands must hold their ends of the pipes, so that
+        # they get EOF and SIGPIPE correctly.
+        for fd in to_close:
+            os.close(fd)
+
+    procs[-1].stderr = stderr_pipe
+    return procs
+
+
+class _SpawnedProcess(object):
+
+    '''A process started by _spawn_pipeline.
+
+    This has the parts of the subprocess.Popen interface that
+    _Pipeline uses.
+
+    '''
+
+    def __init__(self, pid, stdin, stdout):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = None
+        self.returncode = None
+
+    def poll(self):  # pragma: no cover
+        # _Pipeline reaps the process itself, so this only gets
+        # called if something else did.
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+def _iter_pipeline(pipeline):
+    # Drive a single pipeline with a selector of its own. The first
+    # event is ('started', None), to let the caller know the finally
+    # clause below will take care of cleaning up.
+
+    selector = _selector_class()
+    try:
+        pipeline.start(selector)
+        yield 'started', None
+
+        while pipeline.active:
+            timeout = pipeline.timeout_remaining(time.time())
+            if timeout is not None and timeout <= 0:
+                pipeline.on_timeout()
+                continue
+            for key, _ in selector.select(timeout):
+                event = pipeline.handle(key)
+                if event is not None:
+                    yield event
+
+        pipeline.wait()
+    finally:
+        pipeline.close()
+        selector.close()
+
+    yield 'stats', pipeline.stats
+    yield 'exit', pipeline.exit_code
+
+
+# How to find out that a child process has exited, without waiting
+# for each process in turn: 'pidfd' uses os.pidfd_open (Linux 5.3 and
+# later), 'sigchld' a SIGCHLD handler that writes to a pipe, and 'poll'
+# checks every _reap_interval seconds. None means the first one that
+# works here. If pidfd_open fails, because the kernel is too old, or a
+# seccomp filter (such as in a container) forbids it, 'sigchld' is used
+# instead from then on.
+_child_watch = None
+
+# How often, in seconds, to check if processes have exited, when
+# _child_watch is 'poll'.
+_reap_interval = 0.01
+
+
+def _child_watch_method():
+    global _child_watch
+    if _child_watch is None:
+        if hasattr(os, 'pidfd_open'):
+            _child_watch = 'pidfd'
         else:
-            break  # Let's not busywait waiting for processes to die.
-
-        now = time.time()
-        time_since_output = now - latest_output
-        timeout = (output_timeout is not None and
-                   time_since_output >= output_timeout)
-
-        if procs[0].stdin in w and pos < len(feed_stdin):
-            data = feed_stdin[pos:pos + io_size]
-            procs[0].stdin.write(data)
-            pos += len(data)
-            if pos >= len(feed_stdin):
-                procs[0].stdin.close()
-
-        if procs[-1].stdout in r:
-            data = procs[-1].stdout.read(io_size)
-            if data:
-                data_new = stdout_callback(data)
-                if data_new is None:
-                    data_new = data
-                out.append(data_new)
+            _child_watch = 'sigchld'  # pragma: no cover
+    if _child_watch == 'sigchld':
+        # Signal handlers can only be set in the main thread.
+        if not _in_main_thread():
+            return 'poll'  # pragma: no cover
+    return _child_watch
+
+
+def _in_main_thread():
+    main_thread = getattr(threading, 'main_thread', None)
+    if main_thread is None:  # pragma: no cover
+        # Python 2.
+        return isinstance(threading.current_thread(), threading._MainThread)
+    return threading.current_thread() is main_thread()
+
+
+# Write ends of pipes that _on_sigchld writes to: one for every
+# pipeline that waits for SIGCHLD. Our handler is installed only while
+# there are any, so that SIGCHLD does not interrupt system calls
+# elsewhere in the program.
+_sigchld_fds = set()
+
+# The SIGCHLD handler we replaced, if any.
+_previous_sigchld = None
+
+
+def _on_sigchld(signum, frame):
+    for fd in list(_sigchld_fds):
+        try:
+            os.write(fd, b'x')
+        except OSError:  # pragma: no cover
+            # The pipe is full, or has just been closed: either way,
+            # there is no need for another wakeup.
+            pass
+    if callable(_previous_sigchld):
+        _previous_sigchld(signum, frame)  # pragma: no cover
+
+
+def _install_sigchld_handler():
+    # Something else, such as asyncio, may have set its own handler
+    # since we last set ours. Set ours again, but keep calling theirs.
+    global _previous_sigchld
+    previous = signal.getsignal(signal.SIGCHLD)
+    if previous is not _on_sigchld:
+        _previous_sigchld = previous
+        signal.signal(signal.SIGCHLD, _on_sigchld)
+        # Restart system calls the signal interrupts, where the
+        # system can; the pipe wakes up our selector anyway.
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+
+def _restore_sigchld_handler():
+    # Put back the handler we replaced, once no pipeline needs ours,
+    # unless someone has set another one since.
+    global _previous_sigchld
+    if _sigchld_fds or signal.getsignal(signal.SIGCHLD) is not _on_sigchld:
+        return
+    previous = _previous_sigchld
+    _previous_sigchld = None
+    if previous is None:  # pragma: no cover
+        # It was not set from Python.
+        previous = signal.SIG_DFL
+    signal.signal(signal.SIGCHLD, previous)
+
+
+class _Pipeline(object):
+
+    '''A running pipeline, and the pipes we use to talk to it.
+
+    The pipes are registered with a selector, which may be shared with
+    other pipelines. The caller waits for the selector, and gives each
+    ready key that belongs to this pipeline to ``handle``. So that
+    processes are reaped as soon as they exit, the pipeline also
+    registers a file descriptor that becomes readable when that
+    happens (see ``_child_watch``). Once ``active`` is false, the
+    processes only need to be waited for, which is a no-op unless the
+    output timed out or there was no way to watch the processes.
+
+    '''
+
+    def __init__(self, argvs, procs, opts, stdout_to_fd, started):
+        self.procs = procs
+        self.opts = opts
+        self.timed_out = False
+        self.stats = PipelineStats(argvs, [p.pid for p in procs])
+        self._started = started
+        self._stdout_to_fd = stdout_to_fd
+        self._stdin = procs[0].stdin
+        self._stdout = procs[-1].stdout
+        self._stderr = procs[-1].stderr
+        self._selector = None
+        self._registered = []
+        self._watchers = []
+        self._feed = None
+        self._pos = 0
+        self._mover = None
+        self._finished = False
+        self.latest_output = time.time()
+
+        # With no explicit io_size, start with small chunks, so that
+        # commands with little output stay cheap, and double the size
+        # every time a chunk is filled completely.
+        self._io_size = opts['io_size']
+        self._adaptive = self._io_size is None
+        if self._adaptive:
+            self._io_size = _min_io_size
+
+    def start(self, selector):
+        '''Register our pipes with selector.'''
+
+        self._selector = selector
+        opts = self.opts
+
+        if opts['stdin'] == subprocess.PIPE:
+            if opts['feed_stdin']:
+                # Slicing a memoryview does not copy the data being fed.
+                self._feed = memoryview(opts['feed_stdin'])
+                self._register(self._stdin, selectors.EVENT_WRITE,
+                               ('stdin', None))
             else:
-                stdout_eof = True
-            timeout = False
-
-        if procs[-1].stderr in r:
-            data = procs[-1].stderr.read(io_size)
-            if data:
-                data_new = stderr_callback(data)
-                if data_new is None:
-                    data_new = data
-                err.append(data_new)
+                self._stdin.close()
+        if opts['stdout'] == subprocess.PIPE:
+            if self._stdout_to_fd is None:
+                self._register(self._stdout, selectors.EVENT_READ,
+                               ('stdout', opts['stdout_callback']))
             else:
-                stderr_eof = True
-            timeout = False
+                self._mover = _DataMover(
+                    self._stdout.fileno(), self._stdout_to_fd)
+                self._register(self._stdout, selectors.EVENT_READ,
+                               ('stdout_to', None))
+        if opts['stderr'] == subprocess.PIPE:
+            self._register(self._stderr, selectors.EVENT_READ,
+                           ('stderr', opts['stderr_callback']))
+        self._watch_processes()
+
+    def _register(self, f, events, data):
+        flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFL, 0)
+        flags = flags | os.O_NONBLOCK
+        fcntl.fcntl(f.fileno(), fcntl.F_SETFL, flags)
+        self._selector.register(f, events, (self, data))
+        self._registered.append(f)
+
+    def _unregister(self, f):
+        self._selector.unregister(f)
+        self._registered.remove(f)
+
+    def _watch_processes(self):
+        global _child_watch
+        method = _child_watch_method()
+        if method == 'pidfd':
+            for i, p in enumerate(self.procs):
+                # The pid stays valid until we reap the process, so
+                # this can't refer to some other process.
+                try:
+                    fd = os.pidfd_open(p.pid)
+                except OSError as e:
+                    if e.errno not in (errno.ENOSYS, errno.EPERM):
+                        raise  # pragma: no cover
+                    _child_watch = 'sigchld'
+                    for fd in list(self._watchers):
+                        self._unwatch(fd)
+                    self._watch_processes()
+                    return
+                self._watch(fd, ('exit', i))
+        elif method == 'sigchld':
+            _install_sigchld_handler()
+            rfd, wfd = os.pipe()
+            for fd in (rfd, wfd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._sigchld_wfd = wfd
+            _sigchld_fds.add(wfd)
+            self._watch(rfd, ('sigchld', None))
+            # The processes may have exited before the handler was
+            # set, so check now, instead of waiting for a signal
+            # that never comes.
+            self._reap_some()
+
+    def _watch(self, fd, data):
+        self._selector.register(fd, selectors.EVENT_READ, (self, data))
+        self._watchers.append(fd)
+
+    def _unwatch(self, fd):
+        self._selector.unregister(fd)
+        self._watchers.remove(fd)
+        os.close(fd)
+        if self._sigchld_wfd is not None:
+            _sigchld_fds.discard(self._sigchld_wfd)
+            os.close(self._sigchld_wfd)
+            self._sigchld_wfd = None
+            _restore_sigchld_handler()
+
+    _sigchld_wfd = None
+
+    def _reap_some(self):
+        # Reap the processes that have exited. Stop watching when all
+        # have.
+        if self.poll():
+            for fd in self._watchers[:]:
+                self._unwatch(fd)
+
+    @property
+    def io_done(self):
+        '''Are we done with all the pipes?'''
+        return not self._registered
+
+    @property
+    def active(self):
+        '''Is there still something for the selector to tell us?'''
+        return bool(self._registered or self._watchers)
+
+    def timeout_remaining(self, now):
+        '''Return seconds until output times out, or None for never.'''
+        if self.opts['output_timeout'] is None or self.io_done:
+            return None
+        return self.latest_output + self.opts['output_timeout'] - now
+
+    def on_timeout(self):  # pragma: no cover
+        '''There has been no output for output_timeout seconds.
+
+        Call timeout_callback, if any. Unless it returns a false value,
+        stop doing I/O with the pipeline.
+
+        '''
+
+        callback = self.opts['timeout_callback']
+        if callback is None or callback():
+            self.timed_out = True
+            for f in self._registered[:]:
+                self._unregister(f)
+            for fd in self._watchers[:]:
+                self._unwatch(fd)
+        else:
+            self.latest_output = time.time()
+
+    def _grow(self, n):
+        if self._adaptive and n == self._io_size:
+            self._io_size = min(self._io_size * 2, _max_io_size)
+
+    def handle(self, key):
+        '''Handle a ready key from the selector.
+
+        Return an event ``(kind, data)`` for output that the caller
+        should see, or None.
+
+        '''
 
-        if timeout and timeout_callback:  # pragma: no cover
-            result = timeout_callback()
-            if result:
-                timeout_quit = True
-        elif timeout:  # pragma: no cover
-            timeout_quit = True
+        f = key.fileobj
+        kind, callback = key.data[1]
 
-    while not timeout and still_running():
-        for p in procs:
-            if p.returncode is None:
-                p.wait()
+        if kind == 'stdin':
+            self._write_stdin()
+            return None
 
-    errorcodes = [p.returncode for p in procs if p.returncode != 0] or [0]
+        if kind == 'exit':
+            _, i = key.data[1]
+            self._reap(i, False)
+            self._unwatch(f)
+            return None
+
+        if kind == 'sigchld':
+            try:
+                while os.read(f, 4096):  # pragma: no branch
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise  # pragma: no cover
+            self._reap_some()
+            return None
+
+        if kind == 'stdout_to':
+            n = self._mover.move(self._io_size)
+            if n is None:
+                return None  # pragma: no cover
+            self.latest_output = time.time()
+            if n == 0:
+                self._unregister(f)
+            self._grow(n)
+            self.stats.stdout_bytes += n
+            return None
+
+        try:
+            data = os.read(f.fileno(), self._io_size)
+        except OSError as e:  # pragma: no cover
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        self.latest_output = time.time()
+        if not data:
+            self._unregister(f)
+            return None
+        self._grow(len(data))
+        if kind == 'stdout':
+            self.stats.stdout_bytes += len(data)
+        else:
+            self.stats.stderr_bytes += len(data)
+        data_new = callback(data)
+        if data_new is None:
+            data_new = data
+        return kind, data_new
+
+    def _write_stdin(self):
+        feed = self._feed
+        pos = self._pos
+        try:
+            n = os.write(self._stdin.fileno(), feed[pos:pos + self._io_size])
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return  # pragma: no cover
+            if e.errno != errno.EPIPE:
+                raise  # pragma: no cover
+            # The first process does not want any more input.
+            n = len(feed) - pos
+        else:
+            self.stats.stdin_bytes += n
+        self._pos += n
+        if self._pos >= len(feed):
+            self._unregister(self._stdin)
+            self._stdin.close()
+        else:
+            self._grow(n)
 
-    # Ensure that the pipeline doesn't leak file descriptors
-    if procs[0].stdin is not None:
-        procs[0].stdin.close()
-    if procs[-1].stderr is not None:
-        procs[-1].stderr.close()
-    if procs[-1].stdout is not None:
-        procs[-1].stdout.close()
-    return errorcodes[-1], b''.join(out), b''.join(err)
+    def _reap(self, i, block):
+        '''Reap process i, if it has finished. Return true if so.
+
+        We reap with wait4 rather than Popen.wait, to get the resource
+        usage of the process.
+
+        '''
+
+        p = self.procs[i]
+        if p.returncode is not None:
+            return True
+        while True:
+            try:
+                pid, status, rusage = os.wait4(
+                    p.pid, 0 if block else os.WNOHANG)
+                break
+            except OSError as e:  # pragma: no cover
+                if e.errno == errno.EINTR:
+                    # A signal arrived; Python 2 doesn't retry.
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Someone else reaped the process already.
+                p.poll()
+                return p.returncode is not None
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        self.stats.processes[i].set_usage(
+            p.returncode, rusage, time.time() - self._started)
+        return True
+
+    def poll(self):
+        '''Return true if all processes have finished.'''
+        for i in range(len(self.procs)):
+            if not self._reap(i, False):
+                return False
+        self._finished = True
+        return True
+
+    def wait(self):
+        '''Wait for all processes to finish.
+
+        If output timed out, don't wait, just see if they have.
+
+        '''
+
+        for i in range(len(self.procs)):
+            self._reap(i, not self.timed_out)
+        self._finished = True
+
+    def terminate(self):
+        '''Terminate the processes that are still running, and reap.'''
+        for i, p in enumerate(self.procs):
+            if not self._reap(i, False):
+                p.terminate()
+                self._reap(i, True)
+        self._finished = True
+
+    @property
+    def exit_code(self):
+        procs = self.procs
+        errorcodes = [p.returncode for p in procs if p.returncode != 0]
+        return (errorcodes or [0])[-1]
+
+    def close(self):
+        '''Release all resources.
+
+        If the pipeline has not finished, terminate it.
+
+        '''
+
+        for f in self._registered[:]:
+            self._unregister(f)
+        for fd in self._watchers[:]:
+            self._unwatch(fd)
+
+        # Ensure that the pipeline doesn't leak file descriptors
+        for f in (self._stdin, self._stdout, self._stderr):
+            if f is not None:
+                f.close()
+        if self._stdout_to_fd not in (None, self.opts['stdout_to']):
+            os.close(self._stdout_to_fd)
+
+        if not self._finished:
+            # The caller stopped before the pipeline finished. Don't
+            # leave the processes running.
+            self.terminate()
+
+        self.stats.wall_time = time.time() - self._started
+
+
+class ProcessStats(object):
+
+    '''Resource usage of one process in a pipeline.
+
+    The times are in seconds. ``max_rss`` is the peak resident set
+    size, in the unit ``getrusage(2)`` uses on the platform (KiB on
+    Linux). ``wall_time`` is from starting the pipeline to seeing
+    the process exit.
+
+    '''
+
+    def __init__(self, argv, pid):
+        self.argv = argv
+        self.pid = pid
+        self.exit_code = None
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.max_rss = 0
+        self.wall_time = 0.0
+
+    def set_usage(self, exit_code, rusage, wall_time):
+        self.exit_code = exit_code
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss
+        self.wall_time = wall_time
+
+
+class PipelineStats(object):
+
+    '''Resource usage of a pipeline run by runcmd.
+
+    ``processes`` has a ``ProcessStats`` for each command in the
+    pipeline. The byte counts are for data fed to the standard input
+    of the first command, and read from the standard output of the
+    last one and from the standard error output of all of them.
+
+    '''
+
+    def __init__(self, argvs, pids):
+        self.processes = [ProcessStats(argv, pid)
+                          for argv, pid in zip(argvs, pids)]
+        self.stdin_bytes = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.wall_time = 0.0
+
+
+class CommandTotals(object):
+
+    '''Total resource usage of all runs of one command.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.user_time = 0.0
+        self.system_time = 0.0
+        self.wall_time = 0.0
+        self.max_rss = 0
+
+
+class StatsCounter(object):
+
+    '''Aggregate resource usage of external commands.
+
+    Usage is summed up per command name (the basename of argv[0]):
+    ``commands`` is a dict of names to ``CommandTotals``. The byte
+    counts are totals over all pipelines.
+
+    '''
+
+    def __init__(self):
+        self.commands = {}
+        self.stdin_bytes = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    def add(self, stats):
+        '''Add a PipelineStats to the totals.'''
+
+        for proc in stats.processes:
+            name = os.path.basename(proc.argv[0])
+            if name not in self.commands:
+                self.commands[name] = CommandTotals(name)
+            total = self.commands[name]
+            total.runs += 1
+            total.user_time += proc.user_time
+            total.system_time += proc.system_time
+            total.wall_time += proc.wall_time
+            total.max_rss = max(total.max_rss, proc.max_rss)
+        self.stdin_bytes += stats.stdin_bytes
+        self.stdout_bytes += stats.stdout_bytes
+        self.stderr_bytes += stats.stderr_bytes
+
+    def report(self):
+        '''Return totals as lines of text, most CPU time first.'''
+
+        totals = sorted(self.commands.values(),
+                        key=lambda t: t.user_time + t.system_time,
+                        reverse=True)
+        return ['%s: runs=%d user=%.3fs system=%.3fs wall=%.3fs '
+                'max_rss=%d' %
+                (t.name, t.runs, t.user_time, t.system_time, t.wall_time,
+                 t.max_rss)
+                for t in totals]
+
+
+class _OutputBuffer(object):
+
+    '''Collect output from a pipeline.
+
+    Output is kept in memory until there is more than max_memory
+    bytes of it, and after that in an anonymous temporary file.
+
+    '''
+
+    def __init__(self, max_memory=None, spill_dir=None):
+        self._max_memory = max_memory
+        self._spill_dir = spill_dir
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def append(self, data):
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._max_memory is not None and self._size > self._max_memory:
+            import tempfile
+            self._file = tempfile.TemporaryFile(dir=self._spill_dir)
+            for chunk in self._chunks:
+                self._file.write(chunk)
+            self._chunks = []
+
+    def getvalue(self):
+        '''Return the output as bytes, or as an mmap if it was spilled.'''
+        if self._file is None:
+            return b''.join(self._chunks)
+        self._file.flush()
+        m = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._file.close()
+        return m
+
+
+class _DataMover(object):
+
+    '''Move data from a pipe to another file descriptor.
+
+    On Linux, with Python 3.10 or later, this uses splice(2), and
+    the data never gets copied into Python objects. Otherwise, or if
+    the kernel refuses to splice to the target (for example, because
+    it was opened in append mode), it reads into a reusable buffer
+    and writes from there.
+
+    '''
+
+    def __init__(self, from_fd, to_fd):
+        self._from_fd = from_fd
+        self._to_fd = to_fd
+        self._use_splice = hasattr(os, 'splice')
+        self._buffer = None
+        self._reader = None
+
+    def move(self, size):
+        '''Move at most size bytes.
+
+        Return number of bytes moved, 0 at end of file, or None if
+        there was nothing to read after all.
+
+        '''
+
+        if self._use_splice:
+            try:
+                return os.splice(self._from_fd, self._to_fd, size,
+                                 flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:  # pragma: no cover
+                return None
+            except OSError as e:  # pragma: no cover
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self._use_splice = False
+        return self._read_and_write(size)
+
+    def _read_and_write(self, size):
+        if self._buffer is None or len(self._buffer) < size:
+            self._buffer = bytearray(size)
+            self._reader = io.FileIO(self._from_fd, 'rb', closefd=False)
+        view = memoryview(self._buffer)[:size]
+        n = self._reader.readinto(view)
+        if n:
+            done = 0
+            while done < n:
+                done += os.write(self._to_fd, view[done:n])
+        return n
 
 
 def shell_quote(s):
@@ -301,7 +1363,7 @@ def shell_quote(s):
     return ''.join(quoted)
 
 
-def ssh_runcmd(target, argv, **kwargs):  # pragma: no cover
+def ssh_runcmd(target, argv, *argvs, **kwargs):
     '''Run command in argv on remote host target.
 
     This is similar to runcmd, but the command is run on the remote
@@ -309,6 +1371,13 @@ def ssh_runcmd(target, argv, **kwargs):  # pragma: no cover
     array are automatically quoted so they get passed to the other
     side correctly.
 
+    Like with runcmd, further argv arrays make a pipeline, for
+    example ``ssh_runcmd('host', ['find', '/'], ['wc', '-l'])``. The
+    whole pipeline runs in a single remote sh(1), with its standard
+    error output sent back to us. The exit code is that of the last
+    command that failed, and if any did, the error message shows the
+    exit code of each command.
+
     An optional ``tty=`` parameter can be passed to ``ssh_runcmd`` in
     order to force or disable pseudo-tty allocation. This is often
     required to run ``sudo`` on another machine and might be useful
@@ -339,12 +1408,126 @@ def ssh_runcmd(target, argv, **kwargs):  # pragma: no cover
     Invoke env(1) explicitly to pass in the variables you need to
     exist on the other end.
 
-    Pipelines are not supported.
+    To run the command over an existing connection, give an
+    ``SshSession`` for the target as ``session``. Its ``ssh_options``
+    are used too.
+
+    See also ``ssh_runcmd_unchecked``.
 
     '''
 
+    opts = _pop_options(kwargs, _check_options)
+    kwargs['exit_codes'] = True
+    local_argv, result = _ssh_run(target, [argv] + list(argvs), kwargs)
+    exit_code, out, err, exit_codes = result[:4]
+    _check_exit_code(local_argv, exit_code, out, err, opts, exit_codes)
+    if len(result) > 4:
+        return out, result[4]
+    return out
+
+
+def ssh_runcmd_unchecked(target, argv, *argvs, **kwargs):
+    '''Run command or pipeline on remote host target.
+
+    This is like runcmd_unchecked, but the commands run on the remote
+    machine, as with ssh_runcmd. With ``exit_codes=True``, a list of
+    the exit code of each command in the pipeline is returned as a
+    fourth value, before the ``stats``, if any. If ssh fails, the
+    list only has the exit code of ssh. So does it, if the pipeline's
+    standard error output is not captured (``stderr`` is not
+    ``subprocess.PIPE``), or it runs with ``tty=True``, since the
+    exit codes of the commands come back with it; the exit code is
+    still that of the last command that failed.
+
+    '''
+
+    return _ssh_run(target, [argv] + list(argvs), kwargs)[1]
+
+
+# Start of the line with the exit codes of a remote pipeline, which
+# the pipeline adds to its standard error output.
+_exit_codes_marker = 'cliapp-exit-codes:'
+
+
+def _ssh_run(target, argvs, kwargs):
+    # Run argvs on target, return the local argv we used, and what
+    # ssh_runcmd_unchecked returns.
+
+    want_exit_codes = kwargs.pop('exit_codes', False)
+    marker = None
+    if len(argvs) == 1:
+        local_argv = _ssh_argv(target, argvs[0], kwargs)
+    else:
+        # The exit codes of the commands can only be told apart from
+        # their error messages if we capture them, and a tty would
+        # mix them into the output.
+        if (kwargs.get('stderr', subprocess.PIPE) == subprocess.PIPE and
+                not kwargs.get('tty')):
+            import uuid
+            marker = '%s%s' % (_exit_codes_marker, uuid.uuid4().hex)
+        local_argv = _ssh_argv(
+            target, ['sh', '-c', _remote_pipeline(argvs, marker)], kwargs)
+
+    result = runcmd_unchecked(local_argv, **kwargs)
+    exit_code, out, err = result[:3]
+    exit_codes = [exit_code]
+    if len(argvs) > 1:
+        pos = -1 if marker is None else err.rfind(marker.encode())
+        if pos != -1:
+            words = err[pos + len(marker):].split()
+            err = err[:pos]
+            exit_codes = [int(code) for _, code in
+                          sorted(zip(map(int, words[::2]), words[1::2]))]
+            exit_code = ([code for code in exit_codes if code != 0] or
+                         [0])[-1]
+        local_argv = local_argv[:local_argv.index('--') + 1]
+        for i, argv in enumerate(argvs):
+            if i > 0:
+                local_argv.append('|')
+            local_argv.extend(map(shell_quote, argv))
+
+    result = (exit_code, out, err) + result[3:]
+    if want_exit_codes:
+        result = result[:3] + (exit_codes,) + result[3:]
+    return local_argv, result
+
+
+def _remote_pipeline(argvs, marker):
+    # Return a sh script to run argvs as a pipeline, and exit with
+    # the exit code of the last command that failed, or 0. Unless
+    # marker is None, also write the exit code of each command to
+    # stderr at the end, after marker, as pairs of index and exit
+    # code. The exit codes come out of the pipeline via file
+    # descriptor 3, which the commands themselves don't get; file
+    # descriptor 4 is the real stdout.
+    stages = []
+    for i, argv in enumerate(argvs):
+        command = ' '.join(map(shell_quote, argv))
+        stages.append('{ %s 3>&- 4>&-; echo "%d $?" >&3; }' % (command, i))
+    script = ('exec 4>&1; '
+              's=$({ %s; } 3>&1 >&4 4>&-); '
+              'exec 4>&-; ' % ' | '.join(stages))
+    if marker is not None:
+        script += 'printf "%%s%%s" %s "$s" >&2; ' % marker
+    script += ('c=0; '
+               'for i in %s; do '
+               'x=$(printf "%%s\\n" "$s" | sed -n "s/^$i //p"); '
+               'case "$x" in ""|0) ;; *) c=$x ;; esac; '
+               'done; '
+               'exit $c' % ' '.join(str(i) for i in range(len(argvs))))
+    return script
+
+
+def _ssh_argv(target, argv, kwargs):
+    # Return the local argv for ssh_runcmd, removing the options
+    # only it knows about from kwargs.
+
     ssh_argv = ['ssh']
 
+    session = kwargs.pop('session', None)
+    if session is not None:
+        ssh_argv.extend(session.client_options())
+
     tty = kwargs.pop('tty', None)
     if tty:
         ssh_argv.append('-tt')
@@ -364,5 +1547,183 @@ def ssh_runcmd(target, argv, **kwargs):  # pragma: no cover
             '-',
             remote_cwd])))
 
-    local_argv = ssh_argv + list(map(shell_quote, argv))
-    return runcmd(local_argv, **kwargs)
+    return ssh_argv + list(map(shell_quote, argv))
+
+
+def ssh_runcmd_many(targets, argv, max_parallel=10, callback=None,
+                    **kwargs):
+    '''Run command in argv on many remote hosts concurrently.
+
+    Example: ``for target, exit_code, out, err in ssh_runcmd_many(
+    hosts, ['uptime'], max_parallel=20): ...``
+
+    This is like ``ssh_runcmd`` for every host in ``targets``, with
+    at most ``max_parallel`` ssh processes at a time, all handled by
+    one event loop in the calling thread, as with ``runcmd_many``.
+    Other keyword arguments are as for ``ssh_runcmd`` and
+    ``runcmd_unchecked``, and apply to every host.
+
+    Return an iterator of ``(target, exit_code, out, err)`` tuples, in
+    the order the hosts finish; with ``stats=True``, a
+    ``PipelineStats`` is added to each. A host where the command fails
+    is reported with its exit code; no exception is raised.
+
+    To see output while the commands run, give a ``callback``. It
+    gets called as ``callback(target, kind, data)`` for every chunk
+    of output, where kind is ``'stdout'`` or ``'stderr'``.
+
+    With ``output_timeout``, a host that has not produced any output
+    for that many seconds is given up on: its ssh process is
+    terminated (unless ``timeout_callback`` returns a false value),
+    and it is reported with an exit code of ``-signal.SIGTERM``.
+
+    '''
+
+    if max_parallel < 1:
+        raise cliapp.AppException(
+            'ssh_runcmd_many: max_parallel must be >= 1')
+    capture = _pop_options(kwargs, _capture_options)
+    targets = list(targets)
+
+    def jobs():
+        for index, target in enumerate(targets):
+            job_kwargs = dict(kwargs)
+            local_argv = _ssh_argv(target, argv, job_kwargs)
+            if callback is not None:
+                for kind in ('stdout', 'stderr'):
+                    name = '%s_callback' % kind
+                    job_kwargs[name] = _stream_output(
+                        callback, target, kind, job_kwargs.get(name, _noop))
+            yield index, [local_argv], job_kwargs
+
+    results = _run_many(jobs(), max_parallel, False, False, capture)
+    return ((targets[result[0]],) + result[1:] for result in results)
+
+
+def _stream_output(callback, target, kind, output_callback):
+    # Return an output callback for ssh_runcmd_many, which passes on
+    # what output_callback returns to callback.
+
+    def stream(data):
+        data_new = output_callback(data)
+        callback(target, kind, data if data_new is None else data_new)
+        return data_new
+
+    return stream
+
+
+class SshSession(object):
+
+    '''A shared connection to a remote host, for ssh_runcmd.
+
+    Every ssh_runcmd call normally starts a new ssh connection, which
+    costs a TCP handshake, key exchange, and authentication. A session
+    starts an ssh master process (see ControlMaster in ssh_config(5))
+    the first time it is used, and every command run via the session
+    reuses its connection. Call ``close`` when done. If the caller
+    never does, the master process exits on its own after ``persist``
+    seconds of not being used.
+
+    '''
+
+    def __init__(self, target, ssh_options=None, persist=300):
+        self.target = target
+        self.ssh_options = list(ssh_options or [])
+        self.persist = persist
+        self._control_dir = None
+
+    @property
+    def control_path(self):
+        '''Pathname of the master's socket, or None if not open.'''
+        if self._control_dir is None:
+            return None
+        return os.path.join(self._control_dir, 'control')
+
+    def open(self):
+        '''Start the master process, unless it is running already.'''
+
+        if self._control_dir is not None:
+            return
+        import tempfile
+        self._control_dir = tempfile.mkdtemp(prefix='cliapp-ssh-')
+        argv = (['ssh',
+                 '-oControlMaster=yes',
+                 '-oControlPath=%s' % self.control_path,
+                 '-oControlPersist=%d' % self.persist,
+                 '-N', '-f'] +
+                self.ssh_options + [self.target])
+        # The master process keeps running in the background with our
+        # stdout and stderr, so it must not get our pipes: we would
+        # wait for it to close them.
+        with tempfile.TemporaryFile() as f:
+            exit_code, _, _ = runcmd_unchecked(argv, stdout=f, stderr=f)
+            if exit_code != 0:
+                f.seek(0)
+                err = f.read()
+                self._remove_control_dir()
+                raise cliapp.AppException(
+                    'Could not connect to %s: %s' %
+                    (self.target, err.decode('utf-8', 'replace').strip()))
+
+    def client_options(self):
+        '''Return options for ssh to use the session's connection.'''
+        self.open()
+        return (['-oControlMaster=no',
+                 '-oControlPath=%s' % self.control_path] +
+                self.ssh_options)
+
+    def runcmd(self, argv, *argvs, **kwargs):
+        '''Like ssh_runcmd, but over this session.'''
+        return ssh_runcmd(self.target, argv, *argvs, session=self, **kwargs)
+
+    def close(self):
+        '''Stop the master process, if it is running.'''
+
+        if self._control_dir is None:
+            return
+        argv = (['ssh', '-oControlPath=%s' % self.control_path,
+                 '-O', 'exit'] +
+                self.ssh_options + [self.target])
+        exit_code, _, err = runcmd_unchecked(argv)
+        if exit_code != 0:  # pragma: no cover
+            logging.warning(
+                'Could not close ssh connection to %s: %s',
+                self.target, err.decode('utf-8', 'replace').strip())
+        self._remove_control_dir()
+
+    def _remove_control_dir(self):
+        shutil.rmtree(self._control_dir, ignore_errors=True)
+        self._control_dir = None
+
+
+class SshSessionPool(object):
+
+    '''A set of SshSession objects, one per target and options.
+
+    Sessions are opened when first needed. ``close`` closes all of
+    them.
+
+    '''
+
+    def __init__(self, persist=300):
+        self.persist = persist
+        self.sessions = {}
+
+    def get(self, target, ssh_options=None):
+        '''Return the session for target and ssh_options.'''
+        key = (target, tuple(ssh_options or []))
+        if key not in self.sessions:
+            self.sessions[key] = SshSession(
+                target, ssh_options=ssh_options, persist=self.persist)
+        return self.sessions[key]
+
+    def ssh_runcmd(self, target, argv, *argvs, **kwargs):
+        '''Like ssh_runcmd, but over a session from the pool.'''
+        session = self.get(target, kwargs.pop('ssh_options', None))
+        return session.runcmd(argv, *argvs, **kwargs)
+
+    def close(self):
+        '''Close all sessions.'''
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
@@ -17,14 +17,27 @@
 
 from __future__ import unicode_literals
 
+import errno
+import importlib
+import mmap
 import os
+import resource
+import shutil
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import cliapp
 
 
+# The cliapp.runcmd attribute is the function, not the module.
+runcmd_module = importlib.import_module('cliapp.runcmd')
+
+
 def devnull(msg):
     pass
 
@@ -161,6 +174,548 @@ class RuncmdTests(unittest.TestCase):
         self.assertNotEqual(err, '')
         self.assertEqual(b''.join(msgs), err)
 
+    def test_runcmd_grows_io_size_when_there_is_lots_of_output(self):
+        sizes = []
+        data = b'x' * (4 * 1024 ** 2)
+        out = cliapp.runcmd(['cat'], feed_stdin=data,
+                            stdout_callback=lambda s: sizes.append(len(s)))
+        self.assertEqual(out, data)
+        self.assertTrue(max(sizes) > 4096)
+
+    def test_runcmd_obeys_fixed_io_size(self):
+        sizes = []
+        data = b'x' * (1024 ** 2)
+        out = cliapp.runcmd(['cat'], feed_stdin=data, io_size=512,
+                            stdout_callback=lambda s: sizes.append(len(s)))
+        self.assertEqual(out, data)
+        self.assertEqual(max(sizes), 512)
+
+    def test_runcmd_writes_stdout_to_named_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        data = b'x' * (1024 ** 2)
+        self.assertEqual(
+            cliapp.runcmd_unchecked(['cat'], feed_stdin=data,
+                                    stdout_to=filename),
+            (0, b'', b''))
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        os.remove(filename)
+
+    def test_runcmd_writes_stdout_to_file_descriptor(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, b'foo\n')
+        cliapp.runcmd(['echo', 'bar'], stdout_to=fd)
+        os.write(fd, b'baz\n')
+        os.close(fd)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), b'foo\nbar\nbaz\n')
+        os.remove(filename)
+
+    def test_runcmd_writes_stdout_to_file_in_append_mode(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        data = b'x' * (1024 ** 2)
+        cliapp.runcmd(['cat'], feed_stdin=data, stdout_to=fd)
+        os.close(fd)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        os.remove(filename)
+
+    def test_runcmd_refuses_both_stdout_and_stdout_to(self):
+        fd = os.open('/dev/null', os.O_WRONLY)
+        self.assertRaises(cliapp.AppException, cliapp.runcmd, ['true'],
+                          stdout=fd, stdout_to='/dev/null')
+        os.close(fd)
+
+    def test_runcmd_keeps_small_output_in_memory(self):
+        self.assertEqual(
+            cliapp.runcmd_unchecked(['echo', 'foo'], max_memory=1024),
+            (0, b'foo\n', b''))
+
+    def test_runcmd_spills_large_output_to_disk(self):
+        data = b'foo\n' * (1024 ** 2)
+        out = cliapp.runcmd(['cat'], feed_stdin=data, max_memory=1024)
+        self.assertTrue(isinstance(out, mmap.mmap))
+        self.assertEqual(len(out), len(data))
+        self.assertEqual(out[:], data)
+        self.assertEqual(out.readline(), b'foo\n')
+        out.close()
+
+    def test_runcmd_spills_large_stderr_to_given_directory(self):
+        dirname = tempfile.mkdtemp()
+        exit_code, out, err = cliapp.runcmd_unchecked(
+            ['sh', '-c', 'echo foo; yes | head -c 10000 1>&2'],
+            max_memory=1024, spill_dir=dirname)
+        os.rmdir(dirname)
+        self.assertEqual((exit_code, out), (0, b'foo\n'))
+        self.assertTrue(isinstance(err, mmap.mmap))
+        self.assertEqual(err[:], b'y\n' * 5000)
+
+    def test_runcmd_error_shows_start_of_spilled_output(self):
+        try:
+            cliapp.runcmd(['sh', '-c', 'yes | head -c 10000 1>&2; false'],
+                          max_memory=1024, log_error=False)
+        except cliapp.AppException as e:
+            msg = str(e)
+        self.assertFalse('mmap' in msg)
+        self.assertTrue(msg.count('y') > 1000)
+        self.assertTrue('(10000 bytes in total)' in msg)
+        self.assertTrue(len(msg) < 10000)
+
+    def test_runcmd_reports_missing_spill_directory(self):
+        self.assertRaises(OSError, cliapp.runcmd, ['cat'],
+                          feed_stdin=b'x' * 10000, max_memory=1024,
+                          spill_dir='/does/not/exist')
+
+    def test_runcmd_closes_stdin_pipe_when_nothing_to_feed(self):
+        self.assertEqual(cliapp.runcmd(['cat']), b'')
+
+    def test_runcmd_stops_feeding_stdin_when_command_exits(self):
+        data = b'x' * (10 * 1024 ** 2)
+        self.assertEqual(cliapp.runcmd_unchecked(['true'], feed_stdin=data),
+                         (0, b'', b''))
+
+    def test_runcmd_handles_file_descriptors_above_fd_setsize(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2048 <= hard or hard == resource.RLIM_INFINITY:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (2048, hard))
+        fds = []
+        try:
+            fd = os.open('/dev/null', os.O_RDONLY)
+            fds.append(fd)
+            while fd < 1100:
+                fd = os.dup(fds[0])
+                fds.append(fd)
+            self.assertEqual(
+                cliapp.runcmd(['cat'], ['cat'], feed_stdin=b'hello'),
+                b'hello')
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+class RuncmdStatsTests(unittest.TestCase):
+
+    def test_runcmd_unchecked_returns_no_stats_by_default(self):
+        self.assertEqual(len(cliapp.runcmd_unchecked(['true'])), 3)
+
+    def test_runcmd_unchecked_returns_stats_for_each_process(self):
+        exit_code, out, err, stats = cliapp.runcmd_unchecked(
+            ['cat'], ['sh', '-c', 'cat; echo x 1>&2'],
+            feed_stdin=b'hello', stats=True)
+        self.assertEqual((exit_code, out, err), (0, b'hello', b'x\n'))
+        self.assertTrue(isinstance(stats, cliapp.PipelineStats))
+        self.assertEqual([p.argv[0] for p in stats.processes],
+                         ['cat', 'sh'])
+        self.assertEqual([p.exit_code for p in stats.processes], [0, 0])
+        self.assertEqual(stats.stdin_bytes, 5)
+        self.assertEqual(stats.stdout_bytes, 5)
+        self.assertEqual(stats.stderr_bytes, 2)
+        for p in stats.processes:
+            self.assertTrue(p.pid > 0)
+            self.assertTrue(p.max_rss > 0)
+            self.assertTrue(0 <= p.wall_time <= stats.wall_time)
+
+    def test_stats_count_cpu_time(self):
+        _, stats = cliapp.runcmd(
+            ['sh', '-c', 'i=0; while [ $i -lt 200000 ]; do i=$((i+1)); done'],
+            stats=True)
+        proc = stats.processes[0]
+        self.assertTrue(proc.user_time + proc.system_time > 0)
+
+    def test_stats_count_bytes_written_with_stdout_to(self):
+        _, _, _, stats = cliapp.runcmd_unchecked(
+            ['echo', 'foo'], stdout_to='/dev/null', stats=True)
+        self.assertEqual(stats.stdout_bytes, 4)
+
+    def test_runcmd_sees_process_killed_by_signal(self):
+        exit_code, _, _ = cliapp.runcmd_unchecked(['sh', '-c', 'kill -9 $$'])
+        self.assertEqual(exit_code, -9)
+
+    def test_runcmd_iter_sets_stats(self):
+        output = cliapp.runcmd_iter(['echo', 'foo'])
+        self.assertEqual(output.stats, None)
+        list(output)
+        self.assertEqual(output.stats.stdout_bytes, 4)
+
+    def test_runcmd_many_returns_stats(self):
+        results = list(cliapp.runcmd_many([['true'], ['false']], stats=True))
+        self.assertEqual([r[4].processes[0].exit_code for r in results],
+                         [0, 1])
+
+
+class StatsCounterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = cliapp.StatsCounter()
+
+    def make_stats(self, argv, user_time, max_rss):
+        stats = cliapp.PipelineStats([argv], [123])
+        stats.processes[0].user_time = user_time
+        stats.processes[0].max_rss = max_rss
+        stats.stdout_bytes = 10
+        return stats
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.counter.commands, {})
+        self.assertEqual(self.counter.report(), [])
+
+    def test_sums_up_usage_per_command_name(self):
+        self.counter.add(self.make_stats(['/bin/gzip', '-d'], 1.0, 100))
+        self.counter.add(self.make_stats(['gzip'], 2.0, 300))
+        self.counter.add(self.make_stats(['cat'], 0.5, 200))
+        gzip = self.counter.commands['gzip']
+        self.assertEqual(gzip.runs, 2)
+        self.assertEqual(gzip.user_time, 3.0)
+        self.assertEqual(gzip.max_rss, 300)
+        self.assertEqual(self.counter.stdout_bytes, 30)
+
+    def test_reports_most_expensive_command_first(self):
+        self.counter.add(self.make_stats(['cat'], 0.5, 200))
+        self.counter.add(self.make_stats(['gzip'], 2.0, 300))
+        report = self.counter.report()
+        self.assertTrue(report[0].startswith('gzip: runs=1 '))
+        self.assertTrue(report[1].startswith('cat: runs=1 '))
+
+
+class RuncmdIterTests(unittest.TestCase):
+
+    def test_yields_lines(self):
+        lines = list(cliapp.runcmd_iter(['printf', 'foo\\nbar\\nbaz']))
+        self.assertEqual(lines, [b'foo\n', b'bar\n', b'baz'])
+
+    def test_yields_lines_split_across_chunks(self):
+        data = b''.join(b'%d\n' % i for i in range(100000))
+        lines = list(cliapp.runcmd_iter(['cat'], feed_stdin=data,
+                                        io_size=100))
+        self.assertEqual(b''.join(lines), data)
+        self.assertEqual(len(lines), 100000)
+        self.assertTrue(all(line.endswith(b'\n') for line in lines))
+
+    def test_yields_chunks(self):
+        data = b'x' * (1024 ** 2)
+        chunks = list(cliapp.runcmd_iter(['cat'], feed_stdin=data,
+                                         mode='chunks', io_size=1024))
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual(max(len(chunk) for chunk in chunks), 1024)
+
+    def test_rejects_unknown_mode(self):
+        self.assertRaises(cliapp.AppException, cliapp.runcmd_iter,
+                          ['true'], mode='words')
+
+    def test_sets_exit_code_and_stderr_at_end(self):
+        output = cliapp.runcmd_iter(['sh', '-c', 'echo foo; echo bar 1>&2'])
+        self.assertEqual(output.exit_code, None)
+        self.assertEqual(list(output), [b'foo\n'])
+        self.assertEqual(output.exit_code, 0)
+        self.assertEqual(output.stderr, b'bar\n')
+
+    def test_raises_error_on_failure(self):
+        output = cliapp.runcmd_iter(['sh', '-c', 'echo foo; false'],
+                                    log_error=False)
+        self.assertEqual(next(output), b'foo\n')
+        self.assertRaises(cliapp.AppException, next, output)
+        self.assertEqual(output.exit_code, 1)
+
+    def test_ignores_failure_on_request(self):
+        output = cliapp.runcmd_iter(['false'], ignore_fail=True)
+        self.assertEqual(list(output), [])
+        self.assertEqual(output.exit_code, 1)
+
+    def test_accepts_capture_options(self):
+        output = cliapp.runcmd_iter(['echo', 'foo'], stats=True,
+                                    max_memory=1024, spill_dir='.')
+        self.assertEqual(list(output), [b'foo\n'])
+        self.assertEqual(output.stats.stdout_bytes, 4)
+
+    def test_spills_large_stderr_to_disk(self):
+        output = cliapp.runcmd_iter(
+            ['sh', '-c', 'echo foo; cat 1>&2'],
+            feed_stdin=b'x' * (1024 ** 2), max_memory=1024)
+        self.assertEqual(list(output), [b'foo\n'])
+        self.assertTrue(isinstance(output.stderr, mmap.mmap))
+        self.assertEqual(output.stderr[:], b'x' * (1024 ** 2))
+
+    def test_close_terminates_pipeline(self):
+        output = cliapp.runcmd_iter(['yes'], ['cat'])
+        self.assertEqual(next(output), b'y\n')
+        output.close()
+        self.assertEqual(list(output), [])
+
+
+class RuncmdManyTests(unittest.TestCase):
+
+    def sleep_and_echo(self, n):
+        return ['sh', '-c', 'sleep 0.%d; echo %d' % (5 - n, n)]
+
+    def test_returns_nothing_for_no_jobs(self):
+        self.assertEqual(list(cliapp.runcmd_many([])), [])
+
+    def test_returns_results_in_input_order(self):
+        jobs = [self.sleep_and_echo(i) for i in range(5)]
+        self.assertEqual(
+            list(cliapp.runcmd_many(jobs, max_workers=5)),
+            [(i, 0, b'%d\n' % i, b'') for i in range(5)])
+
+    def test_returns_results_in_completion_order(self):
+        jobs = [self.sleep_and_echo(i) for i in range(5)]
+        results = list(cliapp.runcmd_many(jobs, max_workers=5,
+                                          ordered=False))
+        self.assertEqual([index for index, _, _, _ in results],
+                         [4, 3, 2, 1, 0])
+
+    def test_runs_jobs_concurrently(self):
+        started = time.time()
+        list(cliapp.runcmd_many([['sleep', '0.5']] * 20, max_workers=20))
+        self.assertTrue(time.time() - started < 5)
+
+    def test_runs_many_jobs_with_few_workers(self):
+        results = list(cliapp.runcmd_many(
+            [['echo', str(i)] for i in range(200)], max_workers=7))
+        self.assertEqual([out for _, _, out, _ in results],
+                         [b'%d\n' % i for i in range(200)])
+
+    def test_runs_pipelines(self):
+        jobs = [[['echo', 'foo'], ['wc', '-c']]]
+        self.assertEqual(list(cliapp.runcmd_many(jobs)),
+                         [(0, 0, b'4\n', b'')])
+
+    def test_passes_keyword_arguments_to_each_job(self):
+        jobs = [['cat'], ['cat']]
+        self.assertEqual(
+            list(cliapp.runcmd_many(jobs, feed_stdin=b'foo')),
+            [(0, 0, b'foo', b''), (1, 0, b'foo', b'')])
+
+    def test_handles_jobs_without_pipes(self):
+        fd, filename = tempfile.mkstemp()
+        self.assertEqual(
+            list(cliapp.runcmd_many([['echo', 'foo']], stdout=fd,
+                                    stderr=fd)),
+            [(0, 0, b'', b'')])
+        os.close(fd)
+        os.remove(filename)
+
+    def test_collects_all_failures(self):
+        jobs = [['true'], ['false'], ['ls', 'notexist'], ['true']]
+        results = list(cliapp.runcmd_many(jobs))
+        self.assertEqual([exit_code for _, exit_code, _, _ in results][:2],
+                         [0, 1])
+        self.assertNotEqual(results[2][1], 0)
+        self.assertNotEqual(results[2][3], b'')
+        self.assertEqual(results[3][1], 0)
+
+    def test_fails_fast_on_request(self):
+        jobs = [['false'], ['sleep', '10'], ['true']]
+        started = time.time()
+        results = cliapp.runcmd_many(jobs, max_workers=2, fail_fast=True)
+        self.assertRaises(cliapp.AppException, list, results)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_spills_large_output_to_disk(self):
+        results = list(cliapp.runcmd_many(
+            [['cat']], feed_stdin=b'x' * 10000, max_memory=1024))
+        self.assertTrue(isinstance(results[0][2], mmap.mmap))
+        self.assertEqual(results[0][2][:], b'x' * 10000)
+
+    def test_rejects_zero_workers(self):
+        self.assertRaises(cliapp.AppException, cliapp.runcmd_many,
+                          [['true']], max_workers=0)
+
+
+@unittest.skipUnless(hasattr(os, 'posix_spawnp'), 'no posix_spawnp')
+class PosixSpawnTests(unittest.TestCase):
+
+    def runcmd_unchecked(self, *argvs, **kwargs):
+        return cliapp.runcmd_unchecked(
+            *argvs, launcher='posix_spawn', **kwargs)
+
+    def test_runs_pipeline(self):
+        self.assertEqual(
+            self.runcmd_unchecked(
+                ['cat'], ['sh', '-c', 'cat; echo bar 1>&2; exit 2'],
+                feed_stdin=b'foo'),
+            (2, b'foo', b'bar\n'))
+
+    def test_terminates_pipeline_when_reader_exits(self):
+        # The commands must not inherit the ignored SIGPIPE.
+        self.assertEqual(
+            self.runcmd_unchecked(['cat', '/dev/zero'], ['false']),
+            (1, b'', b''))
+
+    def test_merges_stderr_into_stdout(self):
+        self.assertEqual(
+            self.runcmd_unchecked(['sh', '-c', 'echo foo 1>&2'],
+                                  stderr=subprocess.STDOUT),
+            (0, b'foo\n', b''))
+
+    def test_reads_stdin_from_devnull(self):
+        self.assertEqual(
+            self.runcmd_unchecked(['cat'], stdin=subprocess.DEVNULL),
+            (0, b'', b''))
+
+    def test_writes_stdout_to_file(self):
+        with tempfile.TemporaryFile() as f:
+            self.runcmd_unchecked(['echo', 'foo'], stdout=f)
+            f.seek(0)
+            self.assertEqual(f.read(), b'foo\n')
+
+    def test_sets_environment(self):
+        self.assertEqual(
+            self.runcmd_unchecked(['sh', '-c', 'echo $FOO'],
+                                  env={'FOO': 'bar'}),
+            (0, b'bar\n', b''))
+
+    def test_does_not_leak_pipes_to_commands(self):
+        exit_code, out, err = self.runcmd_unchecked(
+            ['ls', '/proc/self/fd'], ['cat'])
+        self.assertEqual(out.split(), [b'0', b'1', b'2', b'3'])
+
+    def test_raises_error_for_missing_command(self):
+        self.assertRaises(OSError, self.runcmd_unchecked, ['nonexistent'])
+
+    def test_refuses_other_popen_arguments(self):
+        self.assertRaises(cliapp.AppException,
+                          self.runcmd_unchecked, ['true'], cwd='/')
+
+    def test_refuses_unknown_launcher(self):
+        self.assertRaises(cliapp.AppException,
+                          cliapp.runcmd, ['true'], launcher='rocket')
+
+    def test_runs_many_jobs(self):
+        self.assertEqual(
+            list(cliapp.runcmd_many([['echo', 'foo']] * 3,
+                                    launcher='posix_spawn')),
+            [(i, 0, b'foo\n', b'') for i in range(3)])
+
+
+class ChildWatchTests(object):
+
+    # Mixin for running the same tests with each way of finding out
+    # that child processes have exited.
+
+    method = None
+
+    def setUp(self):
+        self.saved = runcmd_module._child_watch
+        runcmd_module._child_watch = self.method
+
+    def tearDown(self):
+        runcmd_module._child_watch = self.saved
+
+    def test_runs_wide_pipeline(self):
+        argvs = [['cat']] * 50 + [['sh', '-c', 'cat; exit 3']]
+        self.assertEqual(
+            cliapp.runcmd_unchecked(*argvs, feed_stdin=b'foo'),
+            (3, b'foo', b''))
+
+    def test_reaps_process_when_it_exits(self):
+        _, _, _, stats = cliapp.runcmd_unchecked(
+            ['true'], ['sh', '-c', 'sleep 0.5'], stats=True)
+        self.assertTrue(stats.processes[0].wall_time < 0.4)
+
+    def test_waits_for_process_that_closes_its_output(self):
+        self.assertEqual(
+            cliapp.runcmd(['sh', '-c', 'exec >&- 2>&-; sleep 0.1; exit 0']),
+            b'')
+
+    def test_runs_many_jobs(self):
+        results = list(cliapp.runcmd_many(
+            [['sh', '-c', 'exit %d' % (i % 3)] for i in range(30)],
+            max_workers=10))
+        self.assertEqual([r[1] for r in results],
+                         [i % 3 for i in range(30)])
+
+    def test_stops_watching_when_caller_stops_iterating(self):
+        output = cliapp.runcmd_iter(['sh', '-c', 'echo foo; sleep 10'])
+        self.assertEqual(next(output), b'foo\n')
+        output.close()
+        self.assertEqual(runcmd_module._sigchld_fds, set())
+
+
+@unittest.skipUnless(hasattr(os, 'pidfd_open'), 'no pidfd_open')
+class PidfdChildWatchTests(ChildWatchTests, unittest.TestCase):
+
+    method = 'pidfd'
+
+
+class SigchldChildWatchTests(ChildWatchTests, unittest.TestCase):
+
+    method = 'sigchld'
+
+
+    def test_restores_previous_sigchld_handler(self):
+        def handler(signum, frame):
+            pass
+
+        previous = signal.signal(signal.SIGCHLD, handler)
+        try:
+            cliapp.runcmd(['true'])
+            self.assertEqual(signal.getsignal(signal.SIGCHLD), handler)
+        finally:
+            signal.signal(signal.SIGCHLD, previous)
+
+    def test_child_watch_is_polled_in_renamed_thread(self):
+        methods = []
+        thread = threading.Thread(
+            target=lambda: methods.append(
+                runcmd_module._child_watch_method()),
+            name='MainThread')
+        thread.start()
+        thread.join()
+        self.assertEqual(methods, ['poll'])
+
+
+class PollChildWatchTests(ChildWatchTests, unittest.TestCase):
+
+    method = 'poll'
+
+    def test_reaps_process_when_it_exits(self):
+        self.skipTest('polling starts only when the pipes have closed')
+
+
+@unittest.skipUnless(hasattr(os, 'pidfd_open'), 'no pidfd_open')
+class PidfdFallbackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = runcmd_module._child_watch
+        self.pidfd_open = os.pidfd_open
+        runcmd_module._child_watch = None
+
+    def tearDown(self):
+        runcmd_module._child_watch = self.saved
+        os.pidfd_open = self.pidfd_open
+
+    def fail_with(self, error):
+        def pidfd_open(pid):
+            raise OSError(error, os.strerror(error))
+        os.pidfd_open = pidfd_open
+
+    def test_falls_back_to_sigchld_without_pidfd_open(self):
+        for error in [errno.ENOSYS, errno.EPERM]:
+            runcmd_module._child_watch = None
+            self.fail_with(error)
+            self.assertEqual(
+                cliapp.runcmd(['echo', 'hi'], ['cat']), b'hi\n')
+            self.assertEqual(runcmd_module._child_watch, 'sigchld')
+            self.assertEqual(cliapp.runcmd(['echo', 'again']), b'again\n')
+
+    def test_falls_back_when_pidfd_open_fails_for_later_process(self):
+        calls = []
+
+        def pidfd_open(pid):
+            calls.append(pid)
+            if len(calls) > 1:
+                raise OSError(errno.ENOSYS, 'no pidfd')
+            return self.pidfd_open(pid)
+
+        os.pidfd_open = pidfd_open
+        self.assertEqual(
+            cliapp.runcmd(['echo', 'hi'], ['cat'], ['cat']), b'hi\n')
+        self.assertEqual(runcmd_module._child_watch, 'sigchld')
+
 
 class ShellQuoteTests(unittest.TestCase):
 
@@ -178,3 +733,291 @@ class ShellQuoteTests(unittest.TestCase):
 
     def test_quotes_single_quote(self):
         self.assertEqual(cliapp.shell_quote("'"), '"\'"')
+
+
+# A stand-in for ssh(1) that runs commands locally. It understands
+# just enough options for ssh_runcmd and SshSession, pretends the
+# ControlPath file is the master's socket, and logs each call to
+# $FAKE_SSH_LOG as "connect", "master", "mux", or "exit", and the
+# target. Commands see the target as $FAKE_SSH_TARGET.
+fake_ssh = '''#!%s
+import os, signal, sys
+args = sys.argv[1:]
+opts = {}
+control = None
+while args[0].startswith('-') and args[0] != '--':
+    arg = args.pop(0)
+    if arg.startswith('-o'):
+        name, value = arg[2:].split('=', 1)
+        opts[name] = value
+    elif arg == '-O':
+        control = args.pop(0)
+target = args.pop(0)
+if args and args[0] == '--':
+    args.pop(0)
+path = opts.get('ControlPath')
+if target == 'unreachable':
+    sys.stderr.write('no route to host\\n')
+    sys.exit(255)
+if control == 'exit':
+    os.remove(path)
+    what = 'exit'
+elif opts.get('ControlMaster') == 'yes':
+    open(path, 'w').close()
+    what = 'master'
+elif path and os.path.exists(path):
+    what = 'mux'
+else:
+    what = 'connect'
+with open(os.environ['FAKE_SSH_LOG'], 'a') as f:
+    f.write('%%s %%s\\n' %% (what, target))
+if control is None and what != 'master':
+    os.environ['FAKE_SSH_TARGET'] = target
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    os.execvp('sh', ['sh', '-c', ' '.join(args)])
+''' % sys.executable
+
+
+class FakeSshTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        ssh = os.path.join(self.tempdir, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write(fake_ssh)
+        os.chmod(ssh, 0o755)
+        self.log = os.path.join(self.tempdir, 'log')
+        open(self.log, 'w').close()
+        self.saved_env = dict(os.environ)
+        os.environ['PATH'] = self.tempdir + ':' + os.environ['PATH']
+        os.environ['FAKE_SSH_LOG'] = self.log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tempdir)
+
+    def ssh_calls(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+
+class SshRuncmdTests(FakeSshTestCase):
+
+    def test_runs_command_on_target(self):
+        self.assertEqual(cliapp.ssh_runcmd('host', ['echo', 'foo bar']),
+                         b'foo bar\n')
+        self.assertEqual(self.ssh_calls(), ['connect host'])
+
+    def test_runs_command_in_remote_cwd(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd('host', ['pwd'], remote_cwd='/'), b'/\n')
+
+    def test_accepts_tty_option(self):
+        for tty in [True, False, None]:
+            cliapp.ssh_runcmd('host', ['true'], tty=tty)
+        self.assertEqual(self.ssh_calls(), ['connect host'] * 3)
+
+    def test_raises_error_if_command_fails(self):
+        self.assertRaises(cliapp.AppException,
+                          cliapp.ssh_runcmd, 'host', ['false'])
+
+    def test_runs_pipeline_in_one_connection(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd('host', ['printf', "it's a\\n"],
+                              ['sed', 's/a/b/'], ['cat']),
+            b"it's b\n")
+        self.assertEqual(self.ssh_calls(), ['connect host'])
+
+    def test_runs_pipeline_in_remote_cwd(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd('host', ['pwd'], ['cat'], remote_cwd='/'),
+            b'/\n')
+
+    def test_feeds_stdin_to_pipeline(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd('host', ['cat'], ['wc', '-c'],
+                              feed_stdin=b'hello'),
+            b'5\n')
+
+    def test_returns_exit_codes_of_pipeline(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd_unchecked(
+                'host', ['sh', '-c', 'cat; echo foo 1>&2; exit 2'],
+                ['sh', '-c', 'cat; exit 3'], ['cat'], exit_codes=True),
+            (3, b'', b'foo\n', [2, 3, 0]))
+
+    def test_returns_exit_code_of_pipeline_without_captured_stderr(self):
+        result = cliapp.ssh_runcmd_unchecked(
+            'host', ['sh', '-c', 'echo foo 1>&2; exit 2'], ['cat'],
+            stderr=subprocess.STDOUT, exit_codes=True)
+        self.assertEqual(result, (2, b'foo\n', b'', [2]))
+        with self.assertRaises(cliapp.AppException):
+            cliapp.ssh_runcmd('host', ['false'], ['cat'],
+                              stderr=subprocess.STDOUT, log_error=False)
+
+    def test_returns_exit_code_of_pipeline_with_tty(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd_unchecked(
+                'host', ['sh', '-c', 'exit 2'], ['sh', '-c', 'exit 3'],
+                ['cat'], tty=True, exit_codes=True),
+            (3, b'', b'', [3]))
+        with self.assertRaises(cliapp.AppException):
+            cliapp.ssh_runcmd('host', ['false'], ['cat'], tty=True,
+                              log_error=False)
+
+    def test_returns_one_exit_code_for_one_command(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd_unchecked('host', ['false'], exit_codes=True),
+            (1, b'', b'', [1]))
+
+    def test_returns_exit_code_of_ssh_if_it_fails(self):
+        self.assertEqual(
+            cliapp.ssh_runcmd_unchecked('unreachable', ['true'], ['true'],
+                                        exit_codes=True),
+            (255, b'', b'no route to host\n', [255]))
+
+    def test_returns_stats_after_exit_codes(self):
+        result = cliapp.ssh_runcmd_unchecked(
+            'host', ['true'], ['true'], exit_codes=True, stats=True)
+        self.assertEqual(result[:4], (0, b'', b'', [0, 0]))
+        self.assertTrue(isinstance(result[4], cliapp.PipelineStats))
+
+    def test_returns_output_and_stats(self):
+        out, stats = cliapp.ssh_runcmd('host', ['echo', 'foo'], stats=True)
+        self.assertEqual(out, b'foo\n')
+        self.assertTrue(isinstance(stats, cliapp.PipelineStats))
+
+    def test_reports_exit_codes_of_failed_pipeline(self):
+        with self.assertRaises(cliapp.AppException) as cm:
+            cliapp.ssh_runcmd('host', ['echo', 'foo'], ['false'],
+                              log_error=False)
+        self.assertTrue(str(cm.exception).startswith(
+            'Command failed: ssh host -- echo foo | false '
+            '(exit codes: 0 1)\n'))
+
+
+class SshRuncmdManyTests(FakeSshTestCase):
+
+    def test_runs_command_on_every_target(self):
+        results = cliapp.ssh_runcmd_many(
+            ['foo', 'bar', 'foobar'],
+            ['sh', '-c', 'echo $FAKE_SSH_TARGET; exit 3'])
+        self.assertEqual(
+            sorted(results),
+            [('bar', 3, b'bar\n', b''), ('foo', 3, b'foo\n', b''),
+             ('foobar', 3, b'foobar\n', b'')])
+        self.assertEqual(sorted(self.ssh_calls()),
+                         ['connect bar', 'connect foo', 'connect foobar'])
+
+    def test_runs_targets_concurrently(self):
+        started = time.time()
+        results = list(cliapp.ssh_runcmd_many(
+            ['host%d' % i for i in range(10)], ['sleep', '0.5'],
+            max_parallel=10))
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual([r[1] for r in results], [0] * 10)
+
+    def test_streams_output_to_callback(self):
+        seen = []
+
+        def callback(target, kind, data):
+            seen.append((target, kind, data))
+
+        results = list(cliapp.ssh_runcmd_many(
+            ['foo'], ['sh', '-c', 'echo out; echo err 1>&2'],
+            callback=callback, stdout_callback=lambda data: data.upper()))
+        self.assertEqual(results, [('foo', 0, b'OUT\n', b'err\n')])
+        self.assertEqual(sorted(seen), [('foo', 'stderr', b'err\n'),
+                                        ('foo', 'stdout', b'OUT\n')])
+
+    def test_terminates_target_that_times_out(self):
+        script = 'test $FAKE_SSH_TARGET = slow && sleep 10; echo done'
+        started = time.time()
+        results = list(cliapp.ssh_runcmd_many(
+            ['slow', 'fast'], ['sh', '-c', script], output_timeout=0.5))
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(results, [('fast', 0, b'done\n', b''),
+                                   ('slow', -signal.SIGTERM, b'', b'')])
+
+    def test_refuses_zero_max_parallel(self):
+        self.assertRaises(cliapp.AppException, cliapp.ssh_runcmd_many,
+                          ['foo'], ['true'], max_parallel=0)
+
+
+class SshSessionTests(FakeSshTestCase):
+
+    def setUp(self):
+        FakeSshTestCase.setUp(self)
+        self.session = cliapp.SshSession('host', ssh_options=['-oUser=me'])
+
+    def tearDown(self):
+        self.session.close()
+        FakeSshTestCase.tearDown(self)
+
+    def test_is_not_open_initially(self):
+        self.assertEqual(self.session.control_path, None)
+        self.assertEqual(self.ssh_calls(), [])
+
+    def test_reuses_connection_for_commands(self):
+        for i in range(3):
+            self.assertEqual(self.session.runcmd(['echo', str(i)]),
+                             b'%d\n' % i)
+        self.assertEqual(self.ssh_calls(),
+                         ['master host'] + ['mux host'] * 3)
+
+    def test_ssh_runcmd_uses_session(self):
+        cliapp.ssh_runcmd('host', ['true'], session=self.session)
+        self.assertEqual(self.ssh_calls(), ['master host', 'mux host'])
+
+    def test_close_stops_master(self):
+        self.session.open()
+        control_dir = os.path.dirname(self.session.control_path)
+        self.session.close()
+        self.assertEqual(self.session.control_path, None)
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertEqual(self.ssh_calls(), ['master host', 'exit host'])
+
+    def test_close_does_nothing_if_not_open(self):
+        self.session.close()
+        self.assertEqual(self.ssh_calls(), [])
+
+    def test_raises_error_if_cannot_connect(self):
+        session = cliapp.SshSession('unreachable')
+        with self.assertRaises(cliapp.AppException) as cm:
+            session.runcmd(['true'])
+        self.assertTrue('no route to host' in str(cm.exception))
+        self.assertEqual(session.control_path, None)
+
+
+class SshSessionPoolTests(FakeSshTestCase):
+
+    def setUp(self):
+        FakeSshTestCase.setUp(self)
+        self.pool = cliapp.SshSessionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        FakeSshTestCase.tearDown(self)
+
+    def test_has_one_session_per_target_and_options(self):
+        foo = self.pool.get('foo')
+        self.assertTrue(self.pool.get('foo') is foo)
+        self.assertFalse(self.pool.get('bar') is foo)
+        self.assertFalse(self.pool.get('foo', ['-oUser=me']) is foo)
+
+    def test_runs_commands_over_shared_connections(self):
+        for target in ['foo', 'bar', 'foo']:
+            self.assertEqual(self.pool.ssh_runcmd(target, ['echo', target]),
+                             target.encode() + b'\n')
+        self.assertEqual(
+            self.ssh_calls(),
+            ['master foo', 'mux foo', 'master bar', 'mux bar', 'mux foo'])
+
+    def test_close_closes_all_sessions(self):
+        self.pool.ssh_runcmd('foo', ['true'])
+        self.pool.ssh_runcmd('bar', ['true'])
+        self.pool.close()
+        self.assertEqual(self.pool.sessions, {})
+        self.assertEqual(sorted(self.ssh_calls()[-2:]),
+                         ['exit bar', 'exit foo'])
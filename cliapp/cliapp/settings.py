@@ -24,18 +24,13 @@ import optparse
 import os
 import re
 import sys
-
-import yaml
-
-try:
-    import xdg.BaseDirectory
-except ImportError:  # pragma: no cover
-    xdg_is_available = False
-else:  # pragma: no cover
-    xdg_is_available = True
+import time
 
 import cliapp
-from cliapp.genman import ManpageGenerator
+
+# yaml, xdg.BaseDirectory, and cliapp.genman are imported where they
+# are used, since importing them is slow compared to the startup time
+# of a typical program, and many runs never need them.
 
 
 # hack in a 'unicode' type for Python 2 v 3 compatibility
@@ -310,6 +305,12 @@ class Settings(object):
     in ``config_files``. Add or remove from the list if you wish.
     The files need to exist: those that don't are silently ignored.
 
+    To avoid parsing the configuration files every time, set
+    ``config_cache`` to the name of a file, for example
+    ``default_config_cache``. ``load_configs`` then saves the values
+    it reads there, and uses them instead of reading the files again,
+    while the files and the version of the program stay the same.
+
     '''
 
     def __init__(self, progname, version, usage=None, description=None,
@@ -328,12 +329,43 @@ class Settings(object):
 
         self._config_files = None
         self._required_config_files = []
+
+        # Default config files that did not exist when looked for:
+        # load_configs need not try to open them.
+        self._missing_default_configs = set()
         self._cp = ConfigParser()
+        self.config_cache = None
+
+        # Canonical names of settings load_configs has set.
+        self._set_by_configs = set()
+
+        # The parser built by the latest call to parse_args, and what
+        # it was built from, for the next call to reuse; and the list
+        # of callbacks its options have deferred during parsing.
+        self._parser_key = None
+        self._parser = None
+        self._deferred_last = []
 
     def _add_default_settings(self):
         self.string(['output'],
                     'write output to FILE, instead of standard output',
                     metavar='FILE')
+        self.boolean(['atomic-output'],
+                     'write --output to a temporary file, and rename it '
+                     'to FILE only if the program succeeds')
+        self.string(['checkpoint'],
+                    'while processing input files, save progress to FILE '
+                    'every now and then, so that --resume can continue '
+                    'from there',
+                    metavar='FILE')
+        self.integer(['checkpoint-interval'],
+                     'save a --checkpoint at most every SECONDS '
+                     '(default: %default)',
+                     metavar='SECONDS',
+                     default=300)
+        self.boolean(['resume'],
+                     'continue processing input files from the --checkpoint '
+                     'FILE, if it exists')
 
         self.string(['log'],
                     'write log entries to FILE (default is to not write log '
@@ -369,6 +401,46 @@ class Settings(object):
                      metavar='SECONDS',
                      default=300,
                      group=perf_group_name)
+        self.integer(['jobs'],
+                     'process input files in N parallel processes '
+                     '(default: %default)',
+                     metavar='N',
+                     default=1,
+                     group=perf_group_name)
+        self.bytesize(['input-part-size'],
+                      'with --jobs, split input files larger than SIZE '
+                      'into parts of about SIZE bytes, processed in '
+                      'parallel; zero for never (default: %default)',
+                      metavar='SIZE',
+                      default=0,
+                      group=perf_group_name)
+        self.boolean(['decompress-in-background'],
+                     'decompress compressed input files in a background '
+                     'thread, while processing them',
+                     group=perf_group_name)
+        self.integer(['read-ahead'],
+                     'read input files in a background thread, at most '
+                     'N blocks ahead of processing; zero for never '
+                     '(default: %default)',
+                     metavar='N',
+                     default=0,
+                     group=perf_group_name)
+        self.bytesize(['read-ahead-size'],
+                      'with --read-ahead or --decompress-in-background, '
+                      'read blocks of SIZE bytes (default: %default)',
+                      metavar='SIZE',
+                      default=1024 ** 2,
+                      group=perf_group_name)
+        self.bytesize(['output-buffer-size'],
+                      'collect SIZE bytes of output before writing it; '
+                      'zero for the default (default: %default)',
+                      metavar='SIZE',
+                      default=0,
+                      group=perf_group_name)
+        self.boolean(['output-in-background'],
+                     'write output in a background thread, while '
+                     'producing more',
+                     group=perf_group_name)
 
     def _add_setting(self, setting):
         '''Add a setting to self._cp.'''
@@ -481,22 +553,23 @@ class Settings(object):
         # Maintain lists of callback function calls that are deferred.
         # We call them ourselves rather than have OptionParser call them
         # directly so that we can do things like --dump-config only
-        # after the whole command line is parsed.
+        # after the whole command line is parsed. Without a list from
+        # the caller, they go to the list of the parse_args call that
+        # is using the parser.
 
         def defer_last(func):  # pragma: no cover
             def callback(*args):
-                deferred_last.append(lambda: func(*args))
+                if deferred_last is None:
+                    queue = self._deferred_last
+                else:
+                    queue = deferred_last
+                queue.append(lambda: func(*args))
             return callback
 
         # Create the command line parser.
 
-        def getit(x):
-            if x is None or type(x) in [str, unicode]:
-                return x
-            else:
-                return x()
-        usage = getit(self.usage)
-        description = getit(self.description)
+        usage = _getit(self.usage)
+        description = _getit(self.description)
         p = optparse.OptionParser(prog=self.progname, version=self.version,
                                   formatter=FormatHelpParagraphs(),
                                   usage=usage,
@@ -572,8 +645,7 @@ class Settings(object):
         # Add --no-default-configs.
 
         def reset_configs(option, opt_str, value, parser):
-            self.config_files = []
-            self._required_config_files = []
+            self._reset_configs()
 
         add_option_to_group(
             None, config_group,
@@ -586,8 +658,7 @@ class Settings(object):
         # Add --config.
 
         def append_to_configs(option, opt_str, value, parser):
-            self.config_files.append(value)
-            self._required_config_files.append(value)
+            self._add_config(value)
 
         add_option_to_group(
             None, config_group,
@@ -604,6 +675,7 @@ class Settings(object):
         def list_config_files(*args):  # pragma: no cover
             for filename in self.config_files:
                 print(filename)
+            self._report_config_discovery(sys.stderr)
             sys.exit(0)
 
         add_option_to_group(
@@ -716,26 +788,107 @@ class Settings(object):
         Return list of non-option arguments. ``args`` would usually
         be ``sys.argv[1:]``.
 
-        '''
+        With ``configs_only`` true, only ``--config`` and
+        ``--no-default-configs`` are acted on, to find the
+        configuration files to read before parsing the command line
+        for real. The other options are skipped without checking
+        them.
 
-        deferred_last = []
+        The parser is built only on the first call, and reused after
+        that, unless settings have been added, or the arguments or
+        texts it is built from have changed.
+
+        '''
 
-        p = parser or self.build_parser(configs_only=configs_only,
-                                        arg_synopsis=arg_synopsis,
-                                        cmd_synopsis=cmd_synopsis,
-                                        deferred_last=deferred_last,
-                                        all_options=all_options)
+        p = parser or self._get_parser(arg_synopsis, cmd_synopsis,
+                                       all_options)
+        if configs_only:
+            return self._scan_config_options(p, args)
 
+        self._deferred_last = deferred_last = []
         if suppress_errors:
             p.error = lambda msg: sys.exit(1)
-
-        _, args = p.parse_args(args)
+        try:
+            _, args = p.parse_args(args)
+        finally:
+            if suppress_errors:
+                del p.error
         if compute_setting_values:  # pragma: no cover
             compute_setting_values(self)
         for callback in deferred_last:  # pragma: no cover
             callback()
         return args
 
+    def _get_parser(self, arg_synopsis, cmd_synopsis, all_options):
+        # Return a parser for parse_args, built now, or by an earlier
+        # call with the same arguments.
+
+        key = (list(self._canonical_names), arg_synopsis, cmd_synopsis,
+               all_options, self.progname, self.version, _getit(self.usage),
+               _getit(self.description), self.epilog)
+        if key != self._parser_key:
+            self._parser = self.build_parser(
+                arg_synopsis=arg_synopsis, cmd_synopsis=cmd_synopsis,
+                all_options=all_options)
+            self._parser_key = key
+        else:
+            # Values may have changed since the parser was built, for
+            # example by reading config files: --help shows them.
+            self._arg_synopsis = arg_synopsis
+            self._cmd_synopsis = cmd_synopsis
+            self._parser.set_defaults(**dict(
+                (self._destname(name), self._settingses[name].value)
+                for name in self._canonical_names))
+        return self._parser
+
+    def _scan_config_options(self, p, args):
+        # Act on --config and --no-default-configs in args, skipping
+        # other options, and return the non-option arguments. This
+        # follows OptionParser in splitting args into options and their
+        # values, but ignores any errors, which parsing args with p
+        # then reports.
+
+        remaining = list(args)
+        positional = []
+        while remaining:
+            arg = remaining.pop(0)
+            if arg == '--':
+                positional += remaining
+                break
+            elif arg.startswith('--'):
+                opt, equals, value = arg.partition('=')
+                try:
+                    opt = p._match_long_opt(opt)
+                except optparse.BadOptionError:
+                    continue
+                option = p._long_opt[opt]
+                if option.takes_value():
+                    if equals:
+                        remaining.insert(0, value)
+                    values = remaining[:option.nargs]
+                    del remaining[:option.nargs]
+                    value = values[0] if values else None
+                if opt == '--no-default-configs':
+                    self._reset_configs()
+                elif opt == '--config' and value is not None:
+                    self._add_config(value)
+            elif arg.startswith('-') and arg != '-':
+                for i, char in enumerate(arg[1:]):
+                    option = p._short_opt.get('-' + char)
+                    if option is None:
+                        break
+                    if option.takes_value():
+                        rest = arg[i + 2:]
+                        nargs = option.nargs - (1 if rest else 0)
+                        del remaining[:nargs]
+                        break
+            elif p.allow_interspersed_args:
+                positional.append(arg)
+            else:
+                positional += [arg] + remaining
+                break
+        return positional
+
     @property
     def default_config_files(self):
         '''Return list of default config files to read.
@@ -743,20 +896,26 @@ class Settings(object):
         The names of the files are dependent on the name of the program,
         as set in the progname attribute.
 
-        The files may or may not exist.
+        The files may or may not exist. They are looked for only once
+        in the life of the process; load_configs does not try to open
+        the ones that did not exist then.
 
         '''
 
-        configs = []
+        return [pathname for pathname, _ in self._find_default_configs()]
 
-        configs.append('/etc/%s.conf' % self.progname)
-        configs.append('/etc/%s.yaml' % self.progname)
-        configs += self.listconfs('/etc/%s' % self.progname)
+    def _default_config_locations(self):
+        # Return the places to look for default config files in: a
+        # list of ('file', pathname) and ('dir', dirname) pairs.
 
-        configs.append(os.path.expanduser('~/.%s.conf' % self.progname))
-        configs.append(os.path.expanduser('~/.%s.yaml' % self.progname))
-        configs += self.listconfs(
-            os.path.expanduser('~/.config/%s' % self.progname))
+        locations = [
+            ('file', '/etc/%s.conf' % self.progname),
+            ('file', '/etc/%s.yaml' % self.progname),
+            ('dir', '/etc/%s' % self.progname),
+            ('file', os.path.expanduser('~/.%s.conf' % self.progname)),
+            ('file', os.path.expanduser('~/.%s.yaml' % self.progname)),
+            ('dir', os.path.expanduser('~/.config/%s' % self.progname)),
+        ]
 
         # See <http://standards.freedesktop.org/basedir-spec/>. We
         # support these if the xdg library is available. We always
@@ -764,13 +923,21 @@ class Settings(object):
         # files don't get ignored just because the xdg library gets
         # installed.
 
-        if xdg_is_available:  # pragma: no cover
-            for dirname in reversed(xdg.BaseDirectory.xdg_config_dirs):
-                pathname = os.path.join(dirname, self.progname)
-                for location in self.listconfs(pathname):
-                    if location not in configs:
-                        configs.append(location)
+        for dirname in reversed(_xdg_config_dirs()):  # pragma: no cover
+            locations.append(('dir', os.path.join(dirname, self.progname)))
 
+        return locations
+
+    def _find_default_configs(self):
+        # Return (pathname, exists) for each default config file.
+
+        found, _ = _find_configs(self._default_config_locations())
+        configs = []
+        seen = set()
+        for pathname, exists in found:
+            if pathname not in seen:
+                configs.append((pathname, exists))
+                seen.add(pathname)
         return configs
 
     def listconfs(self, dirname, listdir=os.listdir):
@@ -784,18 +951,52 @@ class Settings(object):
 
         '''
 
+        if listdir is os.listdir:
+            return _scan_config_dir(dirname)
+
         if not os.path.isdir(dirname):
             return []
+        return _config_pathnames(dirname, listdir(dirname))
+
+    @property
+    def default_config_cache(self):
+        '''Return the default name of the file for config_cache.
+
+        This is ``settings.cache`` in a directory named after the
+        program, in ``$XDG_CACHE_HOME``, or ``~/.cache``.
+
+        '''
+
+        cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                      os.path.expanduser('~/.cache'))
+        return os.path.join(cache_home, self.progname, 'settings.cache')
+
+    def _report_config_discovery(self, output):
+        '''Write how long looking for default config files took.'''
+
+        _, timings = _find_configs(self._default_config_locations())
+        total = sum(seconds for _, seconds, _ in timings)
+        output.write(
+            'looked for config files in %d places in %.1f ms:\n' %
+            (len(timings), 1000.0 * total))
+        for location, seconds, found in timings:
+            output.write('  %8.3f ms %s: %s\n' %
+                         (1000.0 * seconds, location, found))
+
+    def _reset_configs(self):
+        self.config_files = []
+        self._required_config_files = []
 
-        basenames = listdir(dirname)
-        basenames.sort(key=lambda s: [ord(c) for c in s])
-        return [os.path.join(dirname, x)
-                for x in basenames
-                if x.endswith('.conf') or x.endswith('.yaml')]
+    def _add_config(self, filename):
+        self.config_files.append(filename)
+        self._required_config_files.append(filename)
 
     def _get_config_files(self):
         if self._config_files is None:
-            self._config_files = self.default_config_files
+            found = self._find_default_configs()
+            self._config_files = [pathname for pathname, _ in found]
+            self._missing_default_configs = set(
+                pathname for pathname, exists in found if not exists)
         return self._config_files
 
     def _set_config_files(self, config_files):
@@ -816,11 +1017,24 @@ class Settings(object):
 
         Silently ignore files that do not exist.
 
+        If ``config_cache`` is set, use the values saved there
+        instead, if the files are the same as when they were saved.
+        Otherwise, save the values there after reading the files.
+
         '''
 
+        key = None
+        if self.config_cache is not None and open_file is open:
+            key = self._config_cache_key()
+            if key is not None and self._load_config_cache(key):
+                return
+
         self._all_config_data = {}
+        self._set_by_configs = set()
 
         for pathname in self.config_files:
+            if open_file is open and self._is_missing_default_config(pathname):
+                continue
             try:
                 f = open_file(pathname)
                 if pathname.endswith('.yaml'):
@@ -832,6 +1046,88 @@ class Settings(object):
                 if pathname in self._required_config_files:
                     raise
 
+        if key is not None:
+            self._save_config_cache(key)
+
+    def _is_missing_default_config(self, pathname):
+        return (pathname in self._missing_default_configs and
+                pathname not in self._required_config_files)
+
+    def _config_cache_key(self):
+        # Return what the config cache must have been saved for, to
+        # be used: the program, and the identity of each config file,
+        # or None if it does not exist. Return None if a required file
+        # does not exist, so that reading it reports the error.
+
+        files = []
+        for pathname in self.config_files:
+            if self._is_missing_default_config(pathname):
+                files.append((pathname, None))
+                continue
+            try:
+                st = os.stat(pathname)
+            except OSError:
+                if pathname in self._required_config_files:
+                    return None
+                files.append((pathname, None))
+            else:
+                mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+                files.append((pathname, mtime, st.st_size, st.st_ino))
+        return [self.progname, self.version, cliapp.__version__, files]
+
+    def _load_config_cache(self, key):
+        # Set settings from the config cache, if it was saved for key.
+        # Return True if it was, False if the configs must be read.
+
+        import pickle
+        try:
+            with open(self.config_cache, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['key'] != key:
+                return False
+            values = [(self._settingses[name], value)
+                      for name, value in cache['values']]
+        except Exception:
+            # The cache is missing, broken, or for other settings.
+            return False
+
+        self._set_by_configs = set()
+        for s, value in values:
+            s.value = value
+            if hasattr(s, 'using_default_value'):
+                s.using_default_value = True
+            self._set_by_configs.add(s.names[0])
+        self._all_config_data = cache['all_config_data']
+        return True
+
+    def _save_config_cache(self, key):
+        import pickle
+        import cliapp.outputs
+
+        cache = {
+            'key': key,
+            'values': [(name, self._settingses[name].value)
+                       for name in self._canonical_names
+                       if name in self._set_by_configs],
+            'all_config_data': self._all_config_data,
+        }
+        try:
+            dirname = os.path.dirname(self.config_cache)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname, 0o700)
+            f = cliapp.outputs.AtomicFile(self.config_cache)
+            try:
+                f.write(pickle.dumps(cache, protocol=2))
+            except BaseException:
+                f.discard()
+                raise
+            # The cache is only a cache: don't wait for the disk.
+            f.commit(sync=False)
+        except (IOError, OSError):  # pragma: no cover
+            # The cache only saves time: without it, the configs
+            # just get read again next time.
+            pass
+
     def _read_ini(self, pathname, f):
         cp = ConfigParser()
         cp.add_section('config')
@@ -841,6 +1137,7 @@ class Settings(object):
             s = self.set_from_raw_string(pathname, name, value)
             if hasattr(s, 'using_default_value'):
                 s.using_default_value = True
+            self._set_by_configs.add(s.names[0])
 
         for section in [s for s in cp.sections() if s != 'config']:
             if section not in self._all_config_data:
@@ -850,7 +1147,8 @@ class Settings(object):
                 section_data[option] = cp.get(section, option)
 
     def _read_yaml(self, pathname, f):
-        obj = yaml.safe_load(f)
+        import yaml
+        obj = yaml.load(f, Loader=_yaml_loader())
         self._check_yaml(pathname, obj)
         config = obj.get('config') or {}
         for name, value in list(config.items()):
@@ -860,6 +1158,7 @@ class Settings(object):
             s.set_value(value)
             if hasattr(s, 'using_default_value'):
                 s.using_default_value = True
+            self._set_by_configs.add(s.names[0])
 
         for section in [s for s in obj if s != 'config']:
             if section not in self._all_config_data:
@@ -880,6 +1179,7 @@ class Settings(object):
                 pathname)
 
     def _generate_manpage(self, o, dummy, value, p):  # pragma: no cover
+        from cliapp.genman import ManpageGenerator
         template = open(value).read()
         generator = ManpageGenerator(template, p, self._arg_synopsis,
                                      self._cmd_synopsis)
@@ -911,3 +1211,97 @@ class Settings(object):
     def dump_config(self, output):  # pragma: no cover
         cp = self.as_cp()
         cp.write(output)
+
+
+def _yaml_loader():
+    '''Return the loader class for reading YAML config files.
+
+    This is the safe loader of libyaml, if PyYAML has been built with
+    it, since it is much faster, and otherwise the pure Python one.
+
+    '''
+
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _xdg_config_dirs():
+    '''Return the XDG config directories, or [] without the xdg library.'''
+
+    try:
+        import xdg.BaseDirectory
+    except ImportError:
+        return []
+    return xdg.BaseDirectory.xdg_config_dirs  # pragma: no cover
+
+
+def _getit(x):
+    '''Return x, or if it is a function, what it returns.'''
+
+    if x is None or type(x) in [str, unicode]:
+        return x
+    else:
+        return x()
+
+
+# What _find_configs has found, for the life of the process: config
+# files are not expected to come and go while a program runs, and
+# looking for them can be slow, for example on a home directory on
+# NFS.
+_found_configs = {}
+
+
+def _find_configs(locations):
+    '''Look for config files, and return what was found.
+
+    ``locations`` is a list of ``('file', pathname)`` pairs, for
+    config files, and ``('dir', dirname)`` pairs, for directories of
+    config files. Return a list of ``(pathname, exists)`` pairs, for
+    the config files, and a list of ``(location, seconds, result)``
+    triples, for how long looking in each location took.
+
+    '''
+
+    key = tuple(locations)
+    if key not in _found_configs:
+        found = []
+        timings = []
+        for kind, location in locations:
+            started = time.time()
+            if kind == 'file':
+                exists = os.path.exists(location)
+                found.append((location, exists))
+                result = 'exists' if exists else 'missing'
+            else:
+                pathnames = _scan_config_dir(location)
+                found += [(pathname, True) for pathname in pathnames]
+                result = '%d config files' % len(pathnames)
+            timings.append((location, time.time() - started, result))
+        _found_configs[key] = (found, timings)
+    return _found_configs[key]
+
+
+def _scan_config_dir(dirname):
+    '''Return pathnames of config files in dirname, or [].'''
+
+    scandir = getattr(os, 'scandir', None)
+    try:
+        if scandir is None:  # pragma: no cover
+            basenames = os.listdir(dirname)
+        else:
+            # One system call, where os.path.isdir and os.listdir
+            # would make two.
+            with scandir(dirname) as entries:
+                basenames = [entry.name for entry in entries]
+    except OSError:
+        return []
+    return _config_pathnames(dirname, basenames)
+
+
+def _config_pathnames(dirname, basenames):
+    '''Return sorted pathnames in dirname of config file basenames.'''
+
+    # Sorting strings sorts by code point, as in the C locale.
+    return [os.path.join(dirname, x)
+            for x in sorted(basenames)
+            if x.endswith('.conf') or x.endswith('.yaml')]
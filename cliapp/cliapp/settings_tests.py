@@ -20,6 +20,9 @@ try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+import os
+import shutil
+import tempfile
 import unittest
 
 import cliapp
@@ -271,6 +274,56 @@ class SettingsTests(unittest.TestCase):
         names = self.settings.listconfs('.', listdir=mock_listdir)
         self.assertEqual(names, ['./bar.conf', './foo.conf'])
 
+    def test_finds_default_config_files(self):
+        home = tempfile.mkdtemp()
+        saved = os.environ['HOME']
+        os.environ['HOME'] = home
+        try:
+            confdir = os.path.join(home, '.config', 'findme')
+            os.makedirs(confdir)
+            for name, text in [('b.yaml', 'config: {}\n'),
+                               ('a.conf', '[config]\n'),
+                               ('c.txt', '')]:
+                with open(os.path.join(confdir, name), 'w') as f:
+                    f.write(text)
+            with open(os.path.join(home, '.findme.conf'), 'w') as f:
+                f.write('[config]\n')
+            settings = cliapp.Settings('findme', '1.0')
+            self.assertEqual(
+                [x for x in settings.config_files if x.startswith(home)],
+                [os.path.join(home, '.findme.conf'),
+                 os.path.join(home, '.findme.yaml'),
+                 os.path.join(confdir, 'a.conf'),
+                 os.path.join(confdir, 'b.yaml')])
+            self.assertTrue(settings._is_missing_default_config(
+                os.path.join(home, '.findme.yaml')))
+            self.assertFalse(settings._is_missing_default_config(
+                os.path.join(home, '.findme.conf')))
+            settings.load_configs()
+
+            output = StringIO()
+            settings._report_config_discovery(output)
+            self.assertTrue(
+                '%s: 2 config files' % confdir in output.getvalue())
+        finally:
+            os.environ['HOME'] = saved
+            shutil.rmtree(home)
+
+    def test_remembers_default_config_files(self):
+        home = tempfile.mkdtemp()
+        saved = os.environ['HOME']
+        os.environ['HOME'] = home
+        try:
+            found = cliapp.Settings('remember', '1.0').default_config_files
+            with open(os.path.join(home, '.remember.conf'), 'w') as f:
+                f.write('[config]\nunknown = variable\n')
+            settings = cliapp.Settings('remember', '1.0')
+            self.assertEqual(settings.default_config_files, found)
+            settings.load_configs()
+        finally:
+            os.environ['HOME'] = saved
+            shutil.rmtree(home)
+
     def test_has_config_files_attribute(self):
         self.assertEqual(self.settings.config_files,
                          self.settings.default_config_files)
@@ -467,6 +520,44 @@ config:
             cliapp.UnknownConfigVariable,
             self.settings.load_configs, open_file=mock_open)
 
+    def test_reads_yaml_with_either_loader(self):
+        import yaml
+
+        def mock_open(filename, mode=None):
+            return StringIO('''\
+config:
+  foo: [yeehaa, hoo]
+  size: 1k
+extra:
+  bar: baz
+''')
+
+        def mock_open_unknown(filename, mode=None):
+            return StringIO('config:\n  unknown: yeehaa\n')
+
+        self.settings.string_list(['foo'], 'foo help')
+        self.settings.bytesize(['size'], 'size help')
+        self.settings.config_files = ['whatever.yaml']
+        csafe_loader = getattr(yaml, 'CSafeLoader', None)
+        try:
+            for has_libyaml in [True, False]:
+                if not has_libyaml and csafe_loader is not None:
+                    del yaml.CSafeLoader
+                self.assertEqual(
+                    cliapp.settings._yaml_loader(),
+                    getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+                self.settings.load_configs(open_file=mock_open)
+                self.assertEqual(self.settings['foo'], ['yeehaa', 'hoo'])
+                self.assertEqual(self.settings['size'], 1000)
+                self.assertEqual(
+                    self.settings.as_cp().get('extra', 'bar'), 'baz')
+                self.assertRaises(
+                    cliapp.UnknownConfigVariable,
+                    self.settings.load_configs, open_file=mock_open_unknown)
+        finally:
+            if csafe_loader is not None:
+                yaml.CSafeLoader = csafe_loader
+
     def test_load_configs_remembers_extra_sections_in_ini(self):
 
         def mock_open(filename, mode=None):
@@ -518,6 +609,55 @@ extra:
         self.settings.parse_args(['--no-default-configs', '--config=foo.conf'])
         self.assertEqual(self.settings.config_files, ['foo.conf'])
 
+    def test_configs_only_finds_config_options(self):
+        args = self.settings.parse_args(
+            ['--no-default', 'foo', '--config', 'a.conf', '--conf=b.conf'],
+            configs_only=True)
+        self.assertEqual(self.settings.config_files, ['a.conf', 'b.conf'])
+        self.assertEqual(args, ['foo'])
+
+    def test_configs_only_skips_values_of_other_options(self):
+        self.settings.string(['foo', 'f'], 'foo help')
+        self.settings.boolean(['bar', 'b'], 'bar help')
+        args = self.settings.parse_args(
+            ['--no-default-configs', '--foo', '--config=a.conf',
+             '-bf', '--config=b.conf', '-f--config=c.conf', 'x',
+             '--', '--config=d.conf'],
+            configs_only=True)
+        self.assertEqual(self.settings.config_files, [])
+        self.assertEqual(args, ['x', '--config=d.conf'])
+
+    def test_configs_only_ignores_other_options(self):
+        self.settings.string(['foo'], 'foo help')
+        args = self.settings.parse_args(
+            ['--foo=bar', '--unknown', '--no-default-configs'],
+            configs_only=True)
+        self.assertEqual(self.settings['foo'], '')
+        self.assertEqual(self.settings.config_files, [])
+        self.assertEqual(args, [])
+
+    def test_reuses_parser(self):
+        built = []
+        build_parser = self.settings.build_parser
+        self.settings.build_parser = (
+            lambda **kwargs: built.append(kwargs) or build_parser(**kwargs))
+        self.settings.string(['foo'], 'foo help')
+        self.settings.parse_args(['--config=foo.conf'], configs_only=True)
+        self.settings.parse_args(['--foo=bar'])
+        self.assertEqual(len(built), 1)
+        self.settings.string(['bar'], 'bar help')
+        self.settings.parse_args(['--bar=foo'])
+        self.assertEqual(len(built), 2)
+        self.assertEqual(self.settings['foo'], 'bar')
+        self.assertEqual(self.settings['bar'], 'foo')
+
+    def test_reused_parser_shows_current_values_as_defaults(self):
+        self.settings.string(['foo'], 'foo help', default='old')
+        self.settings.parse_args([])
+        self.settings['foo'] = 'new'
+        p = self.settings._get_parser(None, None, False)
+        self.assertEqual(p.defaults['foo'], 'new')
+
     def test_require_raises_error_if_string_unset(self):
         self.settings.string(['foo'], 'foo help', default=None)
         self.assertRaises(cliapp.AppException, self.settings.require,
@@ -600,3 +740,83 @@ bar = dodo
         self.assertEqual(cp.get('config', 'foo'), 'yeehaa')
         self.assertEqual(cp.options('other'), ['bar'])
         self.assertEqual(cp.get('other', 'bar'), 'dodo')
+
+
+class ConfigCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.ini = os.path.join(self.tempdir, 'app.conf')
+        self.yaml = os.path.join(self.tempdir, 'app.yaml')
+        with open(self.ini, 'w') as f:
+            f.write('[config]\nfoo = from ini\nlist = a, b\n')
+        with open(self.yaml, 'w') as f:
+            f.write('config:\n  size: 2k\nextra:\n  bar: baz\n')
+        self.cache = os.path.join(self.tempdir, 'cache', 'settings.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def load(self, version='1.0', read=True):
+        settings = cliapp.Settings('appname', version)
+        settings.string(['foo'], 'foo help')
+        settings.string_list(['list'], 'list help')
+        settings.bytesize(['size'], 'size help')
+        settings.config_files = [self.ini, self.yaml,
+                                 os.path.join(self.tempdir, 'missing.conf')]
+        settings.config_cache = self.cache
+        if not read:
+            settings._read_ini = settings._read_yaml = self.fail
+        settings.load_configs()
+        return settings
+
+    def test_uses_cached_values(self):
+        self.load()
+        self.assertTrue(os.path.exists(self.cache))
+        settings = self.load(read=False)
+        self.assertEqual(settings['foo'], 'from ini')
+        self.assertEqual(settings['list'], ['a', 'b'])
+        self.assertEqual(settings['size'], 2000)
+        self.assertEqual(settings.as_cp().get('extra', 'bar'), 'baz')
+        settings.parse_args(['--list=c'])
+        self.assertEqual(settings['list'], ['c'])
+
+    def test_reads_changed_config_file(self):
+        self.load()
+        with open(self.ini, 'w') as f:
+            f.write('[config]\nfoo = changed\n')
+        settings = self.load()
+        self.assertEqual(settings['foo'], 'changed')
+        self.load(read=False)
+
+    def test_reads_config_files_for_new_version(self):
+        self.load()
+        self.load(version='2.0')
+        self.load(version='2.0', read=False)
+
+    def test_reads_config_files_if_cache_is_broken(self):
+        self.load()
+        with open(self.cache, 'w') as f:
+            f.write('garbage')
+        self.assertEqual(self.load()['foo'], 'from ini')
+
+    def test_reports_missing_required_config_file(self):
+        self.load()
+        settings = cliapp.Settings('appname', '1.0')
+        settings.config_cache = self.cache
+        settings.parse_args(['--config', os.path.join(self.tempdir, 'no')])
+        with self.assertRaises(IOError):
+            settings.load_configs()
+
+    def test_default_cache_is_in_xdg_cache_home(self):
+        saved = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.tempdir
+        try:
+            self.assertEqual(
+                cliapp.Settings('appname', '1.0').default_config_cache,
+                os.path.join(self.tempdir, 'appname', 'settings.cache'))
+        finally:
+            if saved is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = saved
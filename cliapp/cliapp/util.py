@@ -19,7 +19,7 @@
 import gc
 import logging
 import os
-import platform
+import sys
 import time
 
 
@@ -74,7 +74,7 @@ class MemoryProfileDumper(object):
 
     def _vmrss(self):  # pragma: no cover
         '''Return current resident memory use, in KiB.'''
-        if platform.system() != 'Linux':
+        if not sys.platform.startswith('linux'):
             return 0
         try:
             f = open('/proc/self/status')